@@ -11,52 +11,29 @@
 ***************************************************************************
 """
 
-from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
-                       QgsFeatureSink,
                        QgsProcessingException,
-                       QgsProcessingAlgorithm,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterString,
-                       QgsProcessingParameterField,
-                       QgsProcessingParameterRasterDestination,
-                       QgsProcessingParameterFeatureSink,
                        QgsRasterLayer,
                        QgsVectorLayer,
-                       QgsMessageLog,
                        QgsProcessingParameterFile,
-                       Qgis,
-                       QgsPathResolver)
-from qgis import processing
-import numpy
-import glob
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingUtils,
+                       QgsFeatureRequest)
 import os
 from osgeo import gdal
-from datetime import datetime
-from datetime import date
-import pathlib
 import sys
-import shutil
-from bs4 import BeautifulSoup
 
-class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from lakeflattening import qgisalgorithms
+
+class ProcessingDEMWithOneLakeInRegion(qgisalgorithms.LakeFlatteningAlgorithm):
 
-    INPUTDEMLAYER = 'INPUTDEMLAYER'
     INPUTLAKELAYER = 'INPUTLAKELAYER'
-    INPUTAOILAYER = 'INPUTAOI'
     ELEVATIONOFLAKE = 'ELEVATIONOFLAKE'
-    FOLDERFORINTERMEDIATEPROCESSING = 'FOLDERFORINTERMEDIATEPROCESSING'
-    OUTPUT = 'OUTPUT'
-
-    def tr(self, string):
-        """
-        Returns a translatable string with the self.tr() function.
-        """
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return ProcessingDEMWithOneLakeInRegion()
 
     def name(self):
         
@@ -79,27 +56,6 @@ class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
         return self.tr('Process DEM with 1 lake in region')
 
 
-    def group(self):
-        
-        """
-        Returns the name of the group this algorithm belongs to. This string
-        should be localised.
-        """
-        return self.tr('Helper scripts')
-
-
-    def groupId(self):
-        
-        """
-        Returns the unique ID of the group this algorithm belongs to. This
-        string should be fixed for the algorithm, and must not be localised.
-        The group id should be unique within each provider. Group id should
-        contain lowercase alphanumeric characters only and no spaces or other
-        formatting characters.
-        """
-        return 'helperscripts'
-
-
     def shortHelpString(self):
         
         """
@@ -109,7 +65,9 @@ class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
         """
         return self.tr("This algorithm will take as an input a DEM and a vector layer containing the lake. It will make the DEM completely flat where the lake is located. Make sure that the input lake layer is in exactly the " + 
                        "same coordinate system and projection as the input DEM (for example UTM34N and UTM35N will not work). The algorithm takes the input elevation value for the lake and outputs a new DEM, where each " 
-                       "pixel value within the lake is set to this input elevation value.")
+                       "pixel value within the lake is set to this input elevation value. With the direct burn-in (the default), only the window of the DEM around the lake is " +
+                       "read and rewritten, no area of interest is needed and the lake layer is reprojected to the DEM on the fly. A .vrt output then only writes the lake " +
+                       "window, to a GeoTIFF next to it that the VRT draws over the input DEM.")
 
     def initAlgorithm(self, config=None):
         
@@ -135,8 +93,9 @@ class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterFeatureSource(
                 self.INPUTAOILAYER,
-                self.tr('Area of interest - should coincide with the input DEM layer!'),
-                [QgsProcessing.TypeVector]
+                self.tr('Area of interest - should coincide with the input DEM layer! Only needed when the lake elevations are not burned directly into the DEM'),
+                [QgsProcessing.TypeVector],
+                optional=True
             )
         )
         
@@ -150,37 +109,86 @@ class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterFile(
                 self.FOLDERFORINTERMEDIATEPROCESSING,
-                self.tr("Processing folder - a directory with the current date will get created within this folder, and it will hold all the intermediate files"),
-                behavior=QgsProcessingParameterFile.Folder
+                self.tr("Processing folder for debugging - a directory with the current date will get created within this folder, and it will hold all the intermediate files (leave empty to use the temporary folder)"),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
                 )
         )
         
         self.addParameter(
-            QgsProcessingParameterRasterDestination(
-                self.OUTPUT,
-                self.tr('Output layer')
-            )
+            QgsProcessingParameterBoolean(
+                self.DIRECTBURNIN,
+                self.tr('Burn the lake elevation directly into the DEM (only the window of the lake is rewritten, in a copy of the DEM or under a .vrt output; no polygonize/difference step and no area of interest needed)'),
+                defaultValue=True
+                )
         )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MEMORYBUDGET,
+                self.tr('Memory budget in MB - the window of the lake is processed in windows of whole GDAL blocks that fit in this budget (leave empty for half of the available memory, 0 processes it at once)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                optional=True
+                )
+        )
+        
+        self.addTimingParameters(self.tr('Profile the burn in with cProfile (.prof next to the output)'))
+        
+        self.addOutputParameters()
 
 
-    def processAlgorithm(self, parameters, context, feedback):
+    def estimator(self, parameters, context):
+        from lakeflattening import FixedElevation
         
-        dir_path = parameters['FOLDERFORINTERMEDIATEPROCESSING']
-        current_date = date.today()
-        current_date_and_time = str(current_date) + "-" + datetime.now().strftime("%H:%M:%S").replace(":","")
+        elevation = self.parameterAsString(parameters, self.ELEVATIONOFLAKE, context)
+        try:
+            return FixedElevation(elevation)
+        except ValueError:
+            raise QgsProcessingException(self.tr('The elevation of the lake must be a number, not "{}"').format(elevation))
+
+
+    def runAlgorithm(self, parameters, context, feedback, timer):
+        
+        """
+        Runs the algorithm, timing its stages with timer.
+        """
+        from lakeflattening import flatten_dem, write_output
+        
+        if self.parameterAsBoolean(parameters, self.DIRECTBURNIN, context):
+            dem_layer = self.parameterAsRasterLayer(parameters, self.INPUTDEMLAYER, context)
+            lake_source = self.parameterAsSource(parameters, self.INPUTLAKELAYER, context)
+            lake_request = QgsFeatureRequest().setDestinationCrs(dem_layer.crs(), context.transformContext())
+            # every feature of the layer belongs to the one lake
+            with timer.stage('Read lake'):
+                lake = self.readLakes(lake_source, lake_request, feedback)
+            if feedback.isCanceled():
+                return {}
+            
+            # only the window of the DEM around the lake is read, rasterized and
+            # rewritten, in a copy of the DEM or under a .vrt overlay output
+            output_dem = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+            flatten_dem(dem_layer.source(), lake, output_dem, self.estimator(parameters, context), extent_buffer=0,
+                        memory_budget_mb=self.memoryBudget(parameters, context),
+                        feedback=feedback, timer=timer, fill=False, **self.outputFormat(parameters, context))
+            return {self.OUTPUT: output_dem}
         
-        working_dir_path = os.path.join(dir_path, "PROCESS_DEM_WITH_1_LAKE_IN_REGION-" + current_date_and_time)
-        os.mkdir(working_dir_path) 
+        if self.parameterAsSource(parameters, self.INPUTAOILAYER, context) is None:
+            raise QgsProcessingException(self.tr('An area of interest is required when the lake elevation is not burned directly into the DEM'))
         
-        lakeshapefile = QgsVectorLayer(parameters["INPUTLAKELAYER"])
-        mean_lake_elevation = parameters["ELEVATIONOFLAKE"]
+        # the polygonize/difference output path runs Processing algorithms
+        from qgis import processing
+        working_dir_path = self.createWorkingFolder(self.parameterAsString(parameters, self.FOLDERFORINTERMEDIATEPROCESSING, context) or QgsProcessingUtils.tempFolder())
+        
+        mean_lake_elevation = str(self.estimator(parameters, context).elevation)
         
         dem_in_lake = os.path.join(working_dir_path, "DEM-IN-LAKE.tif")
         
         parameters_for_clip_raster_by_mask_layer = {'INPUT': parameters["INPUTDEMLAYER"],
                 'MASK': parameters["INPUTLAKELAYER"],
                 'OUTPUT': dem_in_lake}
-        processing.run('gdal:cliprasterbymasklayer', parameters_for_clip_raster_by_mask_layer, context=context, feedback=feedback)
+        with timer.stage('Clip lake region'):
+            processing.run('gdal:cliprasterbymasklayer', parameters_for_clip_raster_by_mask_layer, context=context, feedback=feedback)
                 
         input_raster = QgsRasterLayer(dem_in_lake, 'raster')
         output_raster = os.path.splitext(dem_in_lake)[0] + "-DEM-SET-TO-INPUT-LAKE-ELEVATION.tif"
@@ -189,34 +197,33 @@ class ProcessingDEMWithOneLakeInRegion(QgsProcessingAlgorithm):
                 'BAND_A' : 1,
                 'FORMULA' : mean_lake_elevation, 
                 'OUTPUT' : output_raster}
-        processing.run('gdal:rastercalculator', parameters_create_new_raster)
+        with timer.stage('Raster calculator'):
+            processing.run('gdal:rastercalculator', parameters_create_new_raster)
                 
         output_vector = os.path.splitext(output_raster)[0] + "-polygon.shp"
         parameters_raster_to_vector = {'INPUT' : output_raster, 'OUTPUT' : output_vector}
-        processing.run('gdal:polygonize', parameters_raster_to_vector)
+        with timer.stage('Polygonize'):
+            processing.run('gdal:polygonize', parameters_raster_to_vector)
         
         
         parameters_difference = {'INPUT' : parameters["INPUTAOI"], 'OVERLAY' : output_vector, 'OUTPUT' : os.path.join(working_dir_path, 'difference.shp')}
-        processing.run('native:difference', parameters_difference)
+        with timer.stage('Difference'):
+            processing.run('native:difference', parameters_difference)
         
         non_lake = QgsVectorLayer(os.path.join(working_dir_path, 'difference.shp'))
         parameters_for_clip_raster_by_mask_layer_2 ={'INPUT': parameters["INPUTDEMLAYER"],'MASK': non_lake, 'OUTPUT': os.path.join(working_dir_path, "DEM-NON-LAKE-REGION.tif")}
-        processing.run('gdal:cliprasterbymasklayer', parameters_for_clip_raster_by_mask_layer_2, context=context, feedback=feedback) 
+        with timer.stage('Clip non-lake region'):
+            processing.run('gdal:cliprasterbymasklayer', parameters_for_clip_raster_by_mask_layer_2, context=context, feedback=feedback) 
         
         final_dems_to_merge = []
         final_dems_to_merge.append(os.path.join(working_dir_path, "DEM-NON-LAKE-REGION.tif"))
         final_dems_to_merge.append(output_raster)
         
         vrt_file = os.path.join(working_dir_path, 'FINAL-DEM.vrt')
-        vrt_2 = gdal.BuildVRT(vrt_file, final_dems_to_merge)
-        final_result = os.path.join(working_dir_path, "FINAL-DEM.tif")
-        gdal.Translate(final_result, vrt_2, format='GTiff')
-
-        processing.run('gdal:translate',
-                   {'INPUT': final_result,
-                   'DATA_TYPE':0,
-                   'TFW': 1,
-                   'OUTPUT': parameters["OUTPUT"]}, context = context, feedback=feedback)
+        # the merged DEM is written once, straight in the output format
+        with timer.stage('Merge'):
+            vrt_2 = gdal.BuildVRT(vrt_file, final_dems_to_merge)
+            write_output(vrt_2, self.parameterAsOutputLayer(parameters, self.OUTPUT, context), **self.outputFormat(parameters, context))
         
         
         return {}
\ No newline at end of file
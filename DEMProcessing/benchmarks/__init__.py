@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Benchmarks of the lake processing pipelines on synthetic DEMs. Run them with
+the DEMProcessing folder on the Python path:
+
+    python -m benchmarks --sizes 1000 10000 40000 --lakes 1 1000 10000 --output results.json
+
+Every run first checks the load time of the scripts against a budget (see
+the startup module) and exits with status 1 when a script is over it.
+"""
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy
+from osgeo import gdal
+
+from lakeflattening import ELEVATION_STATISTICS, RING_BOTH, FixedElevation, StageTimer, flatten_dem, read_lakes, statistic_estimator
+
+from .startup import DEFAULT_BUDGET_MS, describe, measure_startup, within_budget
+from .synthetic import synthetic_case
+
+PIPELINES = ('lake-regions', 'boundary-pixels', 'one-lake')
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, and the
+    # resource module does not exist on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _run_case(pipeline, dem_path, lakes_path, memory_budget_mb, min_slope_degrees, folder, statistic='mean'):
+    # runs in a fresh process, so that the peak RSS belongs to this case only;
+    # the stages are the ones flatten_dem times, so the benchmark follows the
+    # pipeline as it changes
+    baseline_rss_mb = _peak_rss_mb()
+    timer = StageTimer()
+    source = gdal.Open(dem_path)
+    with timer.stage('Read lakes'):
+        lakes = read_lakes(lakes_path, source, 'lake_id')
+    output_path = os.path.join(folder, 'output.tif')
+
+    if pipeline == 'one-lake':
+        # the direct burn-in path of ProcessingDEMWith1LakeInRegion
+        lake = [(1, wkb) for lake_id, wkb in lakes[:1]]
+        flatten_dem(dem_path, lake, output_path, FixedElevation(100.0), extent_buffer=0, memory_budget_mb=memory_budget_mb, timer=timer, fill=False)
+    else:
+        estimator = statistic_estimator(statistic.upper().replace('-', '_'), 1 if pipeline == 'boundary-pixels' else 0, RING_BOTH)
+        flatten_dem(dem_path, lakes, output_path, estimator, min_slope_degrees, extent_buffer=100, memory_budget_mb=memory_budget_mb, timer=timer)
+
+    stages = {}
+    for record in timer.stages:
+        stages[record['name']] = round(stages.get(record['name'], 0.0) + record['seconds'], 6)
+    return {'stages': stages,
+            'seconds': round(timer.total_seconds(), 6),
+            'pixels': source.RasterXSize * source.RasterYSize,
+            'lake_count': len(lakes),
+            'baseline_rss_mb': baseline_rss_mb,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def _environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision,
+            'python': platform.python_version(),
+            'gdal': gdal.__version__,
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the lake processing pipelines on synthetic DEMs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000], help='DEM sizes in pixels per side')
+    parser.add_argument('--lakes', type=int, nargs='+', default=[10, 1000], help='lake counts')
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument('--statistics', nargs='+', choices=[statistic.lower().replace('_', '-') for statistic in ELEVATION_STATISTICS],
+                        default=['mean'], help='lake elevation statistics of the pipelines that measure the lakes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, each in a fresh process')
+    parser.add_argument('--memory-budget', type=int, default=1024, help='memory budget in MB (0: no limit)')
+    parser.add_argument('--min-slope', type=float, default=0.01, help='minimum slope in degrees kept by the sink fill')
+    parser.add_argument('--data-folder', default=os.path.join(tempfile.gettempdir(), 'lakeflattening-benchmarks'),
+                        help='folder for the generated DEMs and lakes, reused between runs')
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_BUDGET_MS, help='load time budget of every script in milliseconds')
+    parser.add_argument('--startup-repeat', type=int, default=5, help='loads per script for the startup check')
+    parser.add_argument('--startup-only', action='store_true', help='only check the load time of the scripts')
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON file for the results')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = _arguments(argv)
+    # the scripts are loaded by QGIS at startup, their load time has a budget
+    startup = measure_startup(arguments.startup_budget, arguments.startup_repeat)
+    for row in startup:
+        print('startup ' + describe(row))
+    os.makedirs(arguments.data_folder, exist_ok=True)
+    results = []
+    for size in [] if arguments.startup_only else arguments.sizes:
+        for lake_count in arguments.lakes:
+            dem_path, lakes_path = synthetic_case(arguments.data_folder, size, lake_count, arguments.seed)
+            for pipeline in arguments.pipelines:
+                # the lake elevation statistic only matters to the pipelines that measure the lakes
+                for statistic in ['fixed'] if pipeline == 'one-lake' else arguments.statistics:
+                    for run in range(arguments.repeat):
+                        with tempfile.TemporaryDirectory(dir=arguments.data_folder) as folder:
+                            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                                result = executor.submit(_run_case, pipeline, dem_path, lakes_path, arguments.memory_budget,
+                                                         arguments.min_slope, folder, statistic).result()
+                        result.update(pipeline=pipeline, statistic=statistic, size=size, lakes=lake_count, seed=arguments.seed, run=run,
+                                      megapixels_per_second=round(result['pixels'] / 1e6 / result['seconds'], 3) if result['seconds'] else None)
+                        results.append(result)
+                        print('{pipeline} ({statistic}) {size}px {lakes} lakes: {seconds:.3f} s, peak RSS {peak_rss_mb} MB'.format(**result))
+
+    with open(arguments.output, 'w') as output:
+        json.dump({'environment': _environment(), 'memory_budget_mb': arguments.memory_budget,
+                   'min_slope_degrees': arguments.min_slope, 'startup_budget_ms': arguments.startup_budget,
+                   'startup': startup, 'results': results}, output, indent=2)
+    print('results written to ' + arguments.output)
+    return 0 if within_budget(startup) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
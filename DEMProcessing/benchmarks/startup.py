@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Load time of the scripts. QGIS imports every script of the toolbox when it
+starts and again whenever the toolbox is refreshed, so whatever a script
+imports at module level is paid for by every session, whether the algorithm
+is run or not. Every target is loaded in a fresh interpreter, after the
+modules a QGIS session has loaded anyway, and its load time is checked
+against a budget:
+
+    python -m benchmarks.startup --budget 200
+"""
+
+
+import argparse
+import glob
+import importlib
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# loaded by QGIS before it loads the scripts of the toolbox
+QGIS_PRELOADED = ('qgis.core', 'osgeo.gdal')
+
+# optional or heavy modules that only the code paths needing them may import
+LAZY_MODULES = ('bs4', 'rasterio', 'psutil', 'cProfile', 'multiprocessing', 'concurrent.futures', 'qgis.processing',
+                'lakeflattening.engine', 'lakeflattening.fill', 'lakeflattening.labels', 'lakeflattening.raster')
+
+DEFAULT_BUDGET_MS = 200.0
+
+
+def startup_targets():
+    
+    """
+    Returns the (target, preloaded modules) pairs that are timed: the
+    lakeflattening package on its own, and every script of the folder with
+    the modules of a QGIS session already loaded.
+    """
+    return [('lakeflattening', ())] + [(path, QGIS_PRELOADED) for path in sorted(glob.glob(os.path.join(SCRIPTS_FOLDER, '*.py')))]
+
+
+def _load(target):
+    if target.endswith('.py'):
+        # like the QGIS script loader, the file is run as a module of its own
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(target))[0], target)
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+    else:
+        importlib.import_module(target)
+
+
+def _probe(target, preload):
+    # runs in the fresh interpreter started by _run_probe
+    try:
+        for name in preload:
+            importlib.import_module(name)
+    except ImportError as error:
+        return {'skipped': '{}: {}'.format(type(error).__name__, error)}
+    before = set(sys.modules)
+    started = time.perf_counter()
+    try:
+        _load(target)
+    except Exception as error:
+        return {'error': '{}: {}'.format(type(error).__name__, error)}
+    return {'milliseconds': (time.perf_counter() - started) * 1000.0,
+            'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules and name not in before]}
+
+
+def _run_probe(target, preload):
+    command = [sys.executable, '-m', 'benchmarks.startup', '--probe', target] + ['--preload=' + name for name in preload]
+    completed = subprocess.run(command, cwd=SCRIPTS_FOLDER, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.decode(errors='replace').strip().splitlines()[-1:] or 'exit code {}'.format(completed.returncode)}
+    return json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+
+def measure_startup(budget_ms=DEFAULT_BUDGET_MS, repeat=5):
+    
+    """
+    Loads every startup target repeat times, each in a fresh interpreter,
+    and returns one row per target: its median load time in milliseconds,
+    the lazy modules it loaded and a status, 'ok', 'over budget' (slower
+    than budget_ms or loading one of the LAZY_MODULES), 'failed' (the
+    target cannot be loaded) or 'skipped' (QGIS or GDAL is not installed).
+    """
+    rows = []
+    for target, preload in startup_targets():
+        row = {'target': os.path.relpath(target, SCRIPTS_FOLDER) if target.endswith('.py') else target,
+               'milliseconds': None, 'lazy_modules_loaded': [], 'status': 'ok', 'message': ''}
+        runs = []
+        for run in range(repeat):
+            result = _run_probe(target, preload)
+            if 'skipped' in result or 'error' in result:
+                row.update(status='skipped' if 'skipped' in result else 'failed', message=str(result.get('skipped') or result['error']))
+                break
+            runs.append(result)
+        if runs and row['status'] == 'ok':
+            row['milliseconds'] = round(statistics.median(result['milliseconds'] for result in runs), 3)
+            row['lazy_modules_loaded'] = sorted(set(name for result in runs for name in result['lazy_modules_loaded']))
+            if row['milliseconds'] > budget_ms or row['lazy_modules_loaded']:
+                row['status'] = 'over budget'
+        rows.append(row)
+    return rows
+
+
+def within_budget(rows):
+    return all(row['status'] in ('ok', 'skipped') for row in rows)
+
+
+def describe(row):
+    if row['milliseconds'] is None:
+        return '{target}: {status} ({message})'.format(**row)
+    text = '{target}: {milliseconds:.1f} ms, {status}'.format(**row)
+    if row['lazy_modules_loaded']:
+        text += ', loads ' + ', '.join(row['lazy_modules_loaded'])
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description='Check the load time of the scripts against a budget.')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, help='load time budget of every script in milliseconds')
+    parser.add_argument('--repeat', type=int, default=5, help='loads per script, each in a fresh interpreter')
+    parser.add_argument('--probe', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='append', default=[], help=argparse.SUPPRESS)
+    arguments = parser.parse_args(argv)
+    if arguments.probe:
+        print(json.dumps(_probe(arguments.probe, arguments.preload)))
+        return 0
+    rows = measure_startup(arguments.budget, arguments.repeat)
+    for row in rows:
+        print(describe(row))
+    return 0 if within_budget(rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
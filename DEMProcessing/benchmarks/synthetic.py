@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import math
+import os
+
+import numpy
+from osgeo import gdal, ogr, osr
+
+# a projected coordinate system with metre units, so that cell sizes and the
+# minimum slope of the sink fill behave like on a real DEM
+SYNTHETIC_EPSG = 32633
+SYNTHETIC_ORIGIN = (500000.0, 6500000.0)
+SYNTHETIC_CELL_SIZE = 10.0
+SYNTHETIC_NODATA = -9999.0
+LAKE_ID_FIELD = 'lake_id'
+
+
+def synthetic_lakes(size, lake_count, seed=0, lake_fraction=0.1):
+    
+    """
+    Returns reproducible depressions for a size x size DEM as a list of
+    (lake_id, column, row, radius, depth) tuples in pixels and metres. Their
+    radii are chosen so that the lakes cover about lake_fraction of the DEM.
+    """
+    random = numpy.random.RandomState(seed)
+    mean_radius = min(size / 4.0, max(2.0, size * math.sqrt(lake_fraction / (math.pi * max(1, lake_count)))))
+    radii = numpy.clip(random.uniform(0.5, 1.5, lake_count) * mean_radius, 2.0, size / 4.0)
+    columns = random.uniform(radii, size - radii)
+    rows = random.uniform(radii, size - radii)
+    depths = random.uniform(2.0, 20.0, lake_count)
+    return [(lake_id, columns[lake_id - 1], rows[lake_id - 1], radii[lake_id - 1], depths[lake_id - 1])
+            for lake_id in range(1, lake_count + 1)]
+
+
+def write_synthetic_dem(path, size, lakes, seed=0, rows_per_strip=512):
+    
+    """
+    Writes a size x size Float32 GeoTIFF with a gently tilted, wavy surface
+    plus noise, lowered into a bowl under every lake of synthetic_lakes. The
+    DEM is written in strips, so any size can be generated in bounded memory.
+    """
+    output = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_Float32,
+                                                  options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    output.SetGeoTransform((SYNTHETIC_ORIGIN[0], SYNTHETIC_CELL_SIZE, 0.0, SYNTHETIC_ORIGIN[1], 0.0, -SYNTHETIC_CELL_SIZE))
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(SYNTHETIC_EPSG)
+    output.SetProjection(spatial_reference.ExportToWkt())
+    band = output.GetRasterBand(1)
+    band.SetNoDataValue(SYNTHETIC_NODATA)
+
+    lake_rows = numpy.array([lake[2] for lake in lakes])
+    lake_radii = numpy.array([lake[3] for lake in lakes])
+    columns = numpy.arange(size, dtype=numpy.float64)
+    for yoff in range(0, size, rows_per_strip):
+        strip_rows = min(rows_per_strip, size - yoff)
+        # the noise of a strip only depends on the seed and the strip offset
+        random = numpy.random.RandomState((seed, yoff))
+        rows = numpy.arange(yoff, yoff + strip_rows, dtype=numpy.float64)[:, numpy.newaxis]
+        elevations = (100.0 + 0.01 * rows + 0.005 * columns
+                      + 5.0 * numpy.sin(columns / 97.0) * numpy.cos(rows / 113.0)
+                      + random.normal(0.0, 0.5, (strip_rows, size)))
+        near = numpy.nonzero((lake_rows + lake_radii >= yoff) & (lake_rows - lake_radii < yoff + strip_rows))[0]
+        for index in near:
+            lake_id, column, row, radius, depth = lakes[index]
+            x0, x1 = max(0, int(column - radius)), min(size, int(column + radius) + 2)
+            y0, y1 = max(yoff, int(row - radius)), min(yoff + strip_rows, int(row + radius) + 2)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            distance = numpy.hypot(columns[x0:x1] + 0.5 - column, numpy.arange(y0, y1)[:, numpy.newaxis] + 0.5 - row) / radius
+            bowl = elevations[y0 - yoff:y1 - yoff, x0:x1]
+            bowl -= numpy.where(distance < 1.0, depth * (1.0 - distance ** 2), 0.0)
+        band.WriteArray(elevations.astype(numpy.float32), 0, yoff)
+
+    band.FlushCache()
+    output = None
+    return path
+
+
+def write_synthetic_lakes(path, lakes, shoreline=0.8, segments=32):
+    
+    """
+    Writes the lakes of synthetic_lakes as polygons with a lake_id field to a
+    GeoPackage. Every shoreline is a circle at shoreline times the radius of
+    its depression.
+    """
+    if ogr.GetDriverByName('GPKG').Open(path) is not None:
+        ogr.GetDriverByName('GPKG').DeleteDataSource(path)
+    vector = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(SYNTHETIC_EPSG)
+    layer = vector.CreateLayer('lakes', srs=spatial_reference, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn(LAKE_ID_FIELD, ogr.OFTInteger))
+    angles = numpy.linspace(0.0, 2.0 * math.pi, segments, endpoint=False)
+
+    layer.StartTransaction()
+    for lake_id, column, row, radius, depth in lakes:
+        x = SYNTHETIC_ORIGIN[0] + (column + shoreline * radius * numpy.cos(angles)) * SYNTHETIC_CELL_SIZE
+        y = SYNTHETIC_ORIGIN[1] - (row + shoreline * radius * numpy.sin(angles)) * SYNTHETIC_CELL_SIZE
+        ring = ', '.join('%r %r' % point for point in zip(x.tolist() + [x[0]], y.tolist() + [y[0]]))
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField(LAKE_ID_FIELD, lake_id)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((' + ring + '))'))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    vector = None
+    return path
+
+
+def synthetic_case(folder, size, lake_count, seed=0):
+    
+    """
+    Returns the (dem_path, lakes_path) of a synthetic case in folder,
+    generating it on first use.
+    """
+    name = 'synthetic-{}px-{}lakes-seed{}'.format(size, lake_count, seed)
+    dem_path = os.path.join(folder, name + '.tif')
+    lakes_path = os.path.join(folder, name + '.gpkg')
+    if not (os.path.exists(dem_path) and os.path.exists(lakes_path)):
+        lakes = synthetic_lakes(size, lake_count, seed)
+        write_synthetic_dem(dem_path + '.partial', size, lakes, seed)
+        write_synthetic_lakes(lakes_path, lakes)
+        os.replace(dem_path + '.partial', dem_path)
+    return dem_path, lakes_path
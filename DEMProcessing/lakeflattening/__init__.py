@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Raster engine shared by the DEM processing scripts. Every lake is burned
+once into an integer label grid aligned with the DEM, and the per-lake
+statistics are then computed in a single vectorized pass over that grid.
+
+The names below are imported from their module on first use (PEP 562):
+importing the package loads nothing else, and a caller only loads the
+modules it takes names from.
+"""
+
+
+import importlib
+
+_EXPORTS = {
+    'LAKE_BATCH_SIZE': 'labels',
+    'RING_BOTH': 'labels',
+    'RING_INNER': 'labels',
+    'RING_OUTER': 'labels',
+    'LakeLabels': 'labels',
+    'boundary_ring': 'labels',
+    'rasterize_lakes': 'labels',
+    'ZonalAccumulator': 'zonal',
+    'STATISTICS_FIELDS': 'statistics',
+    'label_counts': 'statistics',
+    'lake_statistics_rows': 'statistics',
+    'block_windows': 'tiling',
+    'extent_window': 'tiling',
+    'fits_in_memory': 'tiling',
+    'pixels_for_budget': 'tiling',
+    'same_grid': 'tiling',
+    'OUTPUT_COMPRESSIONS': 'raster',
+    'OUTPUT_LAYOUTS': 'raster',
+    'band_dataset': 'raster',
+    'burn_epoch_elevations': 'raster',
+    'burn_lake_elevations': 'raster',
+    'burn_lookup': 'raster',
+    'finish_burned_output': 'raster',
+    'output_format': 'raster',
+    'pass_through_copy': 'raster',
+    'plain_geotiff': 'raster',
+    'window_dataset': 'raster',
+    'write_lake_elevation_raster': 'raster',
+    'write_output': 'raster',
+    'write_world_file': 'raster',
+    'measure_epochs': 'engine',
+    'measure_lakes': 'engine',
+    'pool_context': 'engine',
+    'ELEVATION_STATISTICS': 'estimators',
+    'BoundaryMean': 'estimators',
+    'ElevationEstimator': 'estimators',
+    'FixedElevation': 'estimators',
+    'InteriorMean': 'estimators',
+    'MedianElevation': 'estimators',
+    'ModeElevation': 'estimators',
+    'PercentileElevation': 'estimators',
+    'PixelStatistic': 'estimators',
+    'TrimmedMeanElevation': 'estimators',
+    'statistic_estimator': 'estimators',
+    'FILL_BYTES_PER_PIXEL': 'fill',
+    'fill_sinks': 'fill',
+    'RasterCache': 'cache',
+    'lakes_digest': 'cache',
+    'raster_digest': 'cache',
+    'Intermediates': 'intermediates',
+    'is_in_memory': 'intermediates',
+    'epoch_layers': 'pipeline',
+    'flatten_dem': 'pipeline',
+    'flatten_epochs': 'pipeline',
+    'iter_lakes': 'pipeline',
+    'lakes_extent': 'pipeline',
+    'read_lakes': 'pipeline',
+    'StageTimer': 'timing',
+    'raster_pixels': 'timing',
+    'RunManifest': 'checkpoint',
+    'file_signature': 'checkpoint',
+    'lake_geometry_hashes': 'checkpoint',
+    'lake_key': 'checkpoint',
+    'lake_record': 'checkpoint',
+    'signature': 'checkpoint',
+    'changed_lakes': 'incremental',
+    'lakes_outside': 'incremental',
+    'reflatten_lakes': 'incremental',
+    'LAKE_TILE_PIXELS': 'spatialindex',
+    'EnvelopeIndex': 'spatialindex',
+    'lake_tiles': 'spatialindex',
+    'lake_windows': 'spatialindex',
+    'STREAM_THREADS': 'streaming',
+    'stream_windows': 'streaming',
+    'windows_in_flight': 'streaming',
+    'AUTO_MEMORY_FRACTION': 'memoryplan',
+    'MemoryPlan': 'memoryplan',
+    'auto_memory_budget_mb': 'memoryplan',
+    'available_memory_mb': 'memoryplan',
+    'dem_value_bytes': 'memoryplan',
+    'plan_memory': 'memoryplan',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Headless batch runner: flattens the lakes of one lakes layer into many DEM
+tiles, several tiles at a time, without starting QGIS. Run it with the
+DEMProcessing folder on the Python path, for example
+
+    python -m lakeflattening --lakes lakes.gpkg --id-field id --output-folder out "tiles/*.tif"
+
+DEMs can be given as paths, glob patterns or @file lists (one per line).
+With --epochs they are the epochs of one grid (every band of a multi-band
+DEM is an epoch as well), flattened together with one lake label grid.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import sys
+from concurrent.futures.process import BrokenProcessPool
+
+from .engine import pool_context
+from .estimators import ELEVATION_STATISTICS, statistic_estimator
+from .labels import RING_BOTH, RING_INNER, RING_OUTER
+from .memoryplan import auto_memory_budget_mb
+from .pipeline import epoch_layers, run_epochs, run_tile
+
+RING_SIDES = {'inside': RING_INNER, 'outside': RING_OUTER, 'both': RING_BOTH}
+SUMMARY_FIELDS = ('dem', 'output', 'status', 'lakes', 'seconds', 'message')
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m lakeflattening', fromfile_prefix_chars='@',
+                                     description='Flatten the lakes of a lakes layer into many DEM tiles.')
+    parser.add_argument('dems', nargs='+', help='DEM paths or glob patterns')
+    parser.add_argument('--lakes', required=True, help='lakes layer (any OGR format)')
+    parser.add_argument('--layer', help='layer name inside the lakes data source (default: the first layer)')
+    parser.add_argument('--id-field', help='field with a unique id per lake (default: the feature id)')
+    parser.add_argument('--output-folder', required=True, help='folder for the flattened DEMs, named after the input tiles')
+    parser.add_argument('--summary', help='per-tile status CSV (default: summary.csv in the output folder)')
+    parser.add_argument('--method', choices=('mean', 'boundary'), default='mean',
+                        help='lake elevation from all lake pixels or from the boundary pixels')
+    parser.add_argument('--boundary-side', choices=sorted(RING_SIDES), default='both')
+    parser.add_argument('--boundary-width', type=int, default=1, help='boundary width in pixels')
+    parser.add_argument('--statistic', choices=[statistic.lower().replace('_', '-') for statistic in ELEVATION_STATISTICS], default='mean',
+                        help='statistic of the pixel elevations used as the lake elevation')
+    parser.add_argument('--percentile', type=float, default=50.0, help='percentile (0 to 100) for --statistic percentile')
+    parser.add_argument('--trim', type=float, default=0.1, help='proportion left out on each side for --statistic trimmed-mean')
+    parser.add_argument('--bin-width', type=float, default=0.1, help='histogram bin width in meters for --statistic mode')
+    parser.add_argument('--min-slope', type=float, default=0.01, help='minimum slope in degrees kept by the sink fill')
+    parser.add_argument('--extent-buffer', type=int, default=100, help='pixels around the lakes that are filled and rewritten')
+    parser.add_argument('--memory-budget', type=int,
+                        help='MB shared by the tiles running at the same time (default: half of the available memory, 0: no limit)')
+    parser.add_argument('--intermediates-memory', type=int,
+                        help='MB of intermediate files per tile kept in memory (default: taken out of the memory budget of the tile)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='tiles processed at the same time')
+    parser.add_argument('--layout', choices=('striped', 'tiled', 'cog'), default='striped',
+                        help='output layout: striped GeoTIFF, 512 x 512 tiled GeoTIFF or cloud optimized GeoTIFF')
+    parser.add_argument('--compress', choices=('none', 'deflate', 'zstd', 'lerc'), default='none', help='output compression')
+    parser.add_argument('--compress-threads', type=int, default=0,
+                        help='threads compressing each output (default: the CPUs shared by the tiles running at the same time)')
+    parser.add_argument('--cache-folder', help='cache for sink filled DEMs and lake label grids')
+    parser.add_argument('--cache-size', type=int, default=10240, help='cache size limit in MB')
+    parser.add_argument('--trace', action='store_true', help='write the stage timings of every tile as a Chrome trace next to its output')
+    parser.add_argument('--overwrite', action='store_true', help='process tiles whose output already exists')
+    parser.add_argument('--epochs', action='store_true',
+                        help='the DEMs (and the bands of multi-band DEMs) are co-registered epochs: rasterize the lakes once and '
+                             'flatten all epochs in one sweep, always writing every output')
+    return parser.parse_args(argv)
+
+
+def _expand(patterns):
+    dems = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if glob.has_magic(pattern):
+            dems.extend(sorted(glob.glob(pattern)))
+        elif pattern:
+            dems.append(pattern)
+    return list(dict.fromkeys(dems))
+
+
+def _epoch_outputs(output_folder, layers):
+    # named after the DEMs, and after the band for the bands of multi-band DEMs
+    multi_band = {dem for dem, band in layers if band > 1}
+    return [os.path.join(output_folder, os.path.splitext(os.path.basename(dem))[0] + ('-band{}'.format(band) if dem in multi_band else '') + '.tif')
+            for dem, band in layers]
+
+
+def _report(row, done, total):
+    print('[{}/{}] {} {} ({} lakes, {} s) {}'.format(done, total, row[2], row[0], row[3], row[4], row[5]).rstrip())
+
+
+def _tile_output(output_folder, dem):
+    return os.path.join(output_folder, os.path.splitext(os.path.basename(dem))[0] + '.tif')
+
+
+def _shared_outputs(output_folder, dems):
+    # the DEMs whose outputs would overwrite each other, by output
+    outputs = {}
+    for dem in dems:
+        outputs.setdefault(os.path.normcase(os.path.abspath(_tile_output(output_folder, dem))), []).append(dem)
+    return {output: shared for output, shared in outputs.items() if len(shared) > 1}
+
+
+def _failed(dem, output, error):
+    return (dem, output, 'failed', 0, 0.0, '{}: {}'.format(type(error).__name__, error))
+
+
+def _run_tiles(arguments, dems, jobs, options):
+    rows = {}
+    tiles = []
+    for dem in dems:
+        output = _tile_output(arguments.output_folder, dem)
+        if os.path.exists(output) and not arguments.overwrite:
+            rows[dem] = (dem, output, 'skipped', 0, 0.0, 'output exists')
+        else:
+            tiles.append((dem, output))
+
+    def report(row):
+        rows[row[0]] = row
+        _report(row, len(rows), len(dems))
+
+    # the worker processes import the engine once and then take tile after
+    # tile; a tile whose worker fails, or dies and breaks the pool, still
+    # gets its row
+    if jobs == 1:
+        for dem, output in tiles:
+            report(run_tile(dem, arguments.lakes, output, **options))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=pool_context()) as executor:
+            futures = {}
+            for dem, output in tiles:
+                try:
+                    futures[executor.submit(run_tile, dem, arguments.lakes, output, **options)] = (dem, output)
+                except BrokenProcessPool as error:
+                    report(_failed(dem, output, error))
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    report(future.result())
+                except Exception as error:
+                    report(_failed(*futures[future], error))
+    return [rows[dem] for dem in dems]
+
+
+def main(argv=None):
+    arguments = _arguments(argv)
+    dems = _expand(arguments.dems)
+    if not dems:
+        print('No DEMs match ' + ' '.join(arguments.dems), file=sys.stderr)
+        return 2
+    shared = _shared_outputs(arguments.output_folder, dems)
+    if shared:
+        # DEMs of the same name in different folders would overwrite each other
+        for output, shared_dems in sorted(shared.items()):
+            print('{} would all be written to {}'.format(', '.join(shared_dems), output), file=sys.stderr)
+        return 2
+    os.makedirs(arguments.output_folder, exist_ok=True)
+    # the epochs of a stack are flattened in one run
+    jobs = 1 if arguments.epochs else max(1, min(arguments.jobs, len(dems)))
+    # the automatic budget is measured once and shared by the tiles
+    memory_budget = auto_memory_budget_mb() if arguments.memory_budget is None else arguments.memory_budget
+    print('Memory budget: {}'.format('{} MB'.format(memory_budget) if memory_budget else 'no limit') +
+          ('' if arguments.epochs else ', {} tiles at a time'.format(jobs)))
+
+    estimator = statistic_estimator(arguments.statistic.upper().replace('-', '_'),
+                                    arguments.boundary_width if arguments.method == 'boundary' else 0, RING_SIDES[arguments.boundary_side],
+                                    arguments.percentile, arguments.trim, arguments.bin_width)
+    options = dict(estimator=estimator,
+                   min_slope_degrees=arguments.min_slope,
+                   extent_buffer=arguments.extent_buffer,
+                   memory_budget_mb=memory_budget // jobs,
+                   intermediates_mb=arguments.intermediates_memory,
+                   id_field=arguments.id_field,
+                   layer_name=arguments.layer,
+                   cache_folder=arguments.cache_folder,
+                   cache_bytes=arguments.cache_size * 1024 * 1024,
+                   trace=arguments.trace,
+                   layout=arguments.layout.upper(),
+                   compression=arguments.compress.upper(),
+                   threads=arguments.compress_threads or max(1, (os.cpu_count() or 1) // jobs))
+    if memory_budget and not options['memory_budget_mb']:
+        options['memory_budget_mb'] = 1
+
+    if arguments.epochs:
+        try:
+            layers = epoch_layers(dems)
+        except RuntimeError as error:
+            print(error, file=sys.stderr)
+            return 2
+        # the cache keys are per DEM, the stack is not cached
+        epoch_options = {name: value for name, value in options.items() if name not in ('cache_folder', 'cache_bytes', 'trace')}
+        summary_rows = run_epochs(layers, arguments.lakes, _epoch_outputs(arguments.output_folder, layers),
+                                  trace_path=os.path.join(arguments.output_folder, 'epochs.trace.json') if arguments.trace else None,
+                                  **epoch_options)
+        for done, row in enumerate(summary_rows, start=1):
+            _report(row, done, len(summary_rows))
+    else:
+        summary_rows = _run_tiles(arguments, dems, jobs, options)
+
+    summary = arguments.summary or os.path.join(arguments.output_folder, 'summary.csv')
+    with open(summary, 'w', newline='') as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(SUMMARY_FIELDS)
+        writer.writerows(summary_rows)
+    failed = sum(1 for row in summary_rows if row[2] == 'failed')
+    print('{} {}, {} failed, summary written to {}'.format(len(summary_rows), 'epochs' if arguments.epochs else 'tiles', failed, summary))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
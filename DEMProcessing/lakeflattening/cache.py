@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from osgeo import gdal
+
+from .intermediates import is_in_memory
+from .labels import LakeLabels
+from .tiling import block_windows
+
+
+def _grid_signature(dataset):
+    return repr((dataset.RasterXSize, dataset.RasterYSize, tuple(dataset.GetGeoTransform()), dataset.GetProjection())).encode()
+
+
+def raster_digest(dataset, max_pixels=None, *extra):
+    
+    """
+    Returns a content hash of the first band of a dataset: its grid, nodata
+    value and pixels, read window by window. Anything in extra (for example
+    the fill parameters) is hashed as well.
+    """
+    band = dataset.GetRasterBand(1)
+    digest = hashlib.sha256(_grid_signature(dataset))
+    digest.update(repr((band.DataType, band.GetNoDataValue()) + extra).encode())
+    for window in block_windows(dataset, max_pixels):
+        digest.update(band.ReadRaster(*window))
+    return digest.hexdigest()
+
+
+def lakes_digest(lakes, dem):
+    
+    """
+    Returns a content hash of the lakes, a list of (lake_id, wkb) pairs, on the
+    grid of the dem dataset.
+    """
+    digest = hashlib.sha256(_grid_signature(dem))
+    for lake_id, wkb in lakes:
+        digest.update(repr(lake_id).encode())
+        digest.update(bytes(wkb))
+    return digest.hexdigest()
+
+
+class RasterCache:
+
+    """
+    Folder of rasters keyed on content hashes, shared between runs. Every
+    entry is a <key>.tif with optional sidecar files named <key>.*. Entries are
+    touched when they are used and the least recently used ones are removed
+    once the folder grows beyond max_bytes, except the entries this cache
+    object has handed out or stored (in_use), which the run still reads.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.in_use = set()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key, extension='.tif'):
+        return os.path.join(self.folder, key + extension)
+
+    def _temporary_path(self, key):
+        # a name of its own for every write, so that runs storing the same
+        # key at the same time never write to the same file
+        (handle, path) = tempfile.mkstemp(suffix='.partial', prefix=key + '.', dir=self.folder)
+        os.close(handle)
+        return path
+
+    def get(self, key):
+        
+        """
+        Returns the path of the raster stored under key, or None on a miss.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        self.in_use.add(key)
+        return path
+
+    def put(self, key, raster_path):
+        
+        """
+        Moves a finished raster (on disk or in /vsimem) into the cache under
+        key and returns its new path. The move goes through a temporary name
+        so that a half-written entry is never picked up by another run.
+        """
+        path = self.path(key)
+        temporary_path = self._temporary_path(key)
+        if is_in_memory(raster_path):
+            gdal.GetDriverByName('GTiff').CreateCopy(temporary_path, gdal.Open(raster_path), options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+            gdal.Unlink(raster_path)
+        else:
+            shutil.move(raster_path, temporary_path)
+        os.replace(temporary_path, path)
+        self.in_use.add(key)
+        self.evict(self.in_use)
+        return path
+
+    def get_labels(self, key):
+        
+        """
+        Returns the LakeLabels stored under key, or None on a miss.
+        """
+        path = self.get(key)
+        if path is None or not os.path.exists(self.path(key, '.json')):
+            return None
+        with open(self.path(key, '.json')) as lake_ids:
+            return LakeLabels(gdal.Open(path), json.load(lake_ids))
+
+    def put_labels(self, key, labels):
+        
+        """
+        Stores a label grid and its lake ids under key and returns the cached
+        LakeLabels. Lake ids that JSON cannot hold are stored as strings.
+        """
+        temporary_path = self._temporary_path(key)
+        with open(temporary_path, 'w') as lake_ids:
+            json.dump(labels.lake_ids, lake_ids, default=str)
+        os.replace(temporary_path, self.path(key, '.json'))
+        temporary_path = self._temporary_path(key)
+        gdal.GetDriverByName('GTiff').CreateCopy(temporary_path, labels.dataset, options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+        os.replace(temporary_path, self.path(key))
+        self.in_use.add(key)
+        self.evict(self.in_use)
+        return LakeLabels(gdal.Open(self.path(key)), labels.lake_ids)
+
+    def evict(self, keep=()):
+        
+        """
+        Removes least recently used entries until the cache fits in max_bytes,
+        never the entries whose key is in keep.
+        """
+        entries = {}
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not os.path.isfile(path) or name.endswith('.partial'):
+                continue
+            status = os.stat(path)
+            key = name.split('.')[0]
+            used, size, paths = entries.get(key, (0.0, 0, []))
+            entries[key] = (max(used, status.st_mtime), size + status.st_size, paths + [path])
+
+        total = sum(size for used, size, paths in entries.values())
+        for key, (used, size, paths) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            for path in paths:
+                os.remove(path)
+            total -= size
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import hashlib
+import json
+import os
+import time
+
+import numpy
+
+from .zonal import ZonalAccumulator
+
+MANIFEST_NAME = 'manifest.json'
+MEASURE_CHECKPOINT_NAME = 'MEASURE-CHECKPOINT.npz'
+
+
+def lake_geometry_hashes(lakes):
+    
+    """
+    Returns a dict from lake id to a hash of the geometries of that lake, for
+    a list of (lake_id, wkb) pairs. Lakes made of several features hash them
+    in order.
+    """
+    digests = {}
+    for lake_id, wkb in lakes:
+        digests.setdefault(lake_id, hashlib.sha256()).update(bytes(wkb))
+    return {lake_id: digest.hexdigest() for lake_id, digest in digests.items()}
+
+
+def file_signature(path):
+    
+    """
+    Returns a cheap signature of an input file: its path, size and
+    modification time (just the path for sources that are not files).
+    """
+    try:
+        status = os.stat(path)
+    except OSError:
+        return [path]
+    return [path, status.st_size, status.st_mtime_ns]
+
+
+def signature(*values):
+    return hashlib.sha256(repr(values).encode()).hexdigest()
+
+
+def _json_value(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+def lake_key(lake_id):
+    
+    """
+    Returns a lake id the way it is stored in the manifest (a QGIS or OGR id
+    such as a date becomes a string), for comparisons with recorded lakes.
+    """
+    return _json_value(lake_id)
+
+
+def lake_record(lake_id, elevation, geometry_hash, window=None):
+    
+    """
+    Returns the manifest record of a lake. A NaN elevation is stored as None.
+    """
+    return {'id': lake_key(lake_id),
+            'elevation': None if elevation is None or numpy.isnan(elevation) else float(elevation),
+            'hash': geometry_hash,
+            'window': None if window is None else [int(value) for value in window]}
+
+
+class RunManifest:
+
+    """
+    Progress of a run, kept as manifest.json in its working folder so that a
+    run that crashed or was canceled can be resumed from that folder.
+
+    inputs is a dict of named input signatures (for example the DEM, the fill
+    parameters and the lakes). Every completed stage is recorded together with
+    the signatures it depends on and is only reused while those are unchanged
+    and its files still exist. The lake measurement is checkpointed window by
+    window, and the completed lakes are recorded with their elevation and
+    geometry hash.
+    """
+
+    def __init__(self, folder, inputs, resume=False):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.inputs = _json_value(inputs)
+        self.data = {'inputs': self.inputs, 'stages': {}, 'lakes': []}
+        if resume:
+            if not os.path.exists(self.path):
+                raise ValueError('There is no {} to resume from in {}'.format(MANIFEST_NAME, folder))
+            with open(self.path) as manifest:
+                self.data = json.load(manifest)
+            self.data['inputs'] = self.inputs
+        self._pending = None
+        self._saved = time.monotonic()
+
+    def add_inputs(self, **signatures):
+        self.inputs.update(_json_value(signatures))
+
+    def save(self):
+        temporary_path = self.path + '.partial'
+        with open(temporary_path, 'w') as manifest:
+            json.dump(self.data, manifest, indent=1, default=str)
+        os.replace(temporary_path, self.path)
+
+    def completed(self, stage):
+        
+        """
+        Returns the record of a completed stage, or None when it has not been
+        completed, its inputs changed or one of its files is gone.
+        """
+        record = self.data['stages'].get(stage)
+        if record is None:
+            return None
+        if any(self.inputs.get(name) != value for name, value in record['inputs'].items()):
+            return None
+        if any(not os.path.exists(path) for path in record.get('files', [])):
+            return None
+        return record
+
+    def complete(self, stage, depends_on, files=(), **details):
+        
+        """
+        Records a completed stage, the input signatures it depends on and the
+        files it produced, and saves the manifest.
+        """
+        record = {'inputs': {name: self.inputs.get(name) for name in depends_on}, 'files': list(files)}
+        record.update(_json_value(details))
+        self.data['stages'][stage] = record
+        self.save()
+
+    def measure_resume(self, window_count):
+        
+        """
+        Returns the (done, zonal, pixel_counts, boundary_pixel_counts) state
+        saved by an interrupted lake measurement, for measure_lakes(resume=),
+        or None when there is nothing to resume.
+        """
+        record = self.completed('measure')
+        if record is None or record['windows'] != window_count:
+            return None
+        with numpy.load(record['files'][0]) as state:
+            zonal = ZonalAccumulator(len(state['sums']) - 1, bool(state['extremes']), 'values' in state.files)
+            zonal.sums, zonal.counts, zonal.mins, zonal.maxs = state['sums'], state['counts'], state['mins'], state['maxs']
+            if zonal.keep_values:
+                zonal.value_labels, zonal.values = [state['value_labels']], [state['values']]
+            return (record['done'], zonal, state['pixel_counts'], state['boundary_pixel_counts'])
+
+    def measure_checkpoint(self, depends_on, window_count, interval=30.0):
+        
+        """
+        Returns a checkpoint callback for measure_lakes that saves the partial
+        totals at most every interval seconds. Call flush() afterwards to save
+        the last state, also after a cancellation.
+        """
+        def checkpoint(done, zonal, pixel_counts, boundary_pixel_counts):
+            self._pending = (depends_on, window_count, done, zonal, pixel_counts, boundary_pixel_counts)
+            if done == window_count or time.monotonic() - self._saved >= interval:
+                self.flush()
+        return checkpoint
+
+    def flush(self):
+        if self._pending is None:
+            return
+        (depends_on, window_count, done, zonal, pixel_counts, boundary_pixel_counts) = self._pending
+        path = os.path.join(self.folder, MEASURE_CHECKPOINT_NAME)
+        with open(path + '.partial', 'wb') as state:
+            # the kept lake values are saved sorted, which the statistics need anyway
+            kept = dict(zip(('value_labels', 'values'), zonal.sorted_values())) if zonal.keep_values else {}
+            numpy.savez(state, sums=zonal.sums, counts=zonal.counts, mins=zonal.mins, maxs=zonal.maxs, extremes=zonal.extremes,
+                        pixel_counts=pixel_counts, boundary_pixel_counts=boundary_pixel_counts, **kept)
+        os.replace(path + '.partial', path)
+        self.complete('measure', depends_on, files=[path], done=done, windows=window_count)
+        self._pending = None
+        self._saved = time.monotonic()
+
+    def record(self, stage):
+        
+        """
+        Returns the record of a stage whatever the current inputs, or None.
+        """
+        return self.data['stages'].get(stage)
+
+    def forget(self, *stages):
+        for stage in stages:
+            self.data['stages'].pop(stage, None)
+        self.save()
+
+    def record_lakes(self, lake_ids, elevations, geometry_hashes, windows=None):
+        
+        """
+        Records every lake with its elevation (indexed by label), geometry hash
+        and pixel window on the sink filled DEM, and saves the manifest.
+        """
+        windows = windows or {}
+        self.set_lakes([lake_record(lake_id, elevations[label], geometry_hashes.get(lake_id), windows.get(lake_id))
+                        for label, lake_id in enumerate(lake_ids, start=1)])
+
+    def set_lakes(self, records):
+        self.data['lakes'] = records
+        self.save()
+
+    def lakes(self):
+        return self.data['lakes']
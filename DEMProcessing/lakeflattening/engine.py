@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import itertools
+import os
+import sys
+
+import numpy
+from osgeo import gdal
+
+from .intermediates import is_in_memory
+from .labels import RING_BOTH, LakeLabels, boundary_ring
+from .statistics import label_counts
+from .streaming import stream_windows
+from .tiling import expand_window
+from .zonal import ZonalAccumulator, valid_pixels
+
+# datasets opened once by every worker process of the pool
+_worker_datasets = {}
+
+
+def _read_window(dem, labels, window, ring_width, ring_side, from_ring, extremes, count_pixels, keep_values):
+    # the DEM window and the label window, with a halo for the boundary ring
+    needs_ring = ring_width > 0 and (from_ring or count_pixels)
+    grown, crop = expand_window(dem, window, ring_width if needs_ring else 0)
+    band = dem.GetRasterBand(1)
+    return band.ReadAsArray(*window), labels.read(*grown), crop, band.GetNoDataValue()
+
+
+def _reduce_window(lake_count, data, ring_width, ring_side, from_ring, extremes, count_pixels, keep_values):
+    (values, label_grid, crop, nodata) = data
+    zonal = ZonalAccumulator(lake_count, extremes, keep_values)
+    pixel_counts = numpy.zeros(lake_count + 1, dtype=numpy.int64)
+    boundary_pixel_counts = numpy.zeros(lake_count + 1, dtype=numpy.int64)
+    needs_ring = ring_width > 0 and (from_ring or count_pixels)
+
+    ring = boundary_ring(label_grid, ring_width, ring_side)[crop] if needs_ring else None
+    label_grid = label_grid[crop]
+    zonal.add(values, ring if from_ring else label_grid, nodata)
+
+    if count_pixels:
+        pixel_counts += label_counts(label_grid, lake_count)
+        if ring is not None:
+            boundary_pixel_counts += label_counts(ring, lake_count)
+
+    return zonal, pixel_counts, boundary_pixel_counts
+
+
+def _measure_window(dem, labels, window, *options):
+    return _reduce_window(labels.count, _read_window(dem, labels, window, *options), *options)
+
+
+def _open_worker_datasets(dem_path, labels_path, lake_count):
+    _worker_datasets['dem'] = gdal.Open(dem_path)
+    _worker_datasets['labels'] = LakeLabels(gdal.Open(labels_path), [None] * lake_count)
+
+
+def _measure_worker_window(window, *options):
+    return _measure_window(_worker_datasets['dem'], _worker_datasets['labels'], window, *options)
+
+
+def pool_context():
+    
+    """
+    Returns the multiprocessing context of the worker process pools: spawn,
+    with the workers pointed at the bundled Python inside QGIS, whose
+    sys.executable is the QGIS binary rather than a Python interpreter.
+    """
+    # multiprocessing is only imported by the runs that use a pool
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        for candidate in (os.path.join(sys.exec_prefix, 'python.exe'),
+                          os.path.join(sys.exec_prefix, 'python3.exe'),
+                          os.path.join(sys.exec_prefix, 'bin', 'python3')):
+            if os.path.exists(candidate):
+                context.set_executable(candidate)
+                break
+    return context
+
+
+def measure_lakes(dem, labels, windows, ring_width=0, ring_side=RING_BOTH, from_ring=False, extremes=False, count_pixels=False,
+                  keep_values=False, workers=1, threads=0, feedback=None, resume=None, checkpoint=None):
+    
+    """
+    Walks the DEM and the label grid window by window and accumulates the
+    statistics of every lake, so only one window is held in memory at a time.
+    The values of a lake are taken from all of its pixels or, with
+    from_ring=True, from its boundary ring of ring_width pixels. Label windows
+    are read with a halo of ring_width pixels so the ring is the same as on
+    the whole grid. With count_pixels the lake pixels and the boundary ring
+    pixels are counted as well (ring_width 0 skips the boundary count). With
+    keep_values the measured values themselves are kept for the order
+    statistics of the ZonalAccumulator.
+
+    With a single worker, reading a window overlaps with the reductions of
+    the previous ones on threads threads (see stream_windows, 0 for
+    STREAM_THREADS, 1 for a plain loop). With workers > 1 the windows are
+    spread over a process pool. This needs
+    both the DEM and the label grid to be files on disk (not MEM datasets or
+    /vsimem/ files, which other processes cannot see). The
+    partial results are merged in window order, so the result is identical
+    whatever the number of workers or threads. Progress and cancellation go through the
+    optional QGIS feedback object.
+
+    A run can be checkpointed and resumed: checkpoint, when given, is called
+    as checkpoint(done, zonal, pixel_counts, boundary_pixel_counts) after
+    every window, and resume takes such a (done, zonal, pixel_counts,
+    boundary_pixel_counts) tuple to skip the first done windows.
+    Returns the ZonalAccumulator and the two count arrays, indexed by label.
+    """
+    options = (ring_width, ring_side, from_ring, extremes, count_pixels, keep_values)
+    if resume is None:
+        start = 0
+        zonal = ZonalAccumulator(labels.count, extremes, keep_values)
+        pixel_counts = numpy.zeros(labels.count + 1, dtype=numpy.int64)
+        boundary_pixel_counts = numpy.zeros(labels.count + 1, dtype=numpy.int64)
+    else:
+        (start, zonal, pixel_counts, boundary_pixel_counts) = resume
+    remaining = windows[start:]
+
+    def merge(partial, done):
+        zonal.merge(partial[0])
+        pixel_counts[:] += partial[1]
+        boundary_pixel_counts[:] += partial[2]
+        if checkpoint is not None:
+            checkpoint(done, zonal, pixel_counts, boundary_pixel_counts)
+        if feedback is not None:
+            feedback.setProgress(100.0 * done / len(windows))
+
+    def canceled():
+        return feedback is not None and feedback.isCanceled()
+
+    dem_path = dem.GetDescription()
+    labels_path = labels.dataset.GetDescription()
+    shared = all(path and not is_in_memory(path) for path in (dem_path, labels_path))
+    if workers <= 1 or len(remaining) <= 1 or not shared:
+        if threads == 1 or len(remaining) <= 1:
+            for done, window in enumerate(remaining, start=start + 1):
+                if canceled():
+                    break
+                merge(_measure_window(dem, labels, window, *options), done)
+        elif not canceled():
+            counter = itertools.count(start + 1)
+            stream_windows(remaining,
+                           lambda window: _read_window(dem, labels, window, *options),
+                           lambda window, data: _reduce_window(labels.count, data, *options),
+                           lambda window, partial: merge(partial, next(counter)),
+                           threads, canceled)
+        return zonal, pixel_counts, boundary_pixel_counts
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, len(remaining)), mp_context=pool_context(),
+                             initializer=_open_worker_datasets, initargs=(dem_path, labels_path, labels.count)) as pool:
+        futures = [pool.submit(_measure_worker_window, window, *options) for window in remaining]
+        for done, future in enumerate(futures, start=start + 1):
+            if canceled():
+                for pending in futures:
+                    pending.cancel()
+                break
+            merge(future.result(), done)
+
+    return zonal, pixel_counts, boundary_pixel_counts
+
+
+def _read_epoch_window(dems, labels, window, ring_width, ring_side, from_ring, extremes, keep_values):
+    # the window of every epoch and the label window, read once for all of
+    # them, with a halo for the boundary ring
+    grown, crop = expand_window(dems[0], window, ring_width if ring_width > 0 and from_ring else 0)
+    bands = [dem.GetRasterBand(1) for dem in dems]
+    return [band.ReadAsArray(*window) for band in bands], labels.read(*grown), crop, [band.GetNoDataValue() for band in bands]
+
+
+def _reduce_epoch_window(lake_count, data, ring_width, ring_side, from_ring, extremes, keep_values):
+    (stack, label_grid, crop, nodatas) = data
+    if ring_width > 0 and from_ring:
+        label_grid = boundary_ring(label_grid, ring_width, ring_side)
+    label_grid = label_grid[crop]
+
+    # lake label of epoch e is counted under e * (lake_count + 1) + label, so
+    # one bincount reduces every lake of every epoch
+    values = numpy.stack([epoch_values.astype(numpy.float64) for epoch_values in stack])
+    stacked_labels = numpy.zeros(values.shape, dtype=numpy.int64)
+    for epoch, (epoch_values, nodata) in enumerate(zip(values, nodatas)):
+        valid = valid_pixels(epoch_values, label_grid, nodata)
+        stacked_labels[epoch][valid] = label_grid[valid] + epoch * (lake_count + 1)
+    zonal = ZonalAccumulator(len(stack) * (lake_count + 1) - 1, extremes, keep_values)
+    zonal.add(values, stacked_labels)
+    return zonal
+
+
+def measure_epochs(dems, labels, windows, ring_width=0, ring_side=RING_BOTH, from_ring=False, extremes=False, keep_values=False,
+                   threads=0, feedback=None):
+    
+    """
+    Measures the lakes of several DEMs on the grid of the label grid (the
+    epochs or bands of a DEM stack) in one sweep, like measure_lakes: every
+    label window is read, and its boundary ring computed, once for all the
+    epochs, and all lakes of all epochs are reduced together over the stack
+    of epoch windows. Returns one ZonalAccumulator per DEM.
+    """
+    options = (ring_width, ring_side, from_ring, extremes, keep_values)
+    zonal = ZonalAccumulator(len(dems) * (labels.count + 1) - 1, extremes, keep_values)
+    done = itertools.count(1)
+
+    def merge(partial):
+        zonal.merge(partial)
+        if feedback is not None:
+            feedback.setProgress(100.0 * next(done) / len(windows))
+
+    if feedback is None or not feedback.isCanceled():
+        stream_windows(windows,
+                       lambda window: _read_epoch_window(dems, labels, window, *options),
+                       lambda window, data: _reduce_epoch_window(labels.count, data, *options),
+                       lambda window, partial: merge(partial),
+                       threads, None if feedback is None else feedback.isCanceled)
+    return zonal.unstack(len(dems))
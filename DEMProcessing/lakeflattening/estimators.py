@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Elevation estimators: the part of the lake flattening that differs between
+the algorithms. An estimator tells the engine which pixels of every lake to
+measure and turns the measured statistics into the elevation of each lake.
+"""
+
+
+import numpy
+
+from .labels import RING_BOTH, RING_INNER
+
+ELEVATION_STATISTICS = ('MEAN', 'MEDIAN', 'PERCENTILE', 'TRIMMED_MEAN', 'MODE')
+
+
+class ElevationEstimator:
+
+    """
+    Base class of the elevation estimators. measures is False for estimators
+    that do not look at the DEM at all.
+    """
+
+    measures = True
+
+    def measure_options(self, count_pixels=False):
+        
+        """
+        Returns the ring_width, ring_side and from_ring arguments of
+        measure_lakes (and keep_values, for the estimators that need the
+        values themselves). With count_pixels the ring is also the one whose
+        pixels are counted for the lake statistics.
+        """
+        return {'ring_width': 0, 'ring_side': RING_BOTH, 'from_ring': False}
+
+    def signature(self):
+        
+        """
+        Returns the parameters of the estimator, for the run manifest.
+        """
+        return [type(self).__name__]
+
+    def elevations(self, lake_count, zonal=None):
+        
+        """
+        Returns the elevation of every lake, indexed by label (index 0 is the
+        background and NaN), from the ZonalAccumulator filled by
+        measure_lakes. Lakes left at NaN keep their DEM values.
+        """
+        raise NotImplementedError
+
+
+class FixedElevation(ElevationEstimator):
+
+    """
+    Sets every lake to one given elevation, without measuring the DEM.
+    """
+
+    measures = False
+
+    def __init__(self, elevation):
+        self.elevation = float(elevation)
+
+    def signature(self):
+        return [type(self).__name__, self.elevation]
+
+    def elevations(self, lake_count, zonal=None):
+        elevations = numpy.full(lake_count + 1, self.elevation)
+        elevations[0] = numpy.nan
+        return elevations
+
+
+class InteriorMean(ElevationEstimator):
+
+    """
+    Sets every lake to the mean elevation of all of its pixels. The pixels
+    counted as its boundary in the lake statistics are its inner shoreline.
+    """
+
+    def measure_options(self, count_pixels=False):
+        return {'ring_width': 1 if count_pixels else 0, 'ring_side': RING_INNER, 'from_ring': False}
+
+    def elevations(self, lake_count, zonal=None):
+        return zonal.means()
+
+
+class BoundaryMean(ElevationEstimator):
+
+    """
+    Sets every lake to the mean elevation of a ring of width pixels along its
+    shoreline, inside the lake, outside of it or on both sides.
+    """
+
+    def __init__(self, width=1, side=RING_BOTH):
+        self.width = int(width)
+        self.side = side
+
+    def measure_options(self, count_pixels=False):
+        return {'ring_width': self.width, 'ring_side': self.side, 'from_ring': True}
+
+    def signature(self):
+        return [type(self).__name__, self.width, self.side]
+
+    def elevations(self, lake_count, zonal=None):
+        return zonal.means()
+
+
+class PixelStatistic(ElevationEstimator):
+
+    """
+    Base class of the estimators that set every lake to an order statistic
+    of its pixels, all of them (width 0) or a ring of width pixels along its
+    shoreline on side, like BoundaryMean. Order statistics are robust to the
+    bridges, dams and spikes that pull a mean. They are computed for all
+    lakes at once from one sort of the measured values (see
+    ZonalAccumulator), so they cost about the same as a mean.
+    """
+
+    def __init__(self, width=0, side=RING_BOTH):
+        self.width = int(width)
+        self.side = side
+
+    def measure_options(self, count_pixels=False):
+        if self.width:
+            return {'ring_width': self.width, 'ring_side': self.side, 'from_ring': True, 'keep_values': True}
+        return {'ring_width': 1 if count_pixels else 0, 'ring_side': RING_INNER, 'from_ring': False, 'keep_values': True}
+
+    def parameters(self):
+        return []
+
+    def signature(self):
+        return [type(self).__name__] + self.parameters() + [self.width, self.side]
+
+    def elevations(self, lake_count, zonal=None):
+        return self.statistic(zonal)
+
+    def statistic(self, zonal):
+        raise NotImplementedError
+
+
+class MedianElevation(PixelStatistic):
+
+    """
+    Sets every lake to the median elevation of its pixels.
+    """
+
+    def statistic(self, zonal):
+        return zonal.medians()
+
+
+class PercentileElevation(PixelStatistic):
+
+    """
+    Sets every lake to the percent percentile (0 to 100) of the elevations of
+    its pixels, e.g. a low percentile of the shoreline for the water level.
+    """
+
+    def __init__(self, percent, width=0, side=RING_BOTH):
+        PixelStatistic.__init__(self, width, side)
+        self.percent = float(percent)
+        if not 0.0 <= self.percent <= 100.0:
+            raise ValueError('The percentile must be between 0 and 100, not {}'.format(percent))
+
+    def parameters(self):
+        return [self.percent]
+
+    def statistic(self, zonal):
+        return zonal.percentiles(self.percent)
+
+
+class TrimmedMeanElevation(PixelStatistic):
+
+    """
+    Sets every lake to the mean elevation of its pixels once the lowest and
+    the highest proportion of them are left out.
+    """
+
+    def __init__(self, proportion, width=0, side=RING_BOTH):
+        PixelStatistic.__init__(self, width, side)
+        self.proportion = float(proportion)
+        if not 0.0 <= self.proportion < 0.5:
+            raise ValueError('The trimmed proportion must be at least 0 and below 0.5, not {}'.format(proportion))
+
+    def parameters(self):
+        return [self.proportion]
+
+    def statistic(self, zonal):
+        return zonal.trimmed_means(self.proportion)
+
+
+class ModeElevation(PixelStatistic):
+
+    """
+    Sets every lake to the most frequent elevation of its pixels: the centre
+    of the most populated bin of a histogram with bins bin_width wide.
+    """
+
+    def __init__(self, bin_width, width=0, side=RING_BOTH):
+        PixelStatistic.__init__(self, width, side)
+        self.bin_width = float(bin_width)
+        if self.bin_width <= 0.0:
+            raise ValueError('The histogram bin width must be positive, not {}'.format(bin_width))
+
+    def parameters(self):
+        return [self.bin_width]
+
+    def statistic(self, zonal):
+        return zonal.modes(self.bin_width)
+
+
+def statistic_estimator(statistic='MEAN', width=0, side=RING_BOTH, percent=50.0, proportion=0.1, bin_width=0.1):
+    
+    """
+    Returns the estimator of one of the ELEVATION_STATISTICS over all the
+    pixels of every lake (width 0) or over a ring of width pixels on side of
+    its shoreline. percent, proportion and bin_width are the parameters of
+    the percentile, the trimmed mean and the mode.
+    """
+    if statistic == 'MEDIAN':
+        return MedianElevation(width, side)
+    if statistic == 'PERCENTILE':
+        return PercentileElevation(percent, width, side)
+    if statistic == 'TRIMMED_MEAN':
+        return TrimmedMeanElevation(proportion, width, side)
+    if statistic == 'MODE':
+        return ModeElevation(bin_width, width, side)
+    if statistic != 'MEAN':
+        raise ValueError('Unknown lake elevation statistic ' + str(statistic))
+    return BoundaryMean(width, side) if width else InteriorMean()
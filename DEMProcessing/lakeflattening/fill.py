@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import math
+
+import numpy
+from osgeo import gdal
+
+from .raster import DEFAULT_NODATA
+from .tiling import block_windows, expand_window, fits_in_memory
+
+# the flood keeps the elevations, the fill and the seeds as doubles, a
+# transposed copy of the fill and the elevations for the column sweeps and
+# a few masks, which is what bounds the size of a fill window
+FILL_BYTES_PER_PIXEL = 80
+
+
+def min_slope_epsilons(min_slope_degrees, cell_size):
+    
+    """
+    Returns the elevation increments for an orthogonal and a diagonal step that
+    give the minimum slope, the same way SAGA derives them for Planchon/Darboux.
+    """
+    epsilon = math.tan(math.radians(min_slope_degrees)) * cell_size
+    return epsilon, epsilon * math.sqrt(2.0)
+
+
+def _sweep(filled, elevations, is_open, epsilon_orthogonal, epsilon_diagonal, rows, versions, seen, crossing):
+    
+    """
+    Lowers the open cells of a padded grid row by row in the order of rows,
+    every row at once from the three neighbours of the row before it. A row
+    is skipped while that row has not changed (versions) since it was last
+    looked at (seen); the rows that change and the columns they change in
+    (crossing) get a new version.
+    """
+    width = filled.shape[1] - 2
+    candidate = numpy.empty(width)
+    diagonal = numpy.empty(width)
+    step = 1 if rows.start < rows.stop else -1
+    for y in rows:
+        if versions[y - step] == seen[y]:
+            continue
+        seen[y] = versions[y - step]
+        previous = filled[y - step]
+        numpy.minimum(previous[:-2], previous[2:], out=diagonal)
+        diagonal += epsilon_diagonal
+        numpy.add(previous[1:-1], epsilon_orthogonal, out=candidate)
+        numpy.minimum(candidate, diagonal, out=candidate)
+        numpy.maximum(candidate, elevations[y - 1], out=candidate)
+        row = filled[y, 1:-1]
+        lowered = is_open[y - 1] & (candidate < row)
+        if lowered.any():
+            row[lowered] = candidate[lowered]
+            versions[y] += 1
+            crossing[1:-1] += lowered
+
+
+def _flood(elevations, is_open, seed_levels, epsilon_orthogonal=0.0, epsilon_diagonal=0.0):
+    
+    """
+    Planchon/Darboux (2001) fill of a grid, the method of SAGA's Fill Sinks.
+    Cells with a finite seed level are outlets at that level, open cells are
+    raised to the lowest level from which they still drain to an outlet
+    (plus the epsilon of every step), every other cell is a wall. Open cells
+    that cannot reach any outlet come back as +inf.
+
+    The fill starts at +inf and is lowered by sweeps down, up, right and left
+    over the grid until nothing changes. A sweep runs over one row (or one
+    column, on a transposed copy) at a time with numpy, so the Python loop is
+    over rows and not over cells, and rows whose neighbours did not change
+    are skipped.
+    """
+    height, width = elevations.shape
+    filled = numpy.full((height + 2, width + 2), numpy.inf)
+    seeds = numpy.isfinite(seed_levels)
+    filled[1:-1, 1:-1][seeds] = seed_levels[seeds]
+    transposed = numpy.empty((width + 2, height + 2))
+    transposed_elevations = numpy.ascontiguousarray(elevations.T)
+    transposed_open = numpy.ascontiguousarray(is_open.T)
+    epsilons = (epsilon_orthogonal, epsilon_diagonal)
+
+    row_versions = numpy.ones(height + 2, dtype=numpy.int64)
+    column_versions = numpy.ones(width + 2, dtype=numpy.int64)
+    (seen_down, seen_up) = (numpy.zeros(height + 2, dtype=numpy.int64), numpy.zeros(height + 2, dtype=numpy.int64))
+    (seen_right, seen_left) = (numpy.zeros(width + 2, dtype=numpy.int64), numpy.zeros(width + 2, dtype=numpy.int64))
+    changes = None
+    while changes != row_versions.sum():
+        changes = row_versions.sum()
+        _sweep(filled, elevations, is_open, *epsilons, range(1, height + 1), row_versions, seen_down, column_versions)
+        _sweep(filled, elevations, is_open, *epsilons, range(height, 0, -1), row_versions, seen_up, column_versions)
+        transposed[...] = filled.T
+        _sweep(transposed, transposed_elevations, transposed_open, *epsilons, range(1, width + 1), column_versions, seen_right, row_versions)
+        _sweep(transposed, transposed_elevations, transposed_open, *epsilons, range(width, 0, -1), column_versions, seen_left, row_versions)
+        filled[...] = transposed.T
+    return filled[1:-1, 1:-1].copy()
+
+
+def _touches(mask):
+    # cells with at least one of their 8 neighbours in mask, outside the grid counts as in mask
+    height, width = mask.shape
+    padded = numpy.pad(mask, 1, mode='constant', constant_values=True)
+    touching = numpy.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            if dy != 1 or dx != 1:
+                touching |= padded[dy:dy + height, dx:dx + width]
+    return touching
+
+
+def _fill_window(source_band, output_band, dataset, window, nodata, output_nodata, output_dtype, epsilons):
+    
+    """
+    Fills one window of the DEM, using the current values of the one pixel
+    wide halo around it in output_band as outlets (+inf there means not known
+    yet). Returns True when the window changed.
+    """
+    grown, crop = expand_window(dataset, window, 1)
+    elevations = source_band.ReadAsArray(*grown).astype(numpy.float64)
+    valid = numpy.isfinite(elevations)
+    if nodata is not None:
+        valid &= elevations != nodata
+
+    core = numpy.zeros(valid.shape, dtype=bool)
+    core[crop] = True
+    # the halo exists only where the window is not on the edge of the DEM, so
+    # treating everything outside the grown window as a wall makes the cells on
+    # the DEM edge outlets without touching cells next to the halo
+    edge = _touches(~valid) & valid
+
+    current = output_band.ReadAsArray(*grown).astype(numpy.float64)
+    seed_levels = numpy.full(valid.shape, numpy.nan)
+    outlets = core & edge
+    seed_levels[outlets] = elevations[outlets]
+    halo = ~core & valid & numpy.isfinite(current) & (current != output_nodata)
+    seed_levels[halo] = current[halo]
+
+    filled = _flood(elevations, core & valid & ~edge, seed_levels, *epsilons)
+    filled[outlets] = elevations[outlets]
+    filled[~valid] = output_nodata
+    filled = filled[crop].astype(output_dtype)
+
+    if numpy.array_equal(filled, current[crop]):
+        return False
+    output_band.WriteArray(filled, window[0], window[1])
+    return True
+
+
+def fill_sinks(dem_path, output_path, min_slope_degrees=0.0, max_pixels=None, feedback=None):
+    
+    """
+    Fills all sinks of a DEM like SAGA's Planchon/Darboux (2001) fill (see
+    _flood), optionally with a minimum slope (in degrees) between
+    neighbouring cells. Cells on the edge of the DEM or next to nodata are
+    the outlets.
+
+    A DEM with more than max_pixels pixels is filled in windows. Every window
+    is flooded with the current values around it as outlets, and windows are
+    flooded again while a neighbour keeps changing. The values only ever go
+    down, so the sweeps end at the same result as a fill of the whole grid.
+    """
+    source = gdal.Open(dem_path)
+    source_band = source.GetRasterBand(1)
+    nodata = source_band.GetNoDataValue()
+    output_nodata = DEFAULT_NODATA if nodata is None else nodata
+    data_type = gdal.GDT_Float64 if source_band.DataType == gdal.GDT_Float64 else gdal.GDT_Float32
+    output_dtype = numpy.float64 if data_type == gdal.GDT_Float64 else numpy.float32
+    cell_size = abs(source.GetGeoTransform()[1])
+    epsilons = min_slope_epsilons(min_slope_degrees, cell_size) if min_slope_degrees else (0.0, 0.0)
+
+    output = gdal.GetDriverByName('GTiff').Create(output_path, source.RasterXSize, source.RasterYSize, 1, data_type,
+                                                  options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    output.SetGeoTransform(source.GetGeoTransform())
+    output.SetProjection(source.GetProjection())
+    output_band = output.GetRasterBand(1)
+    output_band.SetNoDataValue(output_nodata)
+
+    if fits_in_memory(source, max_pixels):
+        output_band.Fill(numpy.inf)
+        _fill_window(source_band, output_band, source, (0, 0, source.RasterXSize, source.RasterYSize), nodata, output_nodata, output_dtype, epsilons)
+        output_band.FlushCache()
+        return output_path
+
+    windows = list(block_windows(source, max_pixels))
+    output_band.Fill(numpy.inf)
+    step_x, step_y = windows[0][2], windows[0][3]
+    index = {(window[0], window[1]): position for position, window in enumerate(windows)}
+
+    def neighbours(window):
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                position = index.get((window[0] + dx * step_x, window[1] + dy * step_y))
+                if position is not None and (dx or dy):
+                    yield position
+
+    dirty = set(range(len(windows)))
+    sweep = 0
+    while dirty:
+        # alternate the sweep direction so drainage crosses windows both ways
+        order = range(len(windows)) if sweep % 2 == 0 else range(len(windows) - 1, -1, -1)
+        for done, position in enumerate(order, start=1):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    return output_path
+                if sweep == 0:
+                    feedback.setProgress(100.0 * done / len(windows))
+            if position not in dirty:
+                continue
+            dirty.discard(position)
+            if _fill_window(source_band, output_band, source, windows[position], nodata, output_nodata, output_dtype, epsilons):
+                dirty.update(neighbours(windows[position]))
+        sweep += 1
+
+    output_band.FlushCache()
+    return output_path
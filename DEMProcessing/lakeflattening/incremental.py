@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Incremental re-flattening: when only a few lakes of a finished run were
+added, edited or removed, only the pixels around those lakes are recomputed
+and rewritten in the previous output.
+"""
+
+
+import os
+import uuid
+
+import numpy
+from osgeo import gdal
+
+from .checkpoint import lake_geometry_hashes, lake_key, lake_record
+from .engine import measure_lakes
+from .labels import rasterize_lakes
+from .raster import burn_lookup, finish_burned_output, output_format, pass_through_copy, plain_geotiff
+from .spatialindex import lake_windows
+
+
+def changed_lakes(previous_lakes, geometry_hashes):
+    
+    """
+    Compares the lake records of a previous run (RunManifest.lakes()) with
+    the geometry hashes of the current lakes and returns the sets of the
+    added, removed and modified lake ids, as stored in the manifest.
+    """
+    previous = {record['id']: record['hash'] for record in previous_lakes}
+    current = {lake_key(lake_id): geometry_hash for lake_id, geometry_hash in geometry_hashes.items()}
+    added = set(current) - set(previous)
+    removed = set(previous) - set(current)
+    modified = {lake_id for lake_id in set(current) & set(previous) if current[lake_id] != previous[lake_id]}
+    return added, removed, modified
+
+
+def lakes_outside(lakes, dataset, window, buffer_pixels=0):
+    
+    """
+    Returns the ids of the lakes whose window on the dataset (the whole DEM),
+    grown by buffer_pixels, is not inside window: the lakes the DEM window of
+    a previous run does not hold, which an incremental update cannot flatten
+    like a full run would.
+    """
+    return [lake_id for lake_id, lake_window in lake_windows(lakes, dataset, buffer_pixels).items()
+            if lake_window is not None and not (window[0] <= lake_window[0] and window[1] <= lake_window[1] and
+                                                lake_window[0] + lake_window[2] <= window[0] + window[2] and
+                                                lake_window[1] + lake_window[3] <= window[1] + window[3])]
+
+
+def _grow(window, halo, dem):
+    (xoff, yoff, xsize, ysize) = window
+    left, top = max(0, xoff - halo), max(0, yoff - halo)
+    return (left, top, min(dem.RasterXSize, xoff + xsize + halo) - left, min(dem.RasterYSize, yoff + ysize + halo) - top)
+
+
+def _intersects(window, other):
+    return (window[0] < other[0] + other[2] and other[0] < window[0] + window[2] and
+            window[1] < other[1] + other[3] and other[1] < window[1] + window[3])
+
+
+def _union(window, other):
+    left, top = min(window[0], other[0]), min(window[1], other[1])
+    return (left, top, max(window[0] + window[2], other[0] + other[2]) - left, max(window[1] + window[3], other[1] + other[3]) - top)
+
+
+def _merge_windows(windows):
+    # bounding boxes of the groups of overlapping windows
+    clusters = []
+    for window in windows:
+        while True:
+            overlapping = [cluster for cluster in clusters if _intersects(cluster, window)]
+            if not overlapping:
+                break
+            for cluster in overlapping:
+                clusters.remove(cluster)
+                window = _union(window, cluster)
+        clusters.append(window)
+    return clusters
+
+
+def reflatten_lakes(dem, lakes, previous_lakes, previous_output, output_path, estimator, offset=(0, 0), feedback=None,
+                    base_path=None, layout='STRIPED', compression='NONE', threads=0):
+    
+    """
+    Updates the output of a previous run for the current lakes, rewriting
+    only the windows around the lakes that were added, edited or removed.
+
+    dem is the sink filled DEM of the previous run (at offset in the output),
+    lakes the current (lake_id, wkb) pairs and previous_lakes the lake
+    records of the previous run, with their windows. The previous output is
+    copied to output_path (or updated in place when it is the same file).
+    Around every changed lake the filled DEM is restored and the lakes are
+    burned again: the changed lakes and their neighbours (the lakes whose
+    window meets a changed window, whose boundary ring may have changed) get
+    a new elevation from the estimator, the other lakes keep their recorded
+    elevation.
+
+    Returns the lake records of the updated output and the number of changed
+    lakes. When dem is a window of the DEM at base_path, lakes outside it
+    (see lakes_outside) raise a ValueError.
+
+    layout, compression and threads select the output format (see
+    output_format). Only a striped, uncompressed GeoTIFF is updated in
+    place or copied and updated; in any other format (and from a previous
+    output that is not a plain GeoTIFF) the previous window goes to a
+    scratch GeoTIFF and the output is written again like
+    burn_lake_elevations does, over base_path.
+    """
+    if any('window' not in record for record in previous_lakes):
+        raise ValueError('The previous run did not record the lake windows, it cannot be updated incrementally')
+    if not os.path.exists(previous_output):
+        raise ValueError('The output of the previous run {} is gone'.format(previous_output))
+    if base_path is not None:
+        outside = lakes_outside(lakes, gdal.Open(base_path), tuple(offset) + (dem.RasterXSize, dem.RasterYSize))
+        if outside:
+            raise ValueError('The lakes {} are outside the DEM window of the previous run'.format(', '.join(str(lake_id) for lake_id in outside)))
+
+    geometry_hashes = lake_geometry_hashes(lakes)
+    windows = lake_windows(lakes, dem)
+    (added, removed, modified) = changed_lakes(previous_lakes, geometry_hashes)
+    previous = {record['id']: record for record in previous_lakes}
+    lake_ids = list(geometry_hashes)
+    keys = {lake_id: lake_key(lake_id) for lake_id in lake_ids}
+
+    # the changed windows, before and after the edit, grown so that they
+    # hold the boundary rings of the lakes in them
+    options = estimator.measure_options()
+    halo = options['ring_width'] + 1
+    changed = [tuple(previous[key]['window']) for key in removed | modified if previous[key]['window'] is not None]
+    changed += [windows[lake_id] for lake_id in lake_ids if keys[lake_id] in added | modified and windows.get(lake_id) is not None]
+    changed = [_grow(window, halo, dem) for window in changed]
+
+    remeasured = {lake_id for lake_id in lake_ids if windows.get(lake_id) is not None and
+                  any(_intersects(windows[lake_id], window) for window in changed)}
+    clusters = _merge_windows(changed + [_grow(windows[lake_id], halo, dem) for lake_id in remeasured])
+
+    in_place = os.path.abspath(previous_output) == os.path.abspath(output_path)
+    overlay = base_path is not None and os.path.splitext(output_path)[1].lower() == '.vrt'
+    scratch_path = None
+    if layout == 'STRIPED' and compression == 'NONE' and not overlay and not (in_place and not plain_geotiff(gdal.Open(previous_output))):
+        output = gdal.Open(output_path, gdal.GA_Update) if in_place else pass_through_copy(previous_output, output_path, dem.GetRasterBand(1).DataType)
+    else:
+        # the window of the previous output is read before the output is
+        # written again, which may replace the previous output
+        scratch_path = '/vsimem/reflattened-{}.tif'.format(uuid.uuid4().hex)
+        gdal.Translate(scratch_path, previous_output, format='GTiff', outputType=dem.GetRasterBand(1).DataType,
+                       srcWin=list(offset) + [dem.RasterXSize, dem.RasterYSize], creationOptions=['BIGTIFF=IF_SAFER'])
+        output = gdal.Open(scratch_path, gdal.GA_Update)
+        offset = (0, 0)
+    output_band = output.GetRasterBand(1)
+
+    elevations = {lake_id: previous[keys[lake_id]]['elevation'] if keys[lake_id] in previous else None for lake_id in lake_ids}
+    for done, cluster in enumerate(clusters, start=1):
+        if feedback is not None and feedback.isCanceled():
+            break
+        # the lakes of the cluster are burned in their original order, so
+        # overlaps and shared boundary pixels resolve as in a full run
+        cluster_dem = gdal.Translate('', dem, format='MEM', srcWin=list(cluster))
+        cluster_lakes = [(lake_id, wkb) for lake_id, wkb in lakes if windows.get(lake_id) is not None and _intersects(windows[lake_id], cluster)]
+        labels = rasterize_lakes(cluster_dem, cluster_lakes)
+        zonal = measure_lakes(cluster_dem, labels, [(0, 0, cluster[2], cluster[3])], **options)[0] if estimator.measures else None
+        estimates = estimator.elevations(labels.count, zonal)
+
+        cluster_elevations = numpy.full(labels.count + 1, numpy.nan)
+        for label, lake_id in enumerate(labels.lake_ids, start=1):
+            if lake_id in remeasured:
+                elevations[lake_id] = None if numpy.isnan(estimates[label]) else float(estimates[label])
+            if elevations[lake_id] is not None:
+                cluster_elevations[label] = elevations[lake_id]
+        (lookup, burn) = burn_lookup(cluster_elevations, output_band.DataType)
+
+        data = cluster_dem.GetRasterBand(1).ReadAsArray()
+        label_grid = labels.read()
+        lake_pixels = burn[label_grid]
+        data[lake_pixels] = lookup[label_grid[lake_pixels]]
+        output_band.WriteArray(data, cluster[0] + offset[0], cluster[1] + offset[1])
+        if feedback is not None:
+            feedback.setProgress(100.0 * done / len(clusters))
+
+    output_band.FlushCache()
+    output_band = output = None
+    if scratch_path is not None:
+        canceled = feedback is not None and feedback.isCanceled()
+        if overlay:
+            # the burned window of a .vrt output is kept next to it
+            lakes_path = os.path.splitext(output_path)[0] + '-lakes.tif'
+            if not canceled:
+                gdal.Translate(lakes_path, scratch_path, format='GTiff',
+                               creationOptions=output_format(gdal.Open(scratch_path).GetRasterBand(1).DataType, 'TILED', compression, threads)[1])
+            gdal.Unlink(scratch_path)
+            scratch_path = lakes_path
+        finish_burned_output(output_path, base_path, scratch_path, overlay, canceled, layout, compression, threads)
+
+    records = [lake_record(lake_id, numpy.nan if elevations[lake_id] is None else elevations[lake_id], geometry_hashes[lake_id], windows.get(lake_id))
+               for lake_id in lake_ids]
+    return records, len(added | removed | modified)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import os
+import shutil
+import tempfile
+import uuid
+
+from osgeo import gdal
+
+
+class Intermediates:
+
+    """
+    Hands out the paths of the intermediate files of a run. With a working
+    folder (debug output) every file is written there and kept. Without one,
+    files live in GDAL's in-memory file system (/vsimem) as long as their
+    estimated sizes add up to no more than max_bytes, and spill to a temporary
+    folder under spill_folder above that. Files that other programs or worker
+    processes have to read always go to disk. cleanup() removes everything
+    that is not kept.
+    """
+
+    def __init__(self, folder=None, max_bytes=0, spill_folder=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.spill_folder = spill_folder
+        self.in_memory_bytes = 0
+        self._memory_folder = '/vsimem/lakeflattening-' + uuid.uuid4().hex
+        self._memory_paths = []
+        self._disk_folder = folder
+
+    def path(self, name, size_bytes=0, on_disk=False):
+        
+        """
+        Returns the path for an intermediate file called name, whose size is
+        estimated at size_bytes.
+        """
+        if self.folder is None and not on_disk and self.in_memory_bytes + size_bytes <= self.max_bytes:
+            self.in_memory_bytes += size_bytes
+            path = self._memory_folder + '/' + name
+            self._memory_paths.append(path)
+            return path
+        return os.path.join(self.disk_folder(), name)
+
+    def disk_folder(self):
+        
+        """
+        Returns the folder for intermediate files that have to be on disk: the
+        working folder, or a temporary folder created on first use.
+        """
+        if self._disk_folder is None:
+            self._disk_folder = tempfile.mkdtemp(prefix='lakeflattening-', dir=self.spill_folder)
+        return self._disk_folder
+
+    def cleanup(self):
+        
+        """
+        Frees the in-memory files and removes the temporary folder. Nothing is
+        removed from a working folder.
+        """
+        for path in self._memory_paths:
+            for sidecar in (path, path + '.aux.xml', os.path.splitext(path)[0] + '.tfw'):
+                if gdal.VSIStatL(sidecar) is not None:
+                    gdal.Unlink(sidecar)
+        self._memory_paths = []
+        self.in_memory_bytes = 0
+        if self.folder is None and self._disk_folder is not None:
+            shutil.rmtree(self._disk_folder, ignore_errors=True)
+            self._disk_folder = None
+
+
+def is_in_memory(path):
+    
+    """
+    Returns whether path is a file in GDAL's in-memory file system.
+    """
+    return path.startswith('/vsimem/')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+import numpy
+from osgeo import gdal, ogr, osr
+
+LABEL_FIELD = 'LAKE_LABEL'
+
+# lakes burned at a time: only one batch of geometries is copied into OGR
+LAKE_BATCH_SIZE = 10000
+
+# sides of the shoreline that make up the boundary ring of a lake, in the
+# order they are offered by the boundary pixels algorithm
+RING_INNER = 0
+RING_OUTER = 1
+RING_BOTH = 2
+
+
+class LakeLabels:
+
+    """
+    Integer label grid aligned with a DEM. Pixel value 0 means "no lake",
+    pixel value i (1 <= i <= count) belongs to the lake lake_ids[i - 1].
+    """
+
+    def __init__(self, dataset, lake_ids):
+        self.dataset = dataset
+        self.lake_ids = lake_ids
+
+    @property
+    def count(self):
+        return len(self.lake_ids)
+
+    def read(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        
+        """
+        Reads the labels of a window of the grid (the whole grid by default).
+        """
+        band = self.dataset.GetRasterBand(1)
+        if xsize is None:
+            xsize = self.dataset.RasterXSize - xoff
+        if ysize is None:
+            ysize = self.dataset.RasterYSize - yoff
+        return band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+
+def _memory_vector_driver():
+    # GDAL 3.11 renamed the OGR "Memory" driver to "MEM".
+    driver = ogr.GetDriverByName('Memory')
+    if driver is None:
+        driver = ogr.GetDriverByName('MEM')
+    return driver
+
+
+def _burn_batch(label_dataset, spatial_reference, batch):
+    # batch is a list of (label, geometry) pairs, burned in order so that a
+    # later lake wins where lakes overlap, as in a single pass
+    vector = _memory_vector_driver().CreateDataSource('lakes')
+    layer = vector.CreateLayer('lakes', srs=spatial_reference, geom_type=ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn(LABEL_FIELD, ogr.OFTInteger))
+    for label, geometry in batch:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField(LABEL_FIELD, label)
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    gdal.RasterizeLayer(label_dataset, [1], layer, options=['ATTRIBUTE=' + LABEL_FIELD])
+
+
+def rasterize_lakes(dem, lakes, path=None, batch_size=LAKE_BATCH_SIZE):
+    
+    """
+    Burns all lakes into a label grid matching the grid of the dem dataset.
+    lakes is an iterable of (lake_id, wkb) pairs, with the geometries in the
+    coordinate system of the DEM. Features sharing a lake id are treated as
+    one lake, the same way splitting the lakes layer by the unique field does.
+    The grid is kept in memory, or written to a tiled and compressed GeoTIFF
+    at path when one is given (for DEMs larger than the memory budget).
+
+    The lakes are burned batch_size at a time, so that besides the lakes
+    themselves only one batch of OGR geometries is held in memory; lakes can
+    be a generator reading a lakes layer.
+    """
+    spatial_reference = osr.SpatialReference()
+    if dem.GetProjection():
+        spatial_reference.ImportFromWkt(dem.GetProjection())
+
+    if path is None:
+        label_dataset = gdal.GetDriverByName('MEM').Create('', dem.RasterXSize, dem.RasterYSize, 1, gdal.GDT_Int32)
+    else:
+        label_dataset = gdal.GetDriverByName('GTiff').Create(path, dem.RasterXSize, dem.RasterYSize, 1, gdal.GDT_Int32,
+                                                             options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    label_dataset.SetGeoTransform(dem.GetGeoTransform())
+    label_dataset.SetProjection(dem.GetProjection())
+    label_dataset.GetRasterBand(1).Fill(0)
+
+    labels_by_id = {}
+    batch = []
+    for lake_id, wkb in lakes:
+        geometry = ogr.CreateGeometryFromWkb(bytes(wkb))
+        if geometry is None or geometry.IsEmpty():
+            continue
+        batch.append((labels_by_id.setdefault(lake_id, len(labels_by_id) + 1), geometry))
+        if len(batch) >= batch_size:
+            _burn_batch(label_dataset, spatial_reference, batch)
+            batch = []
+    if batch:
+        _burn_batch(label_dataset, spatial_reference, batch)
+    # worker processes and the run manifest read the file, not this dataset
+    label_dataset.FlushCache()
+
+    return LakeLabels(label_dataset, list(labels_by_id))
+
+
+def _interior(labels):
+    # lake pixels whose 8 neighbours within the grid all hold their label:
+    # the row neighbours are compared first and the rows above and below
+    # then only have to match as a whole
+    across = labels[:, 1:] == labels[:, :-1]
+    row_same = numpy.ones(labels.shape, dtype=bool)
+    row_same[:, 1:] &= across
+    row_same[:, :-1] &= across
+    interior = row_same & (labels > 0)
+    down = labels[1:] == labels[:-1]
+    interior[1:] &= down & row_same[:-1]
+    interior[:-1] &= down & row_same[1:]
+    return interior
+
+
+def _neighbour_maximum(labels):
+    # the highest label among the 8 neighbours within the grid and the pixel
+    # itself, one row pass and one column pass
+    rows = labels.copy()
+    numpy.maximum(rows[:, 1:], labels[:, :-1], out=rows[:, 1:])
+    numpy.maximum(rows[:, :-1], labels[:, 1:], out=rows[:, :-1])
+    reached = rows.copy()
+    numpy.maximum(reached[1:], rows[:-1], out=reached[1:])
+    numpy.maximum(reached[:-1], rows[1:], out=reached[:-1])
+    return reached
+
+
+def boundary_ring(labels, width=1, side=RING_BOTH):
+    
+    """
+    Returns a label grid holding only the boundary ring of every lake: lake
+    pixels within width pixels of the shoreline (RING_INNER), non-lake pixels
+    within width pixels of a lake (RING_OUTER), or both. Distances are counted
+    over the 8 neighbours of a pixel. A non-lake pixel reached by several lakes
+    at the same distance goes to the one with the highest label. The edge of
+    the grid is not treated as a shoreline.
+    """
+    # the eroded lakes keep their labels or drop to 0 and the grown ones
+    # only add labels, so the ring is the difference of the two
+    core = grown = labels
+    if side in (RING_INNER, RING_BOTH):
+        for _ in range(width):
+            core = numpy.where(_interior(core), core, 0)
+    if side in (RING_OUTER, RING_BOTH):
+        for _ in range(width):
+            grown = numpy.where(grown == 0, _neighbour_maximum(grown), grown)
+    return grown - core
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Memory planning. A run gets a memory budget, by default a fraction of the
+memory available on the machine, and the plan shares it out: between the
+in-memory intermediate files and the working windows, between the worker
+processes, and between the windows in flight of every process. The same
+code path then runs within a few hundred MB on a laptop and uses the
+memory of a large server instead of swapping on one and idling on the other.
+"""
+
+
+import math
+import os
+
+from osgeo import gdal
+
+from .fill import FILL_BYTES_PER_PIXEL
+from .streaming import STREAM_THREADS, windows_in_flight
+from .tiling import WORKING_BYTES_PER_PIXEL, fits_in_memory, pixels_for_budget
+
+# share of the available memory an automatic budget takes, and the budget
+# used where the available memory cannot be found out
+AUTO_MEMORY_FRACTION = 0.5
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+# memory of one more worker process (interpreter, numpy and GDAL with its
+# block cache) before it reads a single window
+WORKER_OVERHEAD_MB = 150
+
+# memory per lake and per window in flight: the ZonalAccumulator arrays and
+# the per-lake counts of a window
+LAKE_BYTES_PER_WINDOW = 64
+
+# share of the budget the intermediate files may take in memory when their
+# limit is left to the plan
+INTERMEDIATES_SHARE = 0.5
+
+MB = 1024 * 1024
+
+
+def _cgroup_limit_mb():
+    # a container may be limited below the memory of the machine
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as limit:
+                value = limit.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            return int(value) // MB
+    return None
+
+
+def available_memory_mb():
+    
+    """
+    Returns the memory in MB that can be used without swapping (page cache
+    included), or None where neither /proc nor psutil can tell.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        # psutil is only imported where there is no /proc (macOS, Windows)
+        try:
+            import psutil
+        except ImportError:
+            return None
+        available = psutil.virtual_memory().available // MB
+    limit = _cgroup_limit_mb()
+    return available if limit is None else min(available, limit)
+
+
+def auto_memory_budget_mb(fraction=AUTO_MEMORY_FRACTION):
+    
+    """
+    Returns the automatic memory budget in MB: fraction of the available
+    memory, or DEFAULT_MEMORY_BUDGET_MB when it is not known.
+    """
+    available = available_memory_mb()
+    if available is None:
+        return DEFAULT_MEMORY_BUDGET_MB
+    return max(1, int(available * fraction))
+
+
+def dem_value_bytes(dataset):
+    
+    """
+    Returns the bytes per pixel of the sink filled DEM and of the burned DEM
+    made from dataset: 8 for Float64 DEMs, 4 for everything else (Float32).
+    """
+    return 8 if dataset.GetRasterBand(1).DataType == gdal.GDT_Float64 else 4
+
+
+class MemoryPlan:
+
+    """
+    How a run uses its memory budget (in MB, 0 for no limit):
+
+    - workers: worker processes of the lake measurement
+    - threads: compute threads of every stream of windows
+    - window_pixels: pixels of a DEM window, sized so that the windows in
+      flight of all workers fit in the working memory (None: whole DEM)
+    - label_pixels: the whole label grid is kept in memory up to this many
+      DEM pixels (None: always)
+    - fill_pixels: pixels of a window of the built-in sink fill
+    - intermediates_bytes: bytes of intermediate files kept in memory, the
+      rest spills to disk (see Intermediates)
+    """
+
+    def __init__(self, memory_budget_mb, automatic, workers, threads, window_pixels, label_pixels, fill_pixels,
+                 intermediates_bytes, lake_count):
+        self.memory_budget_mb = memory_budget_mb
+        self.automatic = automatic
+        self.workers = workers
+        self.threads = threads
+        self.window_pixels = window_pixels
+        self.label_pixels = label_pixels
+        self.fill_pixels = fill_pixels
+        self.intermediates_bytes = intermediates_bytes
+        self.lake_count = lake_count
+
+    def labels_in_memory(self, dataset):
+        
+        """
+        Returns whether the label grid of dataset is kept in memory. Worker
+        processes read it from a file.
+        """
+        return self.workers == 1 and fits_in_memory(dataset, self.label_pixels)
+
+    def describe(self, dataset):
+        
+        """
+        Returns the plan for a DEM dataset as lines of text, for the log of
+        the run.
+        """
+        if self.memory_budget_mb:
+            budget = '{} MB{}'.format(self.memory_budget_mb, ' (automatic, {:.0%} of the available memory)'.format(AUTO_MEMORY_FRACTION)
+                                      if self.automatic else '')
+        else:
+            budget = 'no limit'
+        if self.window_pixels is None or fits_in_memory(dataset, self.window_pixels):
+            windows = 'the whole DEM at once'
+        else:
+            windows = 'windows of up to {} pixels'.format(self.window_pixels)
+        return ['Memory budget: ' + budget,
+                'DEM: {} x {} pixels, {} lakes'.format(dataset.RasterXSize, dataset.RasterYSize, self.lake_count),
+                'Workers: {}, compute threads per worker: {}'.format(self.workers, self.threads),
+                'Processing: ' + windows,
+                'Lake label grid: ' + ('in memory' if self.labels_in_memory(dataset) else 'on disk'),
+                'Intermediate files: ' + ('up to {} MB in memory'.format(self.intermediates_bytes // MB) if self.intermediates_bytes else 'on disk')]
+
+
+def plan_memory(dataset, lake_count, memory_budget_mb=None, workers=0, intermediates_mb=None, cpus=None):
+    
+    """
+    Plans a run on the DEM dataset with lake_count lakes. memory_budget_mb
+    None picks the automatic budget (see auto_memory_budget_mb), 0 means no
+    limit. workers 0 picks the number of worker processes: one while a
+    window of one process covers the whole DEM, otherwise as many as the
+    CPUs (cpus, by default all of them) and the budget allow, every worker
+    holding at least one block row per window in flight besides its own
+    overhead. intermediates_mb None lets the intermediate files take up to
+    INTERMEDIATES_SHARE of the budget in memory, taken out of the working
+    memory. Returns a MemoryPlan.
+    """
+    automatic = memory_budget_mb is None
+    budget_mb = auto_memory_budget_mb() if automatic else memory_budget_mb
+    pixels = dataset.RasterXSize * dataset.RasterYSize
+    # the sink filled DEM, the label grid and the burned DEM
+    intermediates_needed = pixels * (2 * dem_value_bytes(dataset) + 4)
+    threads = STREAM_THREADS
+    in_flight = windows_in_flight(threads)
+
+    if not budget_mb:
+        return MemoryPlan(0, automatic, workers or 1, threads, None, None, None,
+                          intermediates_needed if intermediates_mb is None else intermediates_mb * MB, lake_count)
+
+    if intermediates_mb is None:
+        intermediates_bytes = min(intermediates_needed, int(budget_mb * MB * INTERMEDIATES_SHARE))
+        working_mb = budget_mb - intermediates_bytes / MB
+    else:
+        intermediates_bytes = intermediates_mb * MB
+        working_mb = budget_mb
+    working_mb = max(1.0, working_mb - lake_count * LAKE_BYTES_PER_WINDOW * in_flight / MB)
+
+    if not workers:
+        if fits_in_memory(dataset, pixels_for_budget(working_mb, in_flight)):
+            workers = 1
+        else:
+            block_ysize = dataset.GetRasterBand(1).GetBlockSize()[1]
+            block_row_mb = dataset.RasterXSize * block_ysize * WORKING_BYTES_PER_PIXEL / MB
+            block_rows = math.ceil(dataset.RasterYSize / block_ysize)
+            workers = int(working_mb // (WORKER_OVERHEAD_MB + block_row_mb * in_flight))
+            workers = max(1, min(workers, cpus or os.cpu_count() or 1, block_rows))
+        working_mb = max(1.0, working_mb - (workers - 1) * WORKER_OVERHEAD_MB)
+
+    return MemoryPlan(budget_mb, automatic, workers, threads,
+                      pixels_for_budget(working_mb, max(workers, in_flight)),
+                      pixels_for_budget(working_mb, workers),
+                      pixels_for_budget(working_mb, bytes_per_pixel=FILL_BYTES_PER_PIXEL),
+                      intermediates_bytes, lake_count)
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import os
+import time
+
+from osgeo import gdal, ogr, osr
+
+from .cache import RasterCache, lakes_digest, raster_digest
+from .engine import measure_epochs, measure_lakes
+from .fill import fill_sinks
+from .intermediates import Intermediates
+from .estimators import InteriorMean
+from .labels import rasterize_lakes
+from .memoryplan import dem_value_bytes, plan_memory
+from .raster import band_dataset, burn_epoch_elevations, burn_lake_elevations, pass_through_copy, window_dataset, write_output
+from .spatialindex import lake_tiles
+from .tiling import block_windows, extent_window, same_grid
+from .timing import StageTimer, raster_pixels
+
+
+def _traditional_axis_order(spatial_reference):
+    # GDAL 3 follows the axis order of the authority (latitude first for
+    # EPSG:4326), the rasters and layers here are always x, y
+    if hasattr(spatial_reference, 'SetAxisMappingStrategy'):
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return spatial_reference
+
+
+def _dem_bounds(dem):
+    origin_x, pixel_width, rotation_x, origin_y, rotation_y, pixel_height = dem.GetGeoTransform()
+    corners = [(origin_x + column * pixel_width + row * rotation_x, origin_y + column * rotation_y + row * pixel_height)
+               for column, row in ((0, 0), (dem.RasterXSize, 0), (dem.RasterXSize, dem.RasterYSize), (0, dem.RasterYSize), (0, 0))]
+    return ogr.CreateGeometryFromWkt('POLYGON ((' + ', '.join('%r %r' % corner for corner in corners) + '))')
+
+
+def iter_lakes(lakes_path, dem, id_field=None, layer_name=None):
+    
+    """
+    Yields the lakes of an OGR layer that overlap the dem dataset as
+    (lake_id, wkb) pairs in the coordinate system of the DEM, one feature at
+    a time straight from the layer. The lake id is taken from id_field, or is
+    the feature id when no field is given. No other field is read.
+    """
+    vector = ogr.Open(lakes_path)
+    if vector is None:
+        raise RuntimeError('Cannot open the lakes layer ' + lakes_path)
+    layer = vector.GetLayerByName(layer_name) if layer_name else vector.GetLayer(0)
+    if layer is None:
+        raise RuntimeError('The lakes layer {} has no layer {}'.format(lakes_path, layer_name))
+
+    transform = None
+    bounds = _dem_bounds(dem)
+    if layer.GetSpatialRef() is not None and dem.GetProjection():
+        layer_reference = _traditional_axis_order(layer.GetSpatialRef().Clone())
+        dem_reference = _traditional_axis_order(osr.SpatialReference(wkt=dem.GetProjection()))
+        if not layer_reference.IsSame(dem_reference):
+            transform = osr.CoordinateTransformation(layer_reference, dem_reference)
+            bounds.Segmentize(max(abs(bounds.GetEnvelope()[1] - bounds.GetEnvelope()[0]), 1.0) / 16)
+            bounds.Transform(osr.CoordinateTransformation(dem_reference, layer_reference))
+
+    # only the lakes overlapping the DEM are read, and only their id and
+    # geometry
+    layer.SetSpatialFilter(bounds)
+    definition = layer.GetLayerDefn()
+    layer.SetIgnoredFields([definition.GetFieldDefn(index).GetName() for index in range(definition.GetFieldCount())
+                            if definition.GetFieldDefn(index).GetName() != id_field] + ['OGR_STYLE'])
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        if transform is not None:
+            geometry = geometry.Clone()
+            geometry.Transform(transform)
+        yield (feature.GetFID() if id_field is None else feature.GetField(id_field), geometry.ExportToWkb())
+
+
+def read_lakes(lakes_path, dem, id_field=None, layer_name=None):
+    
+    """
+    Reads the lakes of an OGR layer that overlap the dem dataset as a list of
+    (lake_id, wkb) pairs in the coordinate system of the DEM, ready for
+    rasterize_lakes (see iter_lakes). Only the WKB geometries and the ids
+    are held in memory, there are no files per lake.
+    """
+    return list(iter_lakes(lakes_path, dem, id_field, layer_name))
+
+
+def lakes_extent(lakes):
+    
+    """
+    Returns the combined extent of a list of (lake_id, wkb) pairs as
+    (xmin, ymin, xmax, ymax), or None when there are no lakes.
+    """
+    extent = None
+    for lake_id, wkb in lakes:
+        xmin, xmax, ymin, ymax = ogr.CreateGeometryFromWkb(bytes(wkb)).GetEnvelope()
+        if extent is not None:
+            xmin, ymin, xmax, ymax = min(xmin, extent[0]), min(ymin, extent[1]), max(xmax, extent[2]), max(ymax, extent[3])
+        extent = (xmin, ymin, xmax, ymax)
+    return extent
+
+
+def flatten_dem(dem_path, lakes, output_path, estimator=None, min_slope_degrees=0.0,
+                extent_buffer=100, memory_budget_mb=None, intermediates_mb=None, cache=None, feedback=None, timer=None,
+                layout='STRIPED', compression='NONE', threads=0, fill=True):
+    
+    """
+    Runs the direct burn-in path of the lake processing scripts on one DEM,
+    without QGIS: the window of the DEM around the lakes is sink filled, every
+    lake is set to the elevation chosen by the estimator (by default the mean
+    elevation of its pixels, see the estimators module) and the result is
+    written to output_path, a copy of the DEM with only that window
+    rewritten. lakes is a list of (lake_id, wkb) pairs in the coordinate
+    system of the DEM. The stages are timed with timer when one is given.
+    layout, compression and threads select the output format (see
+    output_format). Returns the number of lakes that were flattened.
+
+    The window size and the intermediate files kept in memory follow the
+    memory plan of the DEM window (see plan_memory): memory_budget_mb None
+    is the automatic budget, 0 no limit, and intermediates_mb None takes the
+    in-memory intermediate files out of the budget. The plan is reported
+    through feedback before the run starts.
+
+    With fill=False the DEM is not sink filled: only the window of the lakes
+    (grown by extent_buffer) is read, rasterized and rewritten in a copy of
+    the DEM, or in the small GeoTIFF of a .vrt overlay output (see
+    burn_lake_elevations), so the run time follows the size of the lakes
+    rather than of the DEM.
+    """
+    intermediates = Intermediates()
+    try:
+        return _flatten_dem(dem_path, lakes, output_path, estimator or InteriorMean(), min_slope_degrees,
+                            extent_buffer, memory_budget_mb, intermediates_mb, cache, feedback, intermediates, timer or StageTimer(),
+                            dict(layout=layout, compression=compression, threads=threads), fill)
+    finally:
+        intermediates.cleanup()
+
+
+def _copy_dem(dem_path, output_path, output_options):
+    # the output of a DEM without lakes
+    if os.path.splitext(output_path)[1].lower() == '.vrt':
+        gdal.BuildVRT(output_path, [dem_path]).FlushCache()
+    elif output_options['layout'] == 'STRIPED' and output_options['compression'] == 'NONE':
+        pass_through_copy(dem_path, output_path)
+    else:
+        write_output(dem_path, output_path, **output_options)
+
+
+def _flatten_dem(dem_path, lakes, output_path, estimator, min_slope_degrees,
+                 extent_buffer, memory_budget_mb, intermediates_mb, cache, feedback, intermediates, timer, output_options, fill):
+    with timer.stage('Extent window'):
+        extent = lakes_extent(lakes)
+        window = None if extent is None else extent_window(gdal.Open(dem_path), extent, extent_buffer)
+    if window is None:
+        with timer.stage('Copy'):
+            _copy_dem(dem_path, output_path, output_options)
+        return 0
+
+    input_dem = window_dataset(dem_path, window, intermediates.path('INPUT-DEM-WINDOW.vrt'))
+    input_dataset = gdal.Open(input_dem)
+    filled_dem_bytes = raster_pixels(input_dataset) * dem_value_bytes(input_dataset)
+    # the lakes are measured in this process, tiles run in parallel instead
+    plan = plan_memory(input_dataset, len(lakes), memory_budget_mb, 1, intermediates_mb)
+    if feedback is not None:
+        for line in plan.describe(input_dataset):
+            feedback.pushInfo(line)
+    intermediates.max_bytes = plan.intermediates_bytes
+
+    # the cache keys match the ones of the QGIS scripts (built-in fill backend)
+    fill_key = sinks_filled_dem = None
+    if not fill:
+        sinks_filled_dem = input_dem
+    elif cache is not None:
+        with timer.stage('Sink fill cache lookup', raster_pixels(input_dataset)):
+            fill_key = 'fill-' + raster_digest(input_dataset, plan.window_pixels, 0, min_slope_degrees)
+            sinks_filled_dem = cache.get(fill_key)
+    if sinks_filled_dem is None:
+        with timer.stage('Sink fill', raster_pixels(input_dataset), profile=True):
+            sinks_filled_dem = intermediates.path('INPUT-DEM-SINKS-FILLED.tif', filled_dem_bytes)
+            fill_sinks(input_dem, sinks_filled_dem, min_slope_degrees, plan.fill_pixels, feedback)
+            if cache is not None:
+                sinks_filled_dem = cache.put(fill_key, sinks_filled_dem)
+
+    dem = gdal.Open(sinks_filled_dem)
+    windows = list(block_windows(dem, plan.window_pixels))
+    with timer.stage('Rasterize lakes', raster_pixels(dem)):
+        labels_key = None if cache is None else 'labels-' + lakes_digest(lakes, dem)
+        labels = None if cache is None else cache.get_labels(labels_key)
+        if labels is None:
+            labels_path = None if plan.labels_in_memory(dem) else intermediates.path('LAKE-LABELS.tif', raster_pixels(dem) * 4)
+            labels = rasterize_lakes(dem, lakes, labels_path)
+            if cache is not None:
+                labels = cache.put_labels(labels_key, labels)
+
+    zonal = None
+    if estimator.measures:
+        measure_options = estimator.measure_options()
+        measure_windows = lake_tiles(dem, lakes, plan.window_pixels, measure_options['ring_width'] + 1)
+        with timer.stage('Measure lakes', sum(window[2] * window[3] for window in measure_windows), profile=True):
+            zonal = measure_lakes(dem, labels, measure_windows, threads=timer.stream_threads(), feedback=feedback, **measure_options)[0]
+    with timer.stage('Burn in', raster_pixels(dem), profile=True):
+        burn_lake_elevations(dem, labels, estimator.elevations(labels.count, zonal), output_path, windows, base_path=dem_path, offset=window[:2],
+                             scratch_path=intermediates.path('BURNED-DEM.tif', filled_dem_bytes), stream_threads=timer.stream_threads(),
+                             **output_options)
+    return labels.count
+
+
+def epoch_layers(dem_paths):
+    
+    """
+    Returns the epochs of a DEM stack given as DEM paths, as the (dem_path,
+    band) layers flatten_epochs takes: every band of every DEM, in order, so
+    that one multi-band DEM, several single band DEMs or a mix of both can
+    be given.
+    """
+    layers = []
+    for dem_path in dem_paths:
+        dem = gdal.Open(dem_path)
+        if dem is None:
+            raise RuntimeError('Cannot open the DEM ' + dem_path)
+        layers.extend((dem_path, band) for band in range(1, dem.RasterCount + 1))
+    return layers
+
+
+def flatten_epochs(layers, lakes, output_paths, estimator=None, min_slope_degrees=0.0,
+                   extent_buffer=100, memory_budget_mb=None, intermediates_mb=None, feedback=None, timer=None,
+                   layout='STRIPED', compression='NONE', threads=0, fill=True):
+    
+    """
+    Runs flatten_dem on a stack of co-registered DEM epochs at once. layers
+    is a list of (dem_path, band) pairs (see epoch_layers) on one grid, and
+    output_paths holds one output per layer. The lakes are rasterized once,
+    every lake of every epoch is measured in one reduction over the stack of
+    epochs (see measure_epochs) and all outputs are written in a single
+    sweep over the label grid (see burn_epoch_elevations). Only the sink
+    fill runs once per epoch, as the epochs hold different elevations.
+
+    The windows are sized so that the windows of all epochs together fit in
+    the memory plan. Raises ValueError when the layers do not share one grid
+    or there is not one output per layer. Returns the number of lakes that
+    were flattened in every epoch.
+    """
+    if len(output_paths) != len(layers):
+        raise ValueError('{} outputs given for {} DEM epochs'.format(len(output_paths), len(layers)))
+    intermediates = Intermediates()
+    try:
+        return _flatten_epochs(layers, lakes, output_paths, estimator or InteriorMean(), min_slope_degrees,
+                               extent_buffer, memory_budget_mb, intermediates_mb, feedback, intermediates, timer or StageTimer(),
+                               dict(layout=layout, compression=compression, threads=threads), fill)
+    finally:
+        intermediates.cleanup()
+
+
+def _flatten_epochs(layers, lakes, output_paths, estimator, min_slope_degrees,
+                    extent_buffer, memory_budget_mb, intermediates_mb, feedback, intermediates, timer, output_options, fill):
+    # every epoch as a single band DEM, the bands of multi-band DEMs through a VRT
+    dem_paths = [dem_path if gdal.Open(dem_path).RasterCount == 1 else band_dataset(dem_path, band, intermediates.path('EPOCH-{}.vrt'.format(index)))
+                 for index, (dem_path, band) in enumerate(layers, start=1)]
+    first = gdal.Open(dem_paths[0])
+    for dem_path in dem_paths[1:]:
+        if not same_grid(first, gdal.Open(dem_path)):
+            raise ValueError('The DEM epochs {} and {} are not on the same grid'.format(dem_paths[0], dem_path))
+
+    with timer.stage('Extent window'):
+        extent = lakes_extent(lakes)
+        window = None if extent is None else extent_window(first, extent, extent_buffer)
+    if window is None:
+        with timer.stage('Copy'):
+            for dem_path, output_path in zip(dem_paths, output_paths):
+                _copy_dem(dem_path, output_path, output_options)
+        return 0
+
+    input_dems = [window_dataset(dem_path, window, intermediates.path('INPUT-DEM-WINDOW-{}.vrt'.format(index)))
+                  for index, dem_path in enumerate(dem_paths, start=1)]
+    input_dataset = gdal.Open(input_dems[0])
+    filled_dem_bytes = raster_pixels(input_dataset) * dem_value_bytes(input_dataset)
+    plan = plan_memory(input_dataset, len(lakes), memory_budget_mb, 1, intermediates_mb)
+    if feedback is not None:
+        for line in plan.describe(input_dataset):
+            feedback.pushInfo(line)
+        feedback.pushInfo('DEM epochs: {}'.format(len(layers)))
+    intermediates.max_bytes = plan.intermediates_bytes
+
+    sinks_filled_dems = input_dems
+    if fill:
+        with timer.stage('Sink fill', raster_pixels(input_dataset) * len(input_dems), profile=True):
+            sinks_filled_dems = []
+            for index, input_dem in enumerate(input_dems, start=1):
+                sinks_filled_dems.append(intermediates.path('INPUT-DEM-SINKS-FILLED-{}.tif'.format(index), filled_dem_bytes))
+                fill_sinks(input_dem, sinks_filled_dems[-1], min_slope_degrees, plan.fill_pixels, feedback)
+
+    dems = [gdal.Open(path) for path in sinks_filled_dems]
+    # a window is read from every epoch at the same time
+    window_pixels = None if plan.window_pixels is None else max(1, plan.window_pixels // len(dems))
+    windows = list(block_windows(dems[0], window_pixels))
+    with timer.stage('Rasterize lakes', raster_pixels(dems[0])):
+        labels_path = None if plan.labels_in_memory(dems[0]) else intermediates.path('LAKE-LABELS.tif', raster_pixels(dems[0]) * 4)
+        labels = rasterize_lakes(dems[0], lakes, labels_path)
+
+    if estimator.measures:
+        measure_options = estimator.measure_options()
+        measure_windows = lake_tiles(dems[0], lakes, window_pixels, measure_options['ring_width'] + 1)
+        with timer.stage('Measure lakes', sum(window[2] * window[3] for window in measure_windows) * len(dems), profile=True):
+            zonals = measure_epochs(dems, labels, measure_windows, threads=timer.stream_threads(), feedback=feedback, **measure_options)
+        elevations = [estimator.elevations(labels.count, zonal) for zonal in zonals]
+    else:
+        elevations = [estimator.elevations(labels.count)] * len(dems)
+    with timer.stage('Burn in', raster_pixels(dems[0]) * len(dems), profile=True):
+        burn_epoch_elevations(dems, labels, elevations, output_paths, windows, base_paths=dem_paths, offset=window[:2], feedback=feedback,
+                              scratch_paths=[intermediates.path('BURNED-DEM-{}.tif'.format(index), filled_dem_bytes)
+                                             for index in range(1, len(dems) + 1)],
+                              stream_threads=timer.stream_threads(), **output_options)
+    return labels.count
+
+
+def run_epochs(layers, lakes_path, output_paths, id_field=None, layer_name=None, trace_path=None, **options):
+    
+    """
+    Reads the lakes overlapping a stack of DEM epochs, given as (dem_path,
+    band) layers (see epoch_layers), and flattens them with flatten_epochs,
+    catching any error. With trace_path, the stage timings are written there
+    as a Chrome trace. Returns one status row per layer, like run_tile, with
+    the layer as dem_path:band.
+    """
+    started = time.perf_counter()
+    timer = StageTimer()
+    try:
+        dem = gdal.Open(layers[0][0])
+        if dem is None:
+            raise RuntimeError('Cannot open the DEM ' + layers[0][0])
+        with timer.stage('Read lakes'):
+            lakes = read_lakes(lakes_path, dem, id_field, layer_name)
+        lake_count = flatten_epochs(layers, lakes, output_paths, timer=timer, **options)
+        status, message = ('done' if lake_count else 'no lakes'), ''
+    except Exception as error:
+        lake_count, status, message = 0, 'failed', '{}: {}'.format(type(error).__name__, error)
+    if trace_path:
+        timer.write_trace(trace_path)
+    seconds = round(time.perf_counter() - started, 3)
+    return [('{}:{}'.format(dem_path, band), output_path, status, lake_count, seconds, message)
+            for (dem_path, band), output_path in zip(layers, output_paths)]
+
+
+def run_tile(dem_path, lakes_path, output_path, id_field=None, layer_name=None, cache_folder=None, cache_bytes=0, trace=False,
+             **options):
+    
+    """
+    Reads the lakes overlapping one DEM tile and flattens them with
+    flatten_dem, catching any error. With trace, the stage timings are
+    written as a Chrome trace next to the output. Returns a status row (dem,
+    output, status, lakes, seconds, message) for the batch summary. This is
+    the function the worker processes of the batch runner call.
+    """
+    started = time.perf_counter()
+    timer = StageTimer()
+    try:
+        dem = gdal.Open(dem_path)
+        if dem is None:
+            raise RuntimeError('Cannot open the DEM ' + dem_path)
+        with timer.stage('Read lakes'):
+            lakes = read_lakes(lakes_path, dem, id_field, layer_name)
+        cache = RasterCache(cache_folder, cache_bytes) if cache_folder else None
+        lake_count = flatten_dem(dem_path, lakes, output_path, cache=cache, timer=timer, **options)
+        status, message = ('done' if lake_count else 'no lakes'), ''
+    except Exception as error:
+        lake_count, status, message = 0, 'failed', '{}: {}'.format(type(error).__name__, error)
+    if trace:
+        timer.write_trace(os.path.splitext(output_path)[0] + '.trace.json')
+    return (dem_path, output_path, status, lake_count, round(time.perf_counter() - started, 3), message)
@@ -0,0 +1,878 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+The QGIS side of the lake flattening: Processing algorithm base classes that
+hold the whole pipeline, so that the scripts only add their parameters and
+their elevation estimator. This module needs QGIS and is not imported by the
+package itself. The scripts refer to these classes through the module (not
+import them by name), because the QGIS script loader takes the first
+QgsProcessingAlgorithm subclass it finds in the namespace of a script.
+The rest of the package is imported by the methods that run the algorithm,
+so that loading the scripts at QGIS startup imports no more than QGIS itself.
+"""
+
+import os
+import time
+from datetime import date, datetime
+
+from osgeo import gdal
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsCoordinateTransform, QgsFeature, QgsFeatureRequest, QgsFeatureSink, QgsField, QgsFields, QgsMessageLog,
+                       QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterBoolean,
+                       QgsProcessingParameterEnum, QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterField, QgsProcessingParameterFile, QgsProcessingParameterNumber,
+                       QgsProcessingParameterRasterDestination, QgsProcessingParameterRasterLayer, QgsProcessingUtils,
+                       QgsRasterLayer, QgsRectangle, QgsVectorLayer, QgsWkbTypes)
+
+
+class LakeFlatteningAlgorithm(QgsProcessingAlgorithm):
+
+    """
+    Base class of the lake flattening algorithms: the parameters and the
+    steps they share, the stage timing and the choice of an elevation
+    estimator, which subclasses provide with estimator().
+    """
+
+    INPUTDEMLAYER = 'INPUTDEMLAYER'
+    INPUTAOILAYER = 'INPUTAOI'
+    FOLDERFORINTERMEDIATEPROCESSING = 'FOLDERFORINTERMEDIATEPROCESSING'
+    DIRECTBURNIN = 'DIRECTBURNIN'
+    MEMORYBUDGET = 'MEMORYBUDGET'
+    TIMINGTRACE = 'TIMINGTRACE'
+    PROFILE = 'PROFILE'
+    OUTPUTLAYOUT = 'OUTPUTLAYOUT'
+    OUTPUTCOMPRESSION = 'OUTPUTCOMPRESSION'
+    OUTPUTTHREADS = 'OUTPUTTHREADS'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return type(self)()
+
+    def group(self):
+        
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr('Helper scripts')
+
+
+    def groupId(self):
+        
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        The group id should be unique within each provider. Group id should
+        contain lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'helperscripts'
+
+
+    def estimator(self, parameters, context):
+        
+        """
+        Returns the ElevationEstimator that chooses the elevation of the lakes.
+        """
+        raise NotImplementedError
+
+
+    def runAlgorithm(self, parameters, context, feedback, timer):
+        
+        """
+        Runs the algorithm, timing its stages with timer.
+        """
+        raise NotImplementedError
+
+
+    def addTimingParameters(self, profile_description):
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TIMINGTRACE,
+                self.tr('Write the stage timings as a Chrome trace (.trace.json next to the output)'),
+                defaultValue=False
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PROFILE,
+                profile_description,
+                defaultValue=False
+                )
+        )
+
+
+    def addOutputParameters(self):
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUTLAYOUT,
+                self.tr('Output layout - tiles make reading parts of the DEM much cheaper, a cloud optimized GeoTIFF adds internal overviews'),
+                options=[self.tr('Striped GeoTIFF'), self.tr('Tiled GeoTIFF'), self.tr('Cloud optimized GeoTIFF')],
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUTCOMPRESSION,
+                self.tr('Output compression - DEFLATE and ZSTD with a predictor, LERC lossless'),
+                options=['None', 'DEFLATE', 'ZSTD', 'LERC'],
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.OUTPUTTHREADS,
+                self.tr('Threads compressing the output (0 for all CPUs)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.OUTPUT,
+                self.tr('Output layer')
+            )
+        )
+
+
+    def outputFormat(self, parameters, context):
+        
+        """
+        Returns the layout, compression and threads options of the output DEM.
+        """
+        from .raster import OUTPUT_COMPRESSIONS, OUTPUT_LAYOUTS
+        
+        return {'layout': OUTPUT_LAYOUTS[self.parameterAsEnum(parameters, self.OUTPUTLAYOUT, context)],
+                'compression': OUTPUT_COMPRESSIONS[self.parameterAsEnum(parameters, self.OUTPUTCOMPRESSION, context)],
+                'threads': self.parameterAsInt(parameters, self.OUTPUTTHREADS, context)}
+
+
+    def memoryBudget(self, parameters, context):
+        
+        """
+        Returns the memory budget in MB, or None for the automatic budget when
+        the parameter is left empty (see plan_memory).
+        """
+        if parameters.get(self.MEMORYBUDGET) in (None, ''):
+            return None
+        return self.parameterAsInt(parameters, self.MEMORYBUDGET, context)
+
+
+    def readLakes(self, source, request, feedback, id_field=None):
+        
+        """
+        Reads the lakes of a feature source as a list of (lake_id, wkb) pairs,
+        streaming the features straight from the source with their geometry
+        and the id_field attribute only (all features are lake 1 without
+        one). Progress and cancellation are checked every LAKE_BATCH_SIZE
+        features; a canceled read returns the lakes read so far.
+        """
+        from .labels import LAKE_BATCH_SIZE
+        
+        if id_field is None:
+            request.setNoAttributes()
+        else:
+            request.setSubsetOfAttributes([id_field], source.fields())
+        total = source.featureCount()
+        lakes = []
+        for index, feature in enumerate(source.getFeatures(request), start=1):
+            if feature.hasGeometry():
+                lakes.append((1 if id_field is None else feature[id_field], bytes(feature.geometry().asWkb())))
+            if index % LAKE_BATCH_SIZE == 0:
+                if feedback.isCanceled():
+                    break
+                if total > 0:
+                    feedback.setProgress(100.0 * index / total)
+        return lakes
+
+
+    def createWorkingFolder(self, dir_path):
+        
+        """
+        Creates the folder of this run inside dir_path, named after the
+        algorithm and the current date and time, and returns its path.
+        """
+        current_date = date.today()
+        current_date_and_time = str(current_date) + "-" + datetime.now().strftime("%H:%M:%S").replace(":","")
+        
+        working_dir_path = os.path.join(dir_path, self.name().upper().replace(' ', '_') + "-" + current_date_and_time)
+        os.mkdir(working_dir_path) 
+        return working_dir_path
+
+
+    def processAlgorithm(self, parameters, context, feedback):
+        
+        from .timing import StageTimer
+        
+        # every stage is timed and reported, the trace and the profile go next
+        # to the output when asked for
+        output_base = os.path.splitext(self.parameterAsOutputLayer(parameters, self.OUTPUT, context))[0]
+        timer = StageTimer(feedback, output_base + '.prof' if self.parameterAsBoolean(parameters, self.PROFILE, context) else None)
+        try:
+            return self.runAlgorithm(parameters, context, feedback, timer)
+        finally:
+            feedback.pushInfo(self.tr('Total of all stages: {:.3f} s').format(timer.total_seconds()))
+            if self.parameterAsBoolean(parameters, self.TIMINGTRACE, context):
+                feedback.pushInfo(self.tr('Stage timings written to {}').format(timer.write_trace(output_base + '.trace.json')))
+            if timer.write_profile():
+                feedback.pushInfo(self.tr('Profile written to {}').format(timer.profile_path))
+
+
+class LakeRegionsAlgorithm(LakeFlatteningAlgorithm):
+
+    """
+    Base class of the algorithms that flatten every lake of a lakes layer:
+    the DEM is sink filled, the lakes are rasterized into one label grid,
+    measured in a single pass and burned in with the elevations of the
+    estimator. Subclasses add their own parameters in
+    initEstimatorParameters() and build their estimator with
+    statisticEstimator(), from the statistic chosen for the lake elevation.
+    """
+
+    INPUTLAKESLAYER = 'INPUTLAKESLAYER'
+    UNIQUEFIELDNAME = 'UNIQUEFIELDNAME'
+    RESUMEFOLDER = 'RESUMEFOLDER'
+    INCREMENTAL = 'INCREMENTAL'
+    SINKFILLBACKEND = 'SINKFILLBACKEND'
+    MINSLOPE = 'MINSLOPE'
+    RESTRICTTOEXTENT = 'RESTRICTTOEXTENT'
+    EXTENTBUFFER = 'EXTENTBUFFER'
+    WORKERS = 'WORKERS'
+    INTERMEDIATESMEMORY = 'INTERMEDIATESMEMORY'
+    CACHEFOLDER = 'CACHEFOLDER'
+    CACHESIZE = 'CACHESIZE'
+    LAKESTATISTICS = 'LAKESTATISTICS'
+    STATISTIC = 'STATISTIC'
+    PERCENTILE = 'PERCENTILE'
+    TRIMPROPORTION = 'TRIMPROPORTION'
+    MODEBINWIDTH = 'MODEBINWIDTH'
+
+    def initEstimatorParameters(self):
+        
+        """
+        Adds the parameters of the elevation estimator, after the unique field.
+        """
+        pass
+
+
+    def initAlgorithm(self, config=None):
+        
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.INPUTDEMLAYER,
+                self.tr('Input DEM layer')
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUTLAKESLAYER,
+                self.tr('Input lakes layer'),
+                [QgsProcessing.TypeVector]
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUTAOILAYER,
+                self.tr('Area of interest - should coincide with the input DEM layer! Only needed when the lake elevations are not burned directly into the DEM'),
+                [QgsProcessing.TypeVector],
+                optional=True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.UNIQUEFIELDNAME,
+                 self.tr('Field name of unique id for each lake'),
+                type=QgsProcessingParameterField.Any,
+                parentLayerParameterName=self.INPUTLAKESLAYER,
+                defaultValue=None)
+        )
+        
+        self.initEstimatorParameters()
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.STATISTIC,
+                self.tr('Statistic of the pixel elevations used as the lake elevation - the median, a percentile, the trimmed mean or the mode are not pulled by bridges, dams or spikes like the mean'),
+                options=[self.tr('Mean'), self.tr('Median'), self.tr('Percentile'), self.tr('Trimmed mean'), self.tr('Mode (histogram)')],
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PERCENTILE,
+                self.tr('Percentile (0 to 100) of the pixel elevations, for the percentile statistic'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.0,
+                maxValue=100.0,
+                defaultValue=50.0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.TRIMPROPORTION,
+                self.tr('Proportion of the lowest and of the highest pixel elevations left out, for the trimmed mean'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.0,
+                maxValue=0.49,
+                defaultValue=0.1
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MODEBINWIDTH,
+                self.tr('Width of the histogram bins in meters, for the mode'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.001,
+                defaultValue=0.1
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.FOLDERFORINTERMEDIATEPROCESSING,
+                self.tr("Processing folder for debugging - a directory with the current date will get created within this folder, and it will hold all the intermediate files (leave empty to keep them in memory)"),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.RESUMEFOLDER,
+                self.tr("Resume folder - continue a crashed or canceled run in the directory it created in its processing folder"),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INCREMENTAL,
+                self.tr('Incremental update - update the output of the finished run in the resume folder, recomputing only the lakes added, edited or removed since then (all lakes when its sink filled DEM or output is gone)'),
+                defaultValue=False
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INTERMEDIATESMEMORY,
+                self.tr('Memory for intermediate files in MB - without a processing folder they are kept in memory up to this size and spill to the temporary folder above it (leave empty to take it from the memory budget)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                optional=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.SINKFILLBACKEND,
+                self.tr('Sink filling'),
+                options=[self.tr('Built-in Planchon/Darboux (no SAGA needed)'), self.tr('SAGA Fill Sinks (Planchon/Darboux, 2001)')],
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MINSLOPE,
+                self.tr('Minimum slope in degrees kept between neighbouring cells when filling sinks'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.0,
+                defaultValue=0.01
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.DIRECTBURNIN,
+                self.tr('Burn the lake elevations directly into the DEM (single pass, no polygonize/difference step and no area of interest needed)'),
+                defaultValue=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.RESTRICTTOEXTENT,
+                self.tr('Only read, fill and write the part of the DEM around the lakes and the area of interest (the rest of the DEM is passed through untouched)'),
+                defaultValue=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.EXTENTBUFFER,
+                self.tr('Buffer in pixels around the lakes and the area of interest'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=100
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MEMORYBUDGET,
+                self.tr('Memory budget in MB - the tile size, the number of workers and the intermediate files kept in memory are chosen to fit in this budget (leave empty for half of the available memory, 0 processes the whole DEM at once)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                optional=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of worker processes - the DEM windows are shared out between them, the result does not depend on this number (0 chooses it from the memory budget and the CPUs)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.CACHEFOLDER,
+                self.tr('Cache folder - sink filled DEMs and lake label grids are kept here and reused by later runs on the same data (leave empty to disable)'),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+                )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CACHESIZE,
+                self.tr('Cache size limit in MB - the least recently used entries are removed above it'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=10240
+                )
+        )
+        
+        self.addTimingParameters(self.tr('Profile the sink fill, the lake measurement and the burn in with cProfile (.prof next to the output)'))
+        
+        self.addOutputParameters()
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.LAKESTATISTICS,
+                self.tr('Lake statistics - one row per lake, with the pixel counts, the elevation the lake was set to, the mean/min/max elevation it was computed from and the processing time (the time of the single pass shared out by pixel count); skipped by default, since counting the pixels adds a boundary ring pass to the measurement'),
+                QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+
+    def statisticEstimator(self, parameters, context, width=0, side=None):
+        
+        """
+        Returns the estimator of the chosen statistic over all the pixels of
+        every lake (width 0) or over a ring of width pixels on side of its
+        shoreline (both sides by default).
+        """
+        from .estimators import ELEVATION_STATISTICS, statistic_estimator
+        from .labels import RING_BOTH
+        
+        if side is None:
+            side = RING_BOTH
+        return statistic_estimator(ELEVATION_STATISTICS[self.parameterAsEnum(parameters, self.STATISTIC, context)], width, side,
+                                   self.parameterAsDouble(parameters, self.PERCENTILE, context),
+                                   self.parameterAsDouble(parameters, self.TRIMPROPORTION, context),
+                                   self.parameterAsDouble(parameters, self.MODEBINWIDTH, context))
+
+
+    def lakeStatisticsFields(self, lakes_source, unique_field_name):
+        
+        """
+        Returns the fields of the per-lake statistics table. The lake id keeps
+        the type of the unique field of the lakes layer.
+        """
+        from .statistics import STATISTICS_FIELDS
+        
+        fields = QgsFields()
+        for name, kind in STATISTICS_FIELDS:
+            if kind == 'id':
+                field = QgsField(lakes_source.fields().field(unique_field_name))
+                field.setName(name)
+            else:
+                field = QgsField(name, QVariant.Int if kind == 'int' else QVariant.Double)
+            fields.append(field)
+        return fields
+
+
+    def lakesExtent(self, parameters, context, dem_crs):
+        
+        """
+        Returns the combined extent of the lakes layer and, when given, the area
+        of interest as (xmin, ymin, xmax, ymax) in the coordinate system of the DEM.
+        """
+        extent = QgsRectangle()
+        extent.setMinimal()
+        for name in (self.INPUTLAKESLAYER, self.INPUTAOILAYER):
+            source = self.parameterAsSource(parameters, name, context)
+            if source is None:
+                continue
+            transform = QgsCoordinateTransform(source.sourceCrs(), dem_crs, context.transformContext())
+            extent.combineExtentWith(transform.transformBoundingBox(source.sourceExtent()))
+        return (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+
+
+    def runAlgorithm(self, parameters, context, feedback, timer):
+        
+        """
+        Checks the parameters, sets up the intermediate files and the run
+        manifest and runs the algorithm.
+        """
+        from .checkpoint import RunManifest
+        from .intermediates import Intermediates
+        
+        direct_burn_in = self.parameterAsBoolean(parameters, self.DIRECTBURNIN, context)
+        if not direct_burn_in and self.parameterAsSource(parameters, self.INPUTAOILAYER, context) is None:
+            raise QgsProcessingException(self.tr('An area of interest is required when the lake elevations are not burned directly into the DEM'))
+        if self.parameterAsBoolean(parameters, self.INCREMENTAL, context) and not (direct_burn_in and self.parameterAsString(parameters, self.RESUMEFOLDER, context)):
+            raise QgsProcessingException(self.tr('An incremental update needs the resume folder of a finished run and burning the lake elevations directly into the DEM'))
+                
+        # intermediate files are kept in memory (spilling to the QGIS temporary
+        # folder above the limit) unless a processing folder is given for debugging
+        working_dir_path = self.parameterAsString(parameters, self.RESUMEFOLDER, context) or None
+        resuming = working_dir_path is not None
+        if not resuming and self.parameterAsString(parameters, self.FOLDERFORINTERMEDIATEPROCESSING, context):
+            working_dir_path = self.createWorkingFolder(parameters['FOLDERFORINTERMEDIATEPROCESSING'])
+        
+        # the in-memory limit is set by the memory plan of flattenLakes
+        intermediates = Intermediates(working_dir_path, spill_folder=QgsProcessingUtils.tempFolder())
+        
+        # a run with a processing folder keeps a manifest of its progress there,
+        # so that it can be resumed after a crash or a cancellation
+        manifest = None
+        if working_dir_path is not None:
+            try:
+                manifest = RunManifest(working_dir_path, {}, resume=resuming)
+            except ValueError as error:
+                raise QgsProcessingException(str(error))
+        
+        try:
+            return self.flattenLakes(parameters, context, feedback, intermediates, timer, manifest)
+        finally:
+            intermediates.cleanup()
+
+
+    def updateLakes(self, parameters, context, feedback, timer, manifest, dem, lakes, dem_window):
+        
+        """
+        Updates the output of the run recorded in the manifest for the current
+        lakes, recomputing only the lakes added, edited or removed since that
+        run and the lakes next to them, whose boundary may have changed. No
+        lake statistics are written.
+        """
+        from .cache import lakes_digest
+        from .checkpoint import signature
+        from .incremental import reflatten_lakes
+        
+        estimator = self.estimator(parameters, context)
+        output_dem = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+        with timer.stage('Incremental update'):
+            try:
+                (records, changed) = reflatten_lakes(dem, lakes, manifest.lakes(), manifest.record('output')['files'][0], output_dem,
+                                                     estimator,
+                                                     offset=dem_window[:2] if dem_window else (0, 0),
+                                                     feedback=feedback,
+                                                     base_path=self.parameterAsRasterLayer(parameters, self.INPUTDEMLAYER, context).source() if dem_window else None,
+                                                     **self.outputFormat(parameters, context))
+            except ValueError as error:
+                raise QgsProcessingException(str(error))
+        if feedback.isCanceled():
+            return {}
+        feedback.pushInfo(self.tr('{} lakes changed since the previous run').format(changed))
+        
+        manifest.add_inputs(lakes=lakes_digest(lakes, dem))
+        manifest.set_lakes(records)
+        manifest.forget('labels', 'measure')
+        manifest.complete('output', ('dem', 'fill', 'lakes'), files=[output_dem], estimator=signature(estimator.signature()))
+        return {self.OUTPUT: output_dem}
+
+
+    def flattenLakes(self, parameters, context, feedback, intermediates, timer, manifest=None):
+        
+        """
+        Runs the algorithm, placing its intermediate files through intermediates
+        and timing its stages with timer. Completed stages are recorded in, and
+        when resuming taken from, the manifest of the working folder.
+        """
+        from .cache import RasterCache, lakes_digest, raster_digest
+        from .checkpoint import file_signature, lake_geometry_hashes, signature
+        from .engine import measure_lakes
+        from .fill import fill_sinks
+        from .incremental import lakes_outside
+        from .labels import LakeLabels, rasterize_lakes
+        from .memoryplan import dem_value_bytes, plan_memory
+        from .raster import burn_lake_elevations, window_dataset, write_lake_elevation_raster, write_output
+        from .spatialindex import lake_tiles, lake_windows
+        from .statistics import lake_statistics_rows
+        from .tiling import block_windows, extent_window
+        from .timing import raster_pixels
+        
+        direct_burn_in = self.parameterAsBoolean(parameters, self.DIRECTBURNIN, context)
+        estimator = self.estimator(parameters, context)
+        fill_backend = self.parameterAsEnum(parameters, self.SINKFILLBACKEND, context)
+        
+        # read, fill and write only the window of the DEM around the lakes and
+        # the area of interest, the rest of the DEM is passed through untouched
+        input_dem_layer = self.parameterAsRasterLayer(parameters, self.INPUTDEMLAYER, context)
+        input_dem = input_dem_layer.source()
+        dem_window = None
+        incremental = manifest is not None and self.parameterAsBoolean(parameters, self.INCREMENTAL, context)
+        if incremental:
+            previous_fill = manifest.record('fill')
+            previous_output = manifest.record('output')
+            if previous_fill is None or previous_output is None:
+                raise QgsProcessingException(self.tr('The run in {} did not finish, it can be resumed but not updated').format(manifest.folder))
+            # the sink filled DEM may have been evicted from the cache or the
+            # output removed since, then every stage is run again
+            missing = [path for path in previous_fill['files'] + previous_output['files'] if not os.path.exists(path)]
+            if missing:
+                feedback.pushInfo(self.tr('{} of the run in {} is gone, flattening all lakes again').format(', '.join(missing), manifest.folder))
+                incremental = False
+            # the lakes kept from the previous run have the elevations of its
+            # statistic, ring and estimator
+            elif previous_output.get('estimator') != signature(estimator.signature()):
+                feedback.pushInfo(self.tr('The elevation statistic changed since the run in {}, flattening all lakes again').format(manifest.folder))
+                incremental = False
+        if incremental:
+            # an incremental update works on the DEM window of the run it updates
+            dem_window = previous_fill['inputs']['dem'][-1]
+            if dem_window:
+                input_dem = window_dataset(input_dem, dem_window, intermediates.path('INPUT-DEM-WINDOW.vrt', on_disk=fill_backend == 1))
+        elif self.parameterAsBoolean(parameters, self.RESTRICTTOEXTENT, context):
+            with timer.stage('Extent window'):
+                dem_window = extent_window(gdal.Open(input_dem), self.lakesExtent(parameters, context, input_dem_layer.crs()),
+                                           self.parameterAsInt(parameters, self.EXTENTBUFFER, context))
+                if dem_window is None:
+                    raise QgsProcessingException(self.tr('The lakes do not overlap the input DEM'))
+                input_dem = window_dataset(input_dem, dem_window, intermediates.path('INPUT-DEM-WINDOW.vrt', on_disk=fill_backend == 1))
+        
+        # sink filled DEMs and lake label grids are cached across runs, keyed on
+        # a hash of their content and of the parameters they were made with
+        cache_folder = self.parameterAsString(parameters, self.CACHEFOLDER, context)
+        cache = RasterCache(cache_folder, self.parameterAsInt(parameters, self.CACHESIZE, context) * 1024 * 1024) if cache_folder else None
+        
+        # the memory budget chooses the window size, the number of workers and
+        # which intermediate files are kept in memory, the plan is reported
+        # before the run starts
+        input_dem_dataset = gdal.Open(input_dem)
+        lakes_source = self.parameterAsSource(parameters, self.INPUTLAKESLAYER, context)
+        intermediates_memory = None if parameters.get(self.INTERMEDIATESMEMORY) in (None, '') else self.parameterAsInt(parameters, self.INTERMEDIATESMEMORY, context)
+        plan = plan_memory(input_dem_dataset, lakes_source.featureCount(), self.memoryBudget(parameters, context),
+                           self.parameterAsInt(parameters, self.WORKERS, context), intermediates_memory)
+        for line in plan.describe(input_dem_dataset):
+            feedback.pushInfo(line)
+        intermediates.max_bytes = plan.intermediates_bytes
+        
+        # SAGA, the GDAL algorithms of the legacy output path and the worker
+        # processes of the measurement run as separate programs, so the files
+        # they read have to be on disk
+        filled_dem_bytes = raster_pixels(input_dem_dataset) * dem_value_bytes(input_dem_dataset)
+        sinks_filled_dem = intermediates.path('INPUT-DEM-SINKS-FILLED.tif', filled_dem_bytes, on_disk=fill_backend == 1 or not direct_burn_in or plan.workers > 1)
+        min_slope = self.parameterAsDouble(parameters, self.MINSLOPE, context)
+        if manifest is not None:
+            manifest.add_inputs(dem=file_signature(input_dem_layer.source()) + [dem_window], fill=[fill_backend, min_slope])
+        resumed_fill = None if manifest is None else manifest.completed('fill')
+        if incremental and resumed_fill is None:
+            raise QgsProcessingException(self.tr('The DEM or the sink fill parameters changed since the run in {}, it cannot be updated incrementally').format(manifest.folder))
+        fill_key = cached_fill = None
+        if cache is not None and resumed_fill is None:
+            with timer.stage('Sink fill cache lookup', raster_pixels(input_dem_dataset)):
+                fill_key = 'fill-' + raster_digest(input_dem_dataset, plan.window_pixels, fill_backend, min_slope)
+                cached_fill = cache.get(fill_key)
+        if resumed_fill is not None:
+            sinks_filled_dem = resumed_fill['files'][0]
+            feedback.pushInfo(self.tr('Resuming with the sink filled DEM {}').format(sinks_filled_dem))
+        elif cached_fill is not None:
+            sinks_filled_dem = cached_fill
+            feedback.pushInfo(self.tr('Using the cached sink filled DEM {}').format(cached_fill))
+        else:
+            with timer.stage('Sink fill', raster_pixels(input_dem_dataset), profile=True):
+                if fill_backend == 1:
+                    # the Processing framework is only loaded for the SAGA backend
+                    from qgis import processing
+                    parameters_fill_sinks = {'DEM': input_dem, 'MINSLOPE': min_slope, 'RESULT': sinks_filled_dem}
+                    processing.run("saga:fillsinksplanchondarboux2001", parameters_fill_sinks)
+                else:
+                    fill_sinks(input_dem, sinks_filled_dem, min_slope, plan.fill_pixels, feedback)
+            if feedback.isCanceled():
+                return {}
+            if cache is not None:
+                sinks_filled_dem = cache.put(fill_key, sinks_filled_dem)
+        if manifest is not None and resumed_fill is None:
+            manifest.complete('fill', ('dem', 'fill'), files=[sinks_filled_dem])
+        
+        # burn every lake into one label grid aligned with the DEM and measure
+        # all lakes in a single pass, instead of clipping the DEM per lake
+        dem = gdal.Open(sinks_filled_dem)
+        unique_field_name = self.parameterAsFields(parameters, self.UNIQUEFIELDNAME, context)[0]
+        lakes_request = QgsFeatureRequest().setDestinationCrs(input_dem_layer.crs(), context.transformContext())
+        with timer.stage('Read lakes'):
+            lakes = self.readLakes(lakes_source, lakes_request, feedback, unique_field_name)
+        if feedback.isCanceled():
+            return {}
+        if incremental:
+            # lakes moved past the DEM window of the previous run need a larger
+            # window, which is sink filled again by a full run
+            if dem_window and lakes_outside(lakes, gdal.Open(input_dem_layer.source()), dem_window,
+                                            self.parameterAsInt(parameters, self.EXTENTBUFFER, context)):
+                feedback.pushInfo(self.tr('Lakes are outside the DEM window of the run in {}, flattening all lakes again').format(manifest.folder))
+                return self.flattenLakes(dict(parameters, **{self.INCREMENTAL: False}), context, feedback, intermediates, timer, manifest)
+            return self.updateLakes(parameters, context, feedback, timer, manifest, dem, lakes, dem_window)
+        
+        statistics_fields = self.lakeStatisticsFields(lakes_source, unique_field_name)
+        (lake_statistics, lake_statistics_id) = self.parameterAsSink(parameters, self.LAKESTATISTICS, context, statistics_fields, QgsWkbTypes.NoGeometry)
+        results = {self.LAKESTATISTICS: lake_statistics_id}
+        
+        # walk the DEM in the windows of the memory plan, the label grid goes
+        # to disk when the plan says so or when the manifest has to keep it
+        windows = list(block_windows(dem, plan.window_pixels))
+        labels_path = None if plan.labels_in_memory(dem) and manifest is None else intermediates.path('LAKE-LABELS.tif', raster_pixels(dem) * 4, on_disk=plan.workers > 1)
+        
+        started = time.perf_counter()
+        with timer.stage('Rasterize lakes', raster_pixels(dem)):
+            lakes_key = lakes_digest(lakes, dem)
+            resumed_labels = None
+            if manifest is not None:
+                manifest.add_inputs(lakes=lakes_key)
+                resumed_labels = manifest.completed('labels')
+            labels = None if cache is None or resumed_labels is not None else cache.get_labels('labels-' + lakes_key)
+            if resumed_labels is not None:
+                labels = LakeLabels(gdal.Open(resumed_labels['files'][0]), resumed_labels['lake_ids'])
+            elif labels is None:
+                labels = rasterize_lakes(dem, lakes, labels_path)
+                if cache is not None:
+                    labels = cache.put_labels('labels-' + lakes_key, labels)
+            if manifest is not None and resumed_labels is None:
+                manifest.complete('labels', ('dem', 'fill', 'lakes'), files=[labels.dataset.GetDescription()], lake_ids=labels.lake_ids)
+        
+        # only the DEM tiles holding lakes are measured, each one through the
+        # bounding window of its lakes and their boundary rings
+        measure_options = estimator.measure_options(lake_statistics is not None)
+        measure_windows = lake_tiles(dem, lakes, plan.window_pixels, measure_options['ring_width'] + 1)
+        
+        # the measurement is checkpointed in the manifest window by window
+        resume = checkpoint = None
+        if manifest is not None:
+            manifest.add_inputs(measure=signature(estimator.signature(), lake_statistics is not None, measure_windows))
+            resume = manifest.measure_resume(len(measure_windows))
+            checkpoint = manifest.measure_checkpoint(('dem', 'fill', 'lakes', 'measure'), len(measure_windows))
+        # while profiling, the windows are measured on the thread cProfile sees
+        with timer.stage('Measure lakes', sum(window[2] * window[3] for window in measure_windows), profile=True):
+            (zonal, pixel_counts, boundary_pixel_counts) = measure_lakes(dem, labels, measure_windows,
+                                                                         extremes=lake_statistics is not None,
+                                                                         count_pixels=lake_statistics is not None,
+                                                                         workers=1 if timer.stream_threads() else plan.workers,
+                                                                         threads=timer.stream_threads(),
+                                                                         feedback=feedback,
+                                                                         resume=resume,
+                                                                         checkpoint=checkpoint,
+                                                                         **measure_options)
+        if manifest is not None:
+            manifest.flush()
+        if feedback.isCanceled():
+            if manifest is not None:
+                feedback.pushInfo(self.tr('Canceled, the run can be resumed from {}').format(manifest.folder))
+            return {}
+        lake_elevations = estimator.elevations(labels.count, zonal)
+        if manifest is not None:
+            manifest.record_lakes(labels.lake_ids, lake_elevations, lake_geometry_hashes(lakes), lake_windows(lakes, dem))
+        
+        for label, lake_id in enumerate(labels.lake_ids, start=1):
+            QgsMessageLog.logMessage(str(lake_id) + ": " + str(lake_elevations[label]), self.name())
+        
+        if lake_statistics is not None:
+            with timer.stage('Lake statistics'):
+                for row in lake_statistics_rows(labels.lake_ids, pixel_counts, boundary_pixel_counts,
+                                                lake_elevations, zonal, time.perf_counter() - started):
+                    feature = QgsFeature(statistics_fields)
+                    feature.setAttributes(list(row))
+                    lake_statistics.addFeature(feature, QgsFeatureSink.FastInsert)
+                    if feedback.isCanceled():
+                        return {}
+        
+        if direct_burn_in:
+            output_dem = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+            with timer.stage('Burn in', raster_pixels(dem), profile=True):
+                burn_lake_elevations(dem, labels, lake_elevations, output_dem, windows,
+                                     base_path=input_dem_layer.source() if dem_window else None,
+                                     offset=dem_window[:2] if dem_window else (0, 0),
+                                     feedback=feedback,
+                                     scratch_path=intermediates.path('BURNED-DEM.tif', filled_dem_bytes),
+                                     stream_threads=timer.stream_threads(),
+                                     **self.outputFormat(parameters, context))
+            if feedback.isCanceled():
+                return {}
+            if manifest is not None:
+                manifest.complete('output', ('dem', 'fill', 'lakes', 'measure'), files=[output_dem], estimator=signature(estimator.signature()))
+            results[self.OUTPUT] = output_dem
+            return results
+        
+        # the polygonize/difference output path runs Processing algorithms
+        from qgis import processing
+        individuallakesfolder = intermediates.disk_folder()
+        result_merged_lake_elevation_files = os.path.join(individuallakesfolder, 'merged_lake_elevation_files.tif')
+        with timer.stage('Lake elevation raster', raster_pixels(dem)):
+            write_lake_elevation_raster(dem, labels, lake_elevations, result_merged_lake_elevation_files, windows)
+        dem = None
+        
+        input_raster_merged_lake_elevation_files = QgsRasterLayer(result_merged_lake_elevation_files, 'raster')
+        output_vector = os.path.splitext(result_merged_lake_elevation_files)[0] + "-polygon.shp"
+        parameters_raster_to_vector = {'INPUT' : input_raster_merged_lake_elevation_files, 'OUTPUT' : output_vector}
+        with timer.stage('Polygonize'):
+            processing.run('gdal:polygonize', parameters_raster_to_vector)
+        
+        
+        parameters_difference = {'INPUT' : parameters["INPUTAOI"], 'OVERLAY' : output_vector, 'OUTPUT' : os.path.join(individuallakesfolder, 'difference.shp')}
+        with timer.stage('Difference'):
+            processing.run('native:difference', parameters_difference)
+        
+        non_lakes = QgsVectorLayer(os.path.join(individuallakesfolder, 'difference.shp'))
+        parameters_for_clip_raster_by_mask_layer_2 ={'INPUT': sinks_filled_dem,'MASK': non_lakes, 'OUTPUT': os.path.join(individuallakesfolder, "DEM-NON-LAKES_REGIONS.tif")}
+        with timer.stage('Clip non-lake regions'):
+            processing.run('gdal:cliprasterbymasklayer', parameters_for_clip_raster_by_mask_layer_2, context=context, feedback=feedback) 
+        
+        final_dems_to_merge = []
+        final_dems_to_merge.append(os.path.join(individuallakesfolder, 'DEM-NON-LAKES_REGIONS.tif'))
+        final_dems_to_merge.append(result_merged_lake_elevation_files)
+        
+        vrt_file = os.path.join(individuallakesfolder, 'FINAL-DEM.vrt')
+        # the merged DEM is written once, straight in the output format
+        with timer.stage('Merge'):
+            vrt_2 = gdal.BuildVRT(vrt_file, final_dems_to_merge)
+            write_output(vrt_2, self.parameterAsOutputLayer(parameters, self.OUTPUT, context), **self.outputFormat(parameters, context))
+        
+        return results
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import itertools
+import os
+import shutil
+import uuid
+
+import numpy
+from osgeo import gdal
+
+from .streaming import stream_windows
+from .tiling import block_windows
+
+DEFAULT_NODATA = -9999.0
+
+OUTPUT_LAYOUTS = ('STRIPED', 'TILED', 'COG')
+OUTPUT_COMPRESSIONS = ('NONE', 'DEFLATE', 'ZSTD', 'LERC')
+
+
+def write_lake_elevation_raster(dem, labels, elevations, output_path, windows=None):
+    
+    """
+    Writes a Float32 GeoTIFF on the grid of the dem dataset in which every lake
+    pixel holds the elevation of its lake and every other pixel is nodata.
+    elevations is indexed by label, as returned by ZonalAccumulator.means().
+    The raster is written window by window (block rows by default), the
+    lookups overlapping with the reads and the writes (see stream_windows).
+    """
+    nodata = dem.GetRasterBand(1).GetNoDataValue()
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+
+    lookup = numpy.where(numpy.isnan(elevations), nodata, elevations).astype(numpy.float32)
+    lookup[0] = nodata
+
+    output = gdal.GetDriverByName('GTiff').Create(output_path, dem.RasterXSize, dem.RasterYSize, 1, gdal.GDT_Float32)
+    output.SetGeoTransform(dem.GetGeoTransform())
+    output.SetProjection(dem.GetProjection())
+    band = output.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    stream_windows(list(windows or _block_row_windows(dem)),
+                   lambda window: labels.read(*window),
+                   lambda window, window_labels: lookup[window_labels],
+                   lambda window, data: band.WriteArray(data, window[0], window[1]))
+    band.FlushCache()
+    output = None
+
+
+def _block_row_windows(dataset, minimum_rows=256):
+    block_rows = dataset.GetRasterBand(1).GetBlockSize()[1]
+    rows = block_rows * max(1, minimum_rows // block_rows)
+    return block_windows(dataset, dataset.RasterXSize * rows)
+
+
+def band_dataset(dem_path, band, path):
+    
+    """
+    Writes a VRT at path that exposes band number band of a multi-band DEM
+    as a single band raster. No pixels are copied.
+    """
+    gdal.Translate(path, dem_path, format='VRT', bandList=[band])
+    return path
+
+
+def window_dataset(dem_path, window, path):
+    
+    """
+    Writes a VRT at path that exposes only a (xoff, yoff, xsize, ysize) window
+    of the DEM. No pixels are copied, the VRT reads them from the DEM itself.
+    """
+    gdal.Translate(path, dem_path, format='VRT', srcWin=list(window))
+    return path
+
+
+def write_world_file(raster_path, geotransform):
+    
+    """
+    Writes the .tfw world file of a raster (which refers to the centre of the
+    upper left pixel, unlike the GDAL geotransform).
+    """
+    origin_x, pixel_width, rotation_x, origin_y, rotation_y, pixel_height = geotransform
+    with open(os.path.splitext(raster_path)[0] + '.tfw', 'w') as world_file:
+        for value in (pixel_width, rotation_y, rotation_x, pixel_height,
+                      origin_x + pixel_width / 2.0 + rotation_x / 2.0,
+                      origin_y + rotation_y / 2.0 + pixel_height / 2.0):
+            world_file.write(repr(float(value)) + '\n')
+
+
+def plain_geotiff(dataset):
+    
+    """
+    Tells whether dataset is a GeoTIFF that can be updated in place: not
+    compressed, without overviews (left stale by an update) and not a cloud
+    optimized GeoTIFF (whose layout an update breaks).
+    """
+    return (dataset.GetDriver().ShortName == 'GTiff' and dataset.GetRasterBand(1).GetOverviewCount() == 0 and
+            dataset.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') is None and
+            dataset.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') != 'COG')
+
+
+def pass_through_copy(source_path, output_path, data_type=None):
+    
+    """
+    Copies a raster to a GeoTIFF of data_type (the type of the raster by
+    default) with a world file and returns the copy opened for update. A
+    plain GeoTIFF (see plain_geotiff) of data_type going to a .tif is copied
+    byte for byte, without decoding it; any other raster is translated,
+    leaving out its overviews and compression.
+    """
+    source = gdal.Open(source_path)
+    if data_type is None:
+        data_type = source.GetRasterBand(1).DataType
+    if (plain_geotiff(source) and source.GetRasterBand(1).DataType == data_type and
+            os.path.splitext(output_path)[1].lower() in ('.tif', '.tiff')):
+        shutil.copyfile(source_path, output_path)
+    else:
+        gdal.Translate(output_path, source, format='GTiff', outputType=data_type, creationOptions=['BIGTIFF=IF_SAFER'])
+    write_world_file(output_path, source.GetGeoTransform())
+    return gdal.Open(output_path, gdal.GA_Update)
+
+
+def _typed_base(base_path, data_type, path):
+    # base_path, or a VRT of it at path reading it as data_type, so that a
+    # mosaic of it and a burned window of data_type keeps the burned values
+    base = gdal.Open(base_path)
+    if base.GetRasterBand(1).DataType == data_type:
+        return base_path
+    gdal.Translate(path, base, format='VRT', outputType=data_type)
+    return path
+
+
+def output_format(data_type, layout='STRIPED', compression='NONE', threads=0):
+    
+    """
+    Returns the GDAL driver and creation options of an output DEM of
+    data_type: a striped GeoTIFF (the layout the scripts always wrote), a
+    GeoTIFF of 512 x 512 tiles, or a cloud optimized GeoTIFF (tiled, with
+    internal overviews). DEFLATE and ZSTD use a predictor (the floating point
+    one for float bands), LERC is lossless. Blocks are compressed on threads
+    threads, 0 meaning all CPUs.
+    """
+    options = ['BIGTIFF=IF_SAFER']
+    if compression != 'NONE':
+        options.append('COMPRESS=' + compression)
+        if compression in ('DEFLATE', 'ZSTD'):
+            if layout == 'COG':
+                options.append('PREDICTOR=YES')
+            else:
+                options.append('PREDICTOR=' + ('3' if gdal.GetDataTypeName(data_type).startswith('Float') else '2'))
+        options.append('NUM_THREADS=' + (str(threads) if threads > 0 else 'ALL_CPUS'))
+    if layout == 'COG':
+        # the COG driver compresses with LZW unless told otherwise
+        if compression == 'NONE':
+            options.append('COMPRESS=NONE')
+        return 'COG', options + ['BLOCKSIZE=512', 'OVERVIEWS=AUTO']
+    if layout == 'TILED':
+        options += ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+    return 'GTiff', options
+
+
+def write_output(source, output_path, layout='STRIPED', compression='NONE', threads=0):
+    
+    """
+    Writes a raster (a dataset or a path, typically a VRT assembling the
+    result) to output_path in a single pass, in the output format, together
+    with a world file.
+    """
+    if not isinstance(source, gdal.Dataset):
+        source = gdal.Open(source)
+    (driver, options) = output_format(source.GetRasterBand(1).DataType, layout, compression, threads)
+    gdal.Translate(output_path, source, format=driver, creationOptions=options)
+    write_world_file(output_path, source.GetGeoTransform())
+
+
+def burn_lookup(elevations, data_type):
+    
+    """
+    Returns the elevation lookup (indexed by label) to burn into a band of
+    data_type, rounded for integer bands, and the mask of the labels that are
+    burned: every lake with an elevation, never the background.
+    """
+    lookup = numpy.asarray(elevations, dtype=numpy.float64)
+    burn = ~numpy.isnan(lookup)
+    burn[0] = False
+    if gdal.GetDataTypeName(data_type).startswith(('Byte', 'Int', 'UInt')):
+        lookup = numpy.round(lookup)
+    return lookup, burn
+
+
+def burn_lake_elevations(dem, labels, elevations, output_path, windows=None, base_path=None, offset=(0, 0), feedback=None,
+                         layout='STRIPED', compression='NONE', threads=0, scratch_path=None, stream_threads=0):
+    
+    """
+    Copies the dem dataset to a GeoTIFF (with a world file) in a single pass
+    and overwrites every lake pixel with the elevation of its lake on the way.
+    elevations is indexed by label; lakes whose elevation is NaN keep their
+    original DEM values. The copy is made window by window (block rows by
+    default), so memory use is bounded by the window size times
+    windows_in_flight(). The lookups overlap with the reads and the writes
+    (see stream_windows).
+
+    When dem only covers a window of a larger DEM at base_path, the output is
+    a pass-through copy of base_path and only the window at offset (the pixel
+    offset of dem within it) is rewritten. The output always has the data
+    type of dem, so that the burned values are not truncated into the type
+    of an integer base_path. Progress and cancellation go
+    through the optional QGIS feedback object.
+
+    layout, compression and threads select the output format (see
+    output_format); stream_threads are the compute threads of the copy (see
+    stream_windows). The output is written once in every format: a GeoTIFF
+    of the whole dem directly, otherwise the burned window goes to a scratch
+    GeoTIFF at scratch_path (in /vsimem by default) and a VRT of it over
+    base_path is translated to the output. An output_path ending in .vrt
+    with a base_path is such a VRT itself, drawing the burned window (kept
+    next to it as <name>-lakes.tif) over base_path (read through
+    <name>-base.vrt when its data type differs), so only the window is
+    written.
+    """
+    burn_epoch_elevations([dem], labels, [elevations], [output_path], windows, [base_path], offset, feedback,
+                          layout, compression, threads, [scratch_path], stream_threads)
+
+
+def _create_burned_output(dem, output_path, base_path, offset, layout, compression, threads, scratch_path):
+    # opens the dataset the burned windows of dem go to, see
+    # burn_lake_elevations, and returns it with the offset of dem in it, the
+    # scratch GeoTIFF (None when the output is written directly) and whether
+    # the output is a .vrt overlay
+    source_band = dem.GetRasterBand(1)
+    xsize, ysize = dem.RasterXSize, dem.RasterYSize
+    (driver, options) = output_format(source_band.DataType, layout, compression, threads)
+    plain = layout == 'STRIPED' and compression == 'NONE'
+    overlay = base_path is not None and os.path.splitext(output_path)[1].lower() == '.vrt'
+
+    if base_path is not None and plain and not overlay:
+        return pass_through_copy(base_path, output_path, source_band.DataType), offset, None, overlay
+    if base_path is None and driver == 'GTiff':
+        scratch_path = None
+        output = gdal.GetDriverByName('GTiff').Create(output_path, xsize, ysize, 1, source_band.DataType, options=options + ['TFW=YES'])
+    elif overlay:
+        scratch_path = os.path.splitext(output_path)[0] + '-lakes.tif'
+        output = gdal.GetDriverByName('GTiff').Create(scratch_path, xsize, ysize, 1, source_band.DataType,
+                                                      options=output_format(source_band.DataType, 'TILED', compression, threads)[1])
+        offset = (0, 0)
+    else:
+        scratch_path = scratch_path or '/vsimem/burned-{}.tif'.format(uuid.uuid4().hex)
+        output = gdal.GetDriverByName('GTiff').Create(scratch_path, xsize, ysize, 1, source_band.DataType, options=['BIGTIFF=IF_SAFER'])
+        offset = (0, 0)
+    output.SetGeoTransform(dem.GetGeoTransform())
+    output.SetProjection(dem.GetProjection())
+    if source_band.GetNoDataValue() is not None:
+        output.GetRasterBand(1).SetNoDataValue(source_band.GetNoDataValue())
+    return output, offset, scratch_path, overlay
+
+
+def finish_burned_output(output_path, base_path, scratch_path, overlay, canceled, layout, compression, threads):
+    
+    """
+    Turns the closed scratch GeoTIFF of a burned window into the output,
+    drawn over base_path (see burn_lake_elevations), unless canceled. The
+    output has the data type of the scratch GeoTIFF whatever the type of
+    base_path. Nothing is left to do for a scratch_path of None, an output
+    written directly.
+    """
+    if scratch_path is None:
+        return
+    if overlay:
+        if not canceled:
+            data_type = gdal.Open(scratch_path).GetRasterBand(1).DataType
+            base = _typed_base(base_path, data_type, os.path.splitext(output_path)[0] + '-base.vrt')
+            # later sources of a VRT are drawn over the earlier ones
+            mosaic = gdal.BuildVRT(output_path, [base, scratch_path])
+            mosaic = None
+        return
+    if not canceled:
+        if base_path is None:
+            write_output(scratch_path, output_path, layout, compression, threads)
+        else:
+            data_type = gdal.Open(scratch_path).GetRasterBand(1).DataType
+            base = _typed_base(base_path, data_type, scratch_path + '-base.vrt')
+            # later sources of a VRT are drawn over the earlier ones
+            mosaic = gdal.BuildVRT(scratch_path + '.vrt', [base, scratch_path])
+            write_output(mosaic, output_path, layout, compression, threads)
+            mosaic = None
+            gdal.Unlink(scratch_path + '.vrt')
+            if base != base_path:
+                gdal.Unlink(base)
+    gdal.Unlink(scratch_path)
+
+
+def burn_epoch_elevations(dems, labels, elevations, output_paths, windows=None, base_paths=None, offset=(0, 0), feedback=None,
+                          layout='STRIPED', compression='NONE', threads=0, scratch_paths=None, stream_threads=0):
+    
+    """
+    Burns the lakes into several DEM datasets on the grid of the label grid
+    (the epochs or bands of a DEM stack) in a single sweep: every window of
+    the label grid is read once and burned into that window of every DEM.
+    elevations[i] holds the elevations of dems[i], indexed by label. Each
+    DEM is written like burn_lake_elevations does, to output_paths[i] over
+    base_paths[i] through scratch_paths[i] (both lists default to None for
+    every DEM).
+    """
+    base_paths = base_paths or [None] * len(dems)
+    scratch_paths = scratch_paths or [None] * len(dems)
+    outputs = [_create_burned_output(dem, output_path, base_path, offset, layout, compression, threads, scratch_path)
+               for dem, output_path, base_path, scratch_path in zip(dems, output_paths, base_paths, scratch_paths)]
+    output_bands = [output[0].GetRasterBand(1) for output in outputs]
+    lookups = [burn_lookup(epoch_elevations, output_band.DataType) for epoch_elevations, output_band in zip(elevations, output_bands)]
+    source_bands = [dem.GetRasterBand(1) for dem in dems]
+
+    windows = list(windows or _block_row_windows(dems[0]))
+    written = itertools.count(1)
+
+    def read_window(window):
+        return labels.read(*window), [source_band.ReadAsArray(*window) for source_band in source_bands]
+
+    def burn_window(window, read):
+        (window_labels, stack) = read
+        for data, (lookup, burn) in zip(stack, lookups):
+            lake_pixels = burn[window_labels]
+            data[lake_pixels] = lookup[window_labels[lake_pixels]]
+        return stack
+
+    def write_window(window, stack):
+        for data, output_band, output in zip(stack, output_bands, outputs):
+            output_band.WriteArray(data, window[0] + output[1][0], window[1] + output[1][1])
+        if feedback is not None:
+            feedback.setProgress(100.0 * next(written) / len(windows))
+
+    if feedback is None or not feedback.isCanceled():
+        stream_windows(windows, read_window, burn_window, write_window, stream_threads,
+                       canceled=None if feedback is None else feedback.isCanceled)
+
+    for output_band in output_bands:
+        output_band.FlushCache()
+    canceled = feedback is not None and feedback.isCanceled()
+    finished = [(output_path, base_path, output[2], output[3]) for output_path, base_path, output in zip(output_paths, base_paths, outputs)]
+    output_bands = outputs = None
+    for (output_path, base_path, scratch_path, overlay) in finished:
+        finish_burned_output(output_path, base_path, scratch_path, overlay, canceled, layout, compression, threads)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Spatial index over the lakes. The lake envelopes are turned into pixel
+windows of the DEM and packed into an R-tree, so that a pass over the DEM
+only reads the tiles that hold lakes, and within a tile only the bounding
+window of its lakes.
+"""
+
+
+import math
+
+import numpy
+from osgeo import ogr
+
+from .tiling import block_windows, extent_window
+
+# tiles of the lake measurement are at most this many pixels, so that the
+# pixels read stay close to the area of the lakes on DEMs that fit in memory
+LAKE_TILE_PIXELS = 4 * 1024 * 1024
+
+
+def lake_windows(lakes, dem, halo=0):
+    
+    """
+    Returns a dict from lake id to the (xoff, yoff, xsize, ysize) pixel window
+    of the dem dataset covering the envelope of that lake, grown by halo
+    pixels, or None for lakes outside the DEM. lakes is a list of
+    (lake_id, wkb) pairs in the coordinate system of the DEM.
+    """
+    envelopes = {}
+    for lake_id, wkb in lakes:
+        geometry = ogr.CreateGeometryFromWkb(bytes(wkb))
+        if geometry is None or geometry.IsEmpty():
+            continue
+        (xmin, xmax, ymin, ymax) = geometry.GetEnvelope()
+        if lake_id in envelopes:
+            (xmin, ymin) = (min(xmin, envelopes[lake_id][0]), min(ymin, envelopes[lake_id][1]))
+            (xmax, ymax) = (max(xmax, envelopes[lake_id][2]), max(ymax, envelopes[lake_id][3]))
+        envelopes[lake_id] = (xmin, ymin, xmax, ymax)
+    return {lake_id: extent_window(dem, envelope, halo, snap_to_blocks=False) for lake_id, envelope in envelopes.items()}
+
+
+class EnvelopeIndex:
+
+    """
+    A static R-tree over (xoff, yoff, xsize, ysize) windows, packed with the
+    Sort-Tile-Recursive method: the windows are sorted into vertical slices
+    by their centre column, then by their centre row within a slice, and
+    every node_capacity consecutive entries of a level share a node of the
+    level above.
+    """
+
+    def __init__(self, windows, node_capacity=16):
+        boxes = numpy.array([(xoff, yoff, xoff + xsize, yoff + ysize) for xoff, yoff, xsize, ysize in windows],
+                            dtype=numpy.int64).reshape(-1, 4)
+        self.boxes = boxes
+        self.node_capacity = node_capacity
+        centres = boxes[:, :2] + boxes[:, 2:]
+        order = numpy.argsort(centres[:, 0], kind='stable')
+        slice_size = node_capacity * max(1, math.ceil(math.sqrt(math.ceil(len(boxes) / float(node_capacity)))))
+        self._order = order[numpy.lexsort((centres[order, 1], numpy.arange(len(boxes)) // slice_size))]
+        self._levels = [boxes[self._order]]
+        while len(self._levels[-1]) > node_capacity:
+            level = self._levels[-1]
+            starts = numpy.arange(0, len(level), node_capacity)
+            self._levels.append(numpy.column_stack((numpy.minimum.reduceat(level[:, 0], starts),
+                                                    numpy.minimum.reduceat(level[:, 1], starts),
+                                                    numpy.maximum.reduceat(level[:, 2], starts),
+                                                    numpy.maximum.reduceat(level[:, 3], starts))))
+
+    def __len__(self):
+        return len(self._order)
+
+    def query(self, window):
+        
+        """
+        Returns the sorted indices of the windows that overlap window, in the
+        order the windows were given.
+        """
+        (xoff, yoff, xsize, ysize) = window
+        candidates = numpy.arange(len(self._levels[-1]))
+        for depth in range(len(self._levels) - 1, -1, -1):
+            boxes = self._levels[depth][candidates]
+            hits = candidates[(boxes[:, 0] < xoff + xsize) & (xoff < boxes[:, 2]) & (boxes[:, 1] < yoff + ysize) & (yoff < boxes[:, 3])]
+            if depth == 0:
+                return numpy.sort(self._order[hits])
+            candidates = (hits[:, numpy.newaxis] * self.node_capacity + numpy.arange(self.node_capacity)).ravel()
+            candidates = candidates[candidates < len(self._levels[depth - 1])]
+
+
+def lake_tiles(dem, lakes, max_pixels=None, halo=0):
+    
+    """
+    Returns the windows a pass over the lakes of the dem dataset has to read:
+    the DEM is cut into tiles of whole blocks (of at most max_pixels and
+    LAKE_TILE_PIXELS pixels), the lakes are grouped by the tiles their
+    envelope (grown by halo pixels) overlaps, and every tile holding lakes
+    gives one window, the bounding window of its lakes clipped to the tile.
+    Each block is thus decoded once, tiles without lakes are never read and
+    the pixels read depend on the size of the lakes rather than of the DEM.
+    Every lake pixel, and every pixel within halo of a lake, is in exactly
+    one window.
+    """
+    windows = [window for window in lake_windows(lakes, dem, halo).values() if window is not None]
+    if not windows:
+        return []
+    index = EnvelopeIndex(windows)
+    boxes = index.boxes
+    tiles = []
+    for (xoff, yoff, xsize, ysize) in block_windows(dem, min(max_pixels or LAKE_TILE_PIXELS, LAKE_TILE_PIXELS)):
+        hits = index.query((xoff, yoff, xsize, ysize))
+        if not len(hits):
+            continue
+        left, top = max(xoff, int(boxes[hits, 0].min())), max(yoff, int(boxes[hits, 1].min()))
+        right, bottom = min(xoff + xsize, int(boxes[hits, 2].max())), min(yoff + ysize, int(boxes[hits, 3].max()))
+        tiles.append((left, top, right - left, bottom - top))
+    return tiles
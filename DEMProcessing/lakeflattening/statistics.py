@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import numpy
+
+# columns of the per-lake statistics table, with the kind of value they hold
+STATISTICS_FIELDS = (('LAKE_ID', 'id'),
+                     ('PIXEL_COUNT', 'int'),
+                     ('BOUNDARY_PIXEL_COUNT', 'int'),
+                     ('ELEVATION', 'float'),
+                     ('MEAN_ELEVATION', 'float'),
+                     ('MIN_ELEVATION', 'float'),
+                     ('MAX_ELEVATION', 'float'),
+                     ('PROCESSING_TIME', 'float'))
+
+
+def label_counts(labels, lake_count):
+    
+    """
+    Returns the number of pixels of every lake in a label grid, indexed by
+    label. The background (index 0) is not counted, which spares bincount
+    most of the pixels of a boundary ring.
+    """
+    return numpy.bincount(labels[labels > 0], minlength=lake_count + 1)
+
+
+def lake_statistics_rows(lake_ids, pixel_counts, boundary_pixel_counts, elevations, zonal, seconds):
+    
+    """
+    Yields one row per lake, in the column order of STATISTICS_FIELDS.
+    elevations holds the level each lake was flattened to and zonal is the
+    ZonalAccumulator over the pixels that level was estimated from. The lakes
+    are processed together in one vectorized pass, so the seconds spent on that
+    pass are shared out between them in proportion to their pixel count.
+    Missing values are returned as None.
+    """
+    means = zonal.means()
+    minimums = zonal.minimums()
+    maximums = zonal.maximums()
+    total_pixels = max(int(pixel_counts[1:].sum()), 1)
+
+    def value(array, label):
+        return None if numpy.isnan(array[label]) else float(array[label])
+
+    for label, lake_id in enumerate(lake_ids, start=1):
+        yield (lake_id,
+               int(pixel_counts[label]),
+               int(boundary_pixel_counts[label]),
+               value(elevations, label),
+               value(means, label),
+               value(minimums, label),
+               value(maximums, label),
+               seconds * float(pixel_counts[label]) / total_pixels)
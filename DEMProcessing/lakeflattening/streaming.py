@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Overlapped window processing. Reading a window (GDAL decoding), working on
+it (numpy, which releases the GIL) and writing the result (GDAL encoding)
+run at the same time on different windows, instead of one after another.
+"""
+
+
+import os
+import queue
+import threading
+
+# compute threads of a stream by default
+STREAM_THREADS = min(4, os.cpu_count() or 1)
+
+
+def windows_in_flight(threads=0):
+    
+    """
+    Returns how many windows stream_windows holds in memory at most with
+    threads compute threads: one per thread, as many waiting in the queue
+    and the one being written. Memory budgets are shared by that many
+    windows.
+    """
+    return 2 * (threads or STREAM_THREADS) + 1
+
+
+def stream_windows(windows, read, compute, write, threads=0, canceled=None):
+    
+    """
+    Runs read(window) for every window on a reader thread, compute(window,
+    data) on a pool of threads compute threads and write(window, result) on
+    the calling thread, in window order. The queue between them holds
+    threads windows, so a slow writer holds back the reader instead of
+    filling the memory. Every GDAL dataset is only used by one thread: read
+    uses the inputs and write the outputs.
+
+    threads 1 runs the three stages one after another on the calling thread
+    instead, which is what a profiler of that thread needs to see them.
+
+    Stops early when canceled() returns True. Errors of any stage are raised
+    on the calling thread. Returns the number of windows written.
+    """
+    if threads == 1:
+        written = 0
+        for window in windows:
+            write(window, compute(window, read(window)))
+            written += 1
+            if canceled is not None and canceled():
+                break
+        return written
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    threads = threads or STREAM_THREADS
+    pending = queue.Queue(maxsize=threads)
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+
+        def reader():
+            try:
+                for window in windows:
+                    if stop.is_set():
+                        break
+                    pending.put((window, pool.submit(compute, window, read(window))))
+            except BaseException as error:
+                pending.put((None, error))
+            else:
+                pending.put((None, None))
+
+        thread = threading.Thread(target=reader, name='stream-reader', daemon=True)
+        thread.start()
+        written = 0
+        try:
+            while True:
+                (window, result) = pending.get()
+                if window is None:
+                    if result is not None:
+                        raise result
+                    break
+                write(window, result.result())
+                written += 1
+                if canceled is not None and canceled():
+                    break
+        finally:
+            # unblock the reader if it is waiting on a full queue, and drop
+            # the windows it read ahead
+            stop.set()
+            while thread.is_alive() or not pending.empty():
+                try:
+                    (window, result) = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if window is not None:
+                    result.cancel()
+            thread.join()
+    return written
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import math
+
+# rough working memory per pixel of a window: the DEM values as float64, the
+# label grid, the boundary ring and the temporaries of the numpy reductions
+WORKING_BYTES_PER_PIXEL = 40
+
+
+def pixels_for_budget(memory_budget_mb, workers=1, bytes_per_pixel=WORKING_BYTES_PER_PIXEL):
+    
+    """
+    Returns how many pixels one window may hold under a memory budget in
+    megabytes that is shared by the windows of all workers, or None when the
+    budget is 0 (no limit).
+    """
+    if not memory_budget_mb:
+        return None
+    return max(1, int(memory_budget_mb * 1024 * 1024) // (bytes_per_pixel * max(1, workers)))
+
+
+def fits_in_memory(dataset, max_pixels):
+    return max_pixels is None or dataset.RasterXSize * dataset.RasterYSize <= max_pixels
+
+
+def same_grid(dataset, other):
+    
+    """
+    Returns whether two datasets share one grid: the same size, geotransform
+    and coordinate system, so that their pixels line up one to one.
+    """
+    return ((dataset.RasterXSize, dataset.RasterYSize, tuple(dataset.GetGeoTransform()), dataset.GetProjection()) ==
+            (other.RasterXSize, other.RasterYSize, tuple(other.GetGeoTransform()), other.GetProjection()))
+
+
+def block_windows(dataset, max_pixels=None):
+    
+    """
+    Yields (xoff, yoff, xsize, ysize) windows that cover the dataset, made of
+    whole native blocks of its first band so that every block is decoded once.
+    Full-width strips of block rows are used whenever one block row fits in
+    max_pixels, otherwise runs of blocks along a block row. A window is never
+    smaller than one block.
+    """
+    xsize, ysize = dataset.RasterXSize, dataset.RasterYSize
+    if fits_in_memory(dataset, max_pixels):
+        yield (0, 0, xsize, ysize)
+        return
+
+    block_xsize, block_ysize = dataset.GetRasterBand(1).GetBlockSize()
+    block_row_pixels = xsize * block_ysize
+    if block_row_pixels <= max_pixels:
+        rows = block_ysize * (max_pixels // block_row_pixels)
+        for yoff in range(0, ysize, rows):
+            yield (0, yoff, xsize, min(rows, ysize - yoff))
+        return
+
+    columns = block_xsize * max(1, max_pixels // (block_xsize * block_ysize))
+    for yoff in range(0, ysize, block_ysize):
+        for xoff in range(0, xsize, columns):
+            yield (xoff, yoff, min(columns, xsize - xoff), min(block_ysize, ysize - yoff))
+
+
+def expand_window(dataset, window, halo):
+    
+    """
+    Grows a window by halo pixels on every side, clipped to the dataset.
+    Returns the grown window and the (rows, columns) slices that crop an
+    array read with it back to the original window.
+    """
+    xoff, yoff, xsize, ysize = window
+    left = min(halo, xoff)
+    top = min(halo, yoff)
+    right = min(halo, dataset.RasterXSize - xoff - xsize)
+    bottom = min(halo, dataset.RasterYSize - yoff - ysize)
+    grown = (xoff - left, yoff - top, xsize + left + right, ysize + top + bottom)
+    return grown, (slice(top, top + ysize), slice(left, left + xsize))
+
+
+def extent_window(dataset, extent, buffer_pixels=0, snap_to_blocks=True):
+    
+    """
+    Returns the (xoff, yoff, xsize, ysize) window of the dataset that covers an
+    extent (xmin, ymin, xmax, ymax) in its coordinate system, grown by
+    buffer_pixels and snapped outwards to whole native blocks (unless
+    snap_to_blocks is False). Returns None
+    when the extent does not overlap the dataset. Rotated grids always get
+    the whole dataset.
+    """
+    xsize, ysize = dataset.RasterXSize, dataset.RasterYSize
+    origin_x, pixel_width, rotation_x, origin_y, rotation_y, pixel_height = dataset.GetGeoTransform()
+    if rotation_x or rotation_y:
+        return (0, 0, xsize, ysize)
+
+    xmin, ymin, xmax, ymax = extent
+    columns = sorted(((xmin - origin_x) / pixel_width, (xmax - origin_x) / pixel_width))
+    rows = sorted(((ymax - origin_y) / pixel_height, (ymin - origin_y) / pixel_height))
+    left = max(0, math.floor(columns[0]) - buffer_pixels)
+    right = min(xsize, math.ceil(columns[1]) + buffer_pixels)
+    top = max(0, math.floor(rows[0]) - buffer_pixels)
+    bottom = min(ysize, math.ceil(rows[1]) + buffer_pixels)
+    if left >= right or top >= bottom:
+        return None
+    if not snap_to_blocks:
+        return (left, top, right - left, bottom - top)
+
+    block_xsize, block_ysize = dataset.GetRasterBand(1).GetBlockSize()
+    left = (left // block_xsize) * block_xsize
+    top = (top // block_ysize) * block_ysize
+    right = min(xsize, -(-right // block_xsize) * block_xsize)
+    bottom = min(ysize, -(-bottom // block_ysize) * block_ysize)
+    return (left, top, right - left, bottom - top)
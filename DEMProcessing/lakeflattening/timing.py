@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def _io_counters():
+    # bytes read and written by this process so far (GDAL's own file access
+    # included), or None where neither /proc nor psutil can tell
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io.read().splitlines() if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    # psutil is only imported where there is no /proc (macOS, Windows)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (AttributeError, psutil.Error):
+        return None
+
+
+def raster_pixels(dataset):
+    return dataset.RasterXSize * dataset.RasterYSize
+
+
+class StageTimer:
+
+    """
+    Records the stages of a run: wall time, bytes read and written by this
+    process, and the pixel count the stage reports. Every finished stage is
+    pushed to feedback; write_trace() saves them all as a Chrome trace
+    (chrome://tracing, Perfetto). With a profile_path, the stages opened with
+    profile=True are run under cProfile and dumped there by write_profile();
+    they run their windows on the calling thread then (see stream_threads).
+    """
+
+    def __init__(self, feedback=None, profile_path=None):
+        self.feedback = feedback
+        self.profile_path = profile_path
+        self.stages = []
+        self._origin = time.perf_counter()
+        self._profiler = None
+        if profile_path:
+            import cProfile
+            self._profiler = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def stage(self, name, pixels=0, profile=False):
+        
+        """
+        Times the body of a with statement as the stage name. The yielded
+        record is a dict whose 'pixels' entry the body may update.
+        """
+        record = {'name': name, 'pixels': pixels, 'bytes_read': None, 'bytes_written': None}
+        io_before = _io_counters()
+        started = time.perf_counter()
+        profiler = self._profiler if profile else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            finished = time.perf_counter()
+            io_after = _io_counters()
+            if io_before is not None and io_after is not None:
+                record['bytes_read'] = io_after[0] - io_before[0]
+                record['bytes_written'] = io_after[1] - io_before[1]
+            record.update(start=started - self._origin, seconds=finished - started, thread=threading.get_ident())
+            self.stages.append(record)
+            if self.feedback is not None:
+                self.feedback.pushInfo(self.describe(record))
+
+    @staticmethod
+    def describe(record):
+        text = '{}: {:.3f} s'.format(record['name'], record['seconds'])
+        if record['pixels']:
+            text += ', {} pixels ({:.1f} Mpixels/s)'.format(record['pixels'], record['pixels'] / 1e6 / max(record['seconds'], 1e-9))
+        if record['bytes_read'] is not None:
+            text += ', {:.1f} MB read, {:.1f} MB written'.format(record['bytes_read'] / 1048576.0, record['bytes_written'] / 1048576.0)
+        return text
+
+    def total_seconds(self):
+        return sum(record['seconds'] for record in self.stages)
+
+    def write_trace(self, path):
+        
+        """
+        Writes the stages as complete events of the Chrome trace event format.
+        """
+        events = [{'name': record['name'], 'cat': 'stage', 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+                   'ts': round(record['start'] * 1e6), 'dur': round(record['seconds'] * 1e6),
+                   'args': {'pixels': record['pixels'], 'bytes_read': record['bytes_read'], 'bytes_written': record['bytes_written']}}
+                  for record in self.stages]
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace, indent=1)
+        return path
+
+    def stream_threads(self):
+        
+        """
+        Returns the compute threads for the streams of the profiled stages:
+        1 while profiling, since cProfile only sees the calling thread, and
+        0 (STREAM_THREADS) otherwise.
+        """
+        return 0 if self._profiler is None else 1
+
+    def write_profile(self):
+        
+        """
+        Dumps the cProfile statistics of the profiled stages to profile_path
+        (readable with pstats or snakeviz) and returns the path, or None when
+        profiling is off.
+        """
+        if self._profiler is None:
+            return None
+        self._profiler.dump_stats(self.profile_path)
+        return self.profile_path
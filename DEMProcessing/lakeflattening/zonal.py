@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import numpy
+
+
+def valid_pixels(values, labels, nodata=None):
+    
+    """
+    Returns a boolean mask of the pixels that are inside a lake and hold a
+    usable elevation value.
+    """
+    valid = labels > 0
+    if numpy.issubdtype(values.dtype, numpy.floating):
+        valid &= numpy.isfinite(values)
+    if nodata is not None:
+        valid &= values != nodata
+    return valid
+
+
+class ZonalAccumulator:
+
+    """
+    Accumulates per-lake sums and pixel counts with numpy.bincount, so the
+    cost of a pass depends on the number of pixels and not on the number of
+    lakes. Windows of the same DEM can be added one after another. With
+    extremes=True the per-lake minimum and maximum are tracked as well, with
+    unbuffered numpy.minimum.at and numpy.maximum.at reductions (no sort).
+
+    With keep_values=True the values of the lake pixels are kept (12 bytes per
+    pixel) for the order statistics: medians(), percentiles(),
+    trimmed_means() and modes() sort all of them once by label and value and
+    reduce every lake at the same time.
+    """
+
+    def __init__(self, lake_count, extremes=False, keep_values=False):
+        self.lake_count = lake_count
+        self.extremes = extremes
+        self.keep_values = keep_values
+        self.sums = numpy.zeros(lake_count + 1, dtype=numpy.float64)
+        self.counts = numpy.zeros(lake_count + 1, dtype=numpy.int64)
+        self.mins = numpy.full(lake_count + 1, numpy.inf)
+        self.maxs = numpy.full(lake_count + 1, -numpy.inf)
+        self.value_labels = []
+        self.values = []
+        self._values_sorted = False
+
+    def add(self, values, labels, nodata=None):
+        valid = valid_pixels(values, labels, nodata)
+        lake_labels = labels[valid]
+        lake_values = values[valid].astype(numpy.float64)
+        self.sums += numpy.bincount(lake_labels, weights=lake_values, minlength=self.lake_count + 1)
+        self.counts += numpy.bincount(lake_labels, minlength=self.lake_count + 1)
+        if self.keep_values:
+            self.value_labels.append(lake_labels.astype(numpy.int32))
+            self.values.append(lake_values)
+            self._values_sorted = False
+
+        if self.extremes:
+            numpy.minimum.at(self.mins, lake_labels, lake_values)
+            numpy.maximum.at(self.maxs, lake_labels, lake_values)
+
+    def merge(self, other):
+        
+        """
+        Adds the totals of another accumulator over the same lakes, for
+        example one filled from a different window in a worker process.
+        """
+        self.sums += other.sums
+        self.counts += other.counts
+        numpy.minimum(self.mins, other.mins, out=self.mins)
+        numpy.maximum(self.maxs, other.maxs, out=self.maxs)
+        if other.values:
+            self.value_labels.extend(other.value_labels)
+            self.values.extend(other.values)
+            self._values_sorted = False
+
+    def unstack(self, parts):
+        
+        """
+        Splits an accumulator over parts stacked groups of lakes, in which
+        lake label of group part has the label part * (lake_count + 1) + label
+        (the layout measure_epochs reduces the epochs of a DEM stack in), into
+        one accumulator per group.
+        """
+        lake_count = (self.lake_count + 1) // parts - 1
+        if self.keep_values:
+            (value_labels, values) = self.sorted_values()
+            bounds = numpy.searchsorted(value_labels, numpy.arange(parts + 1) * (lake_count + 1))
+        accumulators = []
+        for part in range(parts):
+            first = part * (lake_count + 1)
+            last = first + lake_count + 1
+            zonal = ZonalAccumulator(lake_count, self.extremes, self.keep_values)
+            zonal.sums = self.sums[first:last].copy()
+            zonal.counts = self.counts[first:last].copy()
+            zonal.mins = self.mins[first:last].copy()
+            zonal.maxs = self.maxs[first:last].copy()
+            if self.keep_values:
+                # still sorted by label and value
+                zonal.value_labels = [(value_labels[bounds[part]:bounds[part + 1]] - first).astype(numpy.int32)]
+                zonal.values = [values[bounds[part]:bounds[part + 1]]]
+                zonal._values_sorted = True
+            accumulators.append(zonal)
+        return accumulators
+
+    def means(self):
+        
+        """
+        Returns the mean value of every lake, indexed by label (index 0 is the
+        background and is always NaN, as are lakes without any valid pixel).
+        """
+        means = numpy.full(self.lake_count + 1, numpy.nan)
+        has_pixels = self.counts > 0
+        has_pixels[0] = False
+        means[has_pixels] = self.sums[has_pixels] / self.counts[has_pixels]
+        return means
+
+    def minimums(self):
+        return numpy.where(numpy.isinf(self.mins), numpy.nan, self.mins)
+
+    def maximums(self):
+        return numpy.where(numpy.isinf(self.maxs), numpy.nan, self.maxs)
+
+    def sorted_values(self):
+        
+        """
+        Returns the kept values of the lake pixels and their labels, sorted by
+        label and then by value, so that the values of lake label are
+        values[starts[label]:starts[label] + counts[label]] with
+        starts = cumsum(counts) - counts. The sorted arrays replace the
+        windows that were added, so the sort is only done once.
+        """
+        if not self.keep_values:
+            raise ValueError('The lake values were not kept, create the accumulator with keep_values=True')
+        if not self._values_sorted:
+            value_labels = numpy.concatenate(self.value_labels) if self.values else numpy.zeros(0, dtype=numpy.int32)
+            values = numpy.concatenate(self.values) if self.values else numpy.zeros(0, dtype=numpy.float64)
+            order = numpy.lexsort((values, value_labels))
+            self.value_labels, self.values = [value_labels[order]], [values[order]]
+            self._values_sorted = True
+        return self.value_labels[0], self.values[0]
+
+    def _lakes_with_pixels(self):
+        has_pixels = self.counts > 0
+        has_pixels[0] = False
+        return has_pixels
+
+    def percentiles(self, percent):
+        
+        """
+        Returns the percent percentile of the values of every lake, indexed by
+        label, interpolated linearly between the closest values like
+        numpy.percentile.
+        """
+        values = self.sorted_values()[1]
+        result = numpy.full(self.lake_count + 1, numpy.nan)
+        has_pixels = self._lakes_with_pixels()
+        starts = (numpy.cumsum(self.counts) - self.counts)[has_pixels]
+        positions = (self.counts[has_pixels] - 1) * (percent / 100.0)
+        below = numpy.floor(positions).astype(numpy.int64)
+        above = numpy.ceil(positions).astype(numpy.int64)
+        result[has_pixels] = values[starts + below] + (values[starts + above] - values[starts + below]) * (positions - below)
+        return result
+
+    def medians(self):
+        return self.percentiles(50.0)
+
+    def trimmed_means(self, proportion):
+        
+        """
+        Returns the mean of the values of every lake once the lowest and the
+        highest proportion of them are left out (like scipy.stats.trim_mean,
+        floor(proportion * count) values on each side), indexed by label.
+        """
+        (value_labels, values) = self.sorted_values()
+        starts = numpy.cumsum(self.counts) - self.counts
+        ranks = numpy.arange(len(values)) - starts[value_labels]
+        cut = numpy.floor(self.counts * proportion).astype(numpy.int64)
+        kept = (ranks >= cut[value_labels]) & (ranks < (self.counts - cut)[value_labels])
+        sums = numpy.bincount(value_labels[kept], weights=values[kept], minlength=self.lake_count + 1)
+        counts = numpy.bincount(value_labels[kept], minlength=self.lake_count + 1)
+        result = numpy.full(self.lake_count + 1, numpy.nan)
+        has_pixels = self._lakes_with_pixels() & (counts > 0)
+        result[has_pixels] = sums[has_pixels] / counts[has_pixels]
+        return result
+
+    def modes(self, bin_width):
+        
+        """
+        Returns the centre of the most populated bin_width wide histogram bin
+        of the values of every lake (the lowest one on ties), indexed by
+        label.
+        """
+        (value_labels, values) = self.sorted_values()
+        result = numpy.full(self.lake_count + 1, numpy.nan)
+        if not len(values):
+            return result
+        bins = numpy.floor(values / bin_width).astype(numpy.int64)
+        # runs of equal (label, bin) pairs, which are contiguous in the sort
+        run_starts = numpy.flatnonzero(numpy.r_[True, (value_labels[1:] != value_labels[:-1]) | (bins[1:] != bins[:-1])])
+        run_lengths = numpy.diff(numpy.r_[run_starts, len(values)])
+        run_labels = value_labels[run_starts]
+        # the longest run of every label comes first, the lowest bin on ties
+        order = numpy.lexsort((run_starts, -run_lengths, run_labels))
+        first = order[numpy.r_[True, run_labels[order][1:] != run_labels[order][:-1]]]
+        result[run_labels[first]] = (bins[run_starts[first]] + 0.5) * bin_width
+        return result
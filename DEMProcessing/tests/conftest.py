@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import os
+import sys
+
+# the package sits next to the scripts, like they import it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import os
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from lakeflattening.cache import RasterCache  # noqa: E402
+
+
+def _raster(folder, name, size):
+    path = os.path.join(str(folder), name)
+    with open(path, 'wb') as raster:
+        raster.write(b'\0' * size)
+    return path
+
+
+def test_entries_in_use_are_not_evicted(tmp_path):
+    # every entry alone is over the budget, the ones this run stored stay
+    cache = RasterCache(str(tmp_path / 'cache'), 100)
+    older = RasterCache(cache.folder, 100)
+    older.put('old', _raster(tmp_path, 'old.tif', 200))
+    cache.put('fill', _raster(tmp_path, 'fill.tif', 200))
+    cache.put('labels', _raster(tmp_path, 'labels.tif', 200))
+    assert sorted(os.listdir(cache.folder)) == ['fill.tif', 'labels.tif']
+    assert cache.in_use == {'fill', 'labels'}
+
+
+def test_writes_of_the_same_key_use_their_own_files(tmp_path):
+    cache = RasterCache(str(tmp_path / 'cache'), 1000)
+    paths = {cache._temporary_path('fill') for _ in range(3)}
+    assert len(paths) == 3
+    assert all(os.path.dirname(path) == cache.folder for path in paths)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import shutil
+import subprocess
+import uuid
+
+import numpy
+import pytest
+
+pytest.importorskip('osgeo')
+
+from osgeo import gdal  # noqa: E402
+
+from lakeflattening.fill import _flood, _touches, fill_sinks, min_slope_epsilons  # noqa: E402
+
+NODATA = -9999.0
+TOLERANCE = 1e-9
+# a Float32 fill rounds the values at the window edges the tiled fill floods
+# from, and SAGA keeps its grids in Float32
+FLOAT32_TOLERANCE = 1e-4
+
+
+def _reference_fill(elevations, is_open, seed_levels, epsilon_orthogonal=0.0, epsilon_diagonal=0.0):
+    # Planchon/Darboux by its definition: every open cell is lowered to the
+    # lowest neighbour plus the step epsilon, but not below its elevation,
+    # all cells at once until nothing changes
+    filled = numpy.where(numpy.isfinite(seed_levels), seed_levels, numpy.inf)
+    (height, width) = elevations.shape
+    while True:
+        padded = numpy.pad(filled, 1, mode='constant', constant_values=numpy.inf)
+        lowest = numpy.full(filled.shape, numpy.inf)
+        for dy in range(3):
+            for dx in range(3):
+                if dy != 1 or dx != 1:
+                    epsilon = epsilon_diagonal if dy != 1 and dx != 1 else epsilon_orthogonal
+                    numpy.minimum(lowest, padded[dy:dy + height, dx:dx + width] + epsilon, out=lowest)
+        lowered = numpy.where(is_open, numpy.minimum(filled, numpy.maximum(elevations, lowest)), filled)
+        if numpy.array_equal(lowered, filled):
+            return filled
+        filled = lowered
+
+
+def _grid(rng, shape, nodata_share):
+    elevations = numpy.round(rng.random(shape) * 10.0, int(rng.integers(0, 3)))
+    valid = rng.random(shape) >= nodata_share
+    edge = _touches(~valid) & valid
+    seed_levels = numpy.full(shape, numpy.nan)
+    seed_levels[edge] = elevations[edge]
+    return elevations, valid & ~edge, seed_levels
+
+
+@pytest.mark.parametrize('epsilons', [(0.0, 0.0), min_slope_epsilons(0.1, 1.0), min_slope_epsilons(5.0, 1.0)])
+def test_flood_matches_the_definition(epsilons):
+    rng = numpy.random.default_rng(0)
+    for _ in range(100):
+        (elevations, is_open, seed_levels) = _grid(rng, tuple(rng.integers(1, 25, 2)), rng.random() * 0.3)
+        filled = _flood(elevations, is_open, seed_levels, *epsilons)
+        expected = _reference_fill(elevations, is_open, seed_levels, *epsilons)
+        # cells walled off from every outlet stay at +inf in both
+        numpy.testing.assert_array_equal(numpy.isinf(filled), numpy.isinf(expected))
+        numpy.testing.assert_allclose(filled[numpy.isfinite(filled)], expected[numpy.isfinite(expected)], rtol=0, atol=TOLERANCE)
+
+
+def test_flood_fills_a_pit_to_its_spill_level():
+    elevations = numpy.array([[5, 5, 5, 5, 5],
+                              [5, 1, 2, 1, 5],
+                              [5, 2, 0, 2, 3],
+                              [5, 1, 2, 1, 5],
+                              [5, 5, 5, 5, 5]], dtype=numpy.float64)
+    is_open = numpy.zeros(elevations.shape, dtype=bool)
+    is_open[1:-1, 1:-1] = True
+    seed_levels = numpy.where(is_open, numpy.nan, elevations)
+    filled = _flood(elevations, is_open, seed_levels)
+    numpy.testing.assert_array_equal(filled[1:-1, 1:-1], numpy.full((3, 3), 3.0))
+
+
+def _write_dem(elevations, data_type=gdal.GDT_Float64, path=None):
+    path = path or '/vsimem/dem-{}.tif'.format(uuid.uuid4().hex)
+    dataset = gdal.GetDriverByName('GTiff').Create(path, elevations.shape[1], elevations.shape[0], 1, data_type,
+                                                   options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+    dataset.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, -1.0))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(elevations)
+    dataset = None
+    return path
+
+
+def _read(path):
+    return gdal.Open(path).GetRasterBand(1).ReadAsArray()
+
+
+def _winding_valley():
+    # drainage that crosses the windows several times: a winding valley
+    # down to one outlet on the edge, in a noisy DEM with nodata holes
+    rng = numpy.random.default_rng(1)
+    elevations = 20.0 + rng.random((70, 90)) * 5.0
+    elevations[10:60:20, 5:85] = 1.0
+    elevations[10:61, 84] = 1.0
+    elevations[20:51, 5] = 1.0
+    elevations[60, 0:5] = 1.0
+    elevations[rng.random(elevations.shape) < 0.01] = NODATA
+    return elevations
+
+
+@pytest.mark.parametrize('min_slope', [0.0, 0.5])
+@pytest.mark.parametrize('data_type, tolerance', [(gdal.GDT_Float64, TOLERANCE), (gdal.GDT_Float32, FLOAT32_TOLERANCE)])
+def test_tiled_fill_matches_the_whole_grid(min_slope, data_type, tolerance):
+    dem_path = _write_dem(_winding_valley(), data_type)
+    # the elevations as stored, rounded in a Float32 DEM
+    elevations = _read(dem_path)
+
+    whole = _read(fill_sinks(dem_path, '/vsimem/whole-{}.tif'.format(uuid.uuid4().hex), min_slope))
+    tiled = _read(fill_sinks(dem_path, '/vsimem/tiled-{}.tif'.format(uuid.uuid4().hex), min_slope, max_pixels=16 * 16))
+    numpy.testing.assert_allclose(tiled, whole, rtol=0, atol=tolerance)
+    valid = elevations != NODATA
+    assert (whole[valid] >= elevations[valid]).all()
+    numpy.testing.assert_array_equal(whole[~valid], NODATA)
+
+
+@pytest.mark.skipif(shutil.which('saga_cmd') is None, reason='SAGA is not installed')
+@pytest.mark.parametrize('tool, input_name, output_name, min_slope', [('3', '-DEM', '-RESULT', 0.0),
+                                                                       ('3', '-DEM', '-RESULT', 0.1),
+                                                                       ('4', '-ELEV', '-FILLED', 0.0)])
+def test_fill_matches_saga(tmp_path, tool, input_name, output_name, min_slope):
+    # SAGA's Planchon/Darboux (2001) fill, and Wang & Liu, which fills the
+    # same surface without a minimum slope
+    elevations = _winding_valley()
+    dem_path = _write_dem(elevations, gdal.GDT_Float32, str(tmp_path / 'dem.tif'))
+    saga_path = str(tmp_path / 'saga.sdat')
+    subprocess.run(['saga_cmd', 'ta_preprocessor', tool, input_name, dem_path, output_name, saga_path, '-MINSLOPE', str(min_slope)],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    filled = _read(fill_sinks(dem_path, str(tmp_path / 'filled.tif'), min_slope))
+    valid = elevations != NODATA
+    numpy.testing.assert_allclose(filled[valid], _read(saga_path)[valid], rtol=0, atol=FLOAT32_TOLERANCE)
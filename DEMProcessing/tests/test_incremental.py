@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import numpy
+import pytest
+
+pytest.importorskip('osgeo.ogr')
+
+from osgeo import gdal, ogr  # noqa: E402
+
+from lakeflattening.checkpoint import lake_geometry_hashes, lake_record  # noqa: E402
+from lakeflattening.engine import measure_lakes  # noqa: E402
+from lakeflattening.estimators import BoundaryMean, InteriorMean, MedianElevation  # noqa: E402
+from lakeflattening.incremental import reflatten_lakes  # noqa: E402
+from lakeflattening.labels import rasterize_lakes  # noqa: E402
+from lakeflattening.raster import burn_lake_elevations, window_dataset  # noqa: E402
+from lakeflattening.spatialindex import lake_windows  # noqa: E402
+
+NODATA = -9999.0
+TOLERANCE = 1e-5
+
+# lakes as (left, top, right, bottom) pixel boxes
+PREVIOUS_LAKES = {'a': (4, 4, 12, 10), 'b': (20, 6, 28, 14), 'c': (40, 30, 50, 38)}
+CURRENT_LAKES = {'a': (4, 4, 15, 12), 'c': (40, 30, 50, 38), 'd': (22, 40, 30, 46)}
+
+
+def _lakes(boxes):
+    lakes = []
+    for lake_id, (left, top, right, bottom) in sorted(boxes.items()):
+        geometry = ogr.CreateGeometryFromWkt('POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(left, -top, right, -bottom))
+        lakes.append((lake_id, bytes(geometry.ExportToWkb())))
+    return lakes
+
+
+def _write_dem(path):
+    rng = numpy.random.default_rng(2)
+    dataset = gdal.GetDriverByName('GTiff').Create(path, 64, 56, 1, gdal.GDT_Float32, options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+    dataset.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, -1.0))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray((10.0 + rng.random((56, 64)) * 5.0).astype(numpy.float32))
+    dataset = None
+    return path
+
+
+def _full_run(dem, lakes, output_path, estimator, base_path=None, offset=(0, 0), **output_options):
+    # what flattenLakes does for every lake, with the lake records it keeps
+    labels = rasterize_lakes(dem, lakes)
+    zonal = measure_lakes(dem, labels, [(0, 0, dem.RasterXSize, dem.RasterYSize)], **estimator.measure_options())[0]
+    elevations = estimator.elevations(labels.count, zonal)
+    burn_lake_elevations(dem, labels, elevations, output_path, base_path=base_path, offset=offset, **output_options)
+    hashes = lake_geometry_hashes(lakes)
+    windows = lake_windows(lakes, dem)
+    return [lake_record(lake_id, elevations[label], hashes[lake_id], windows.get(lake_id))
+            for label, lake_id in enumerate(labels.lake_ids, start=1)]
+
+
+def _read(path):
+    return gdal.Open(path).GetRasterBand(1).ReadAsArray()
+
+
+@pytest.mark.parametrize('estimator', [InteriorMean(), BoundaryMean(2), MedianElevation()])
+@pytest.mark.parametrize('output_options', [{}, {'layout': 'TILED', 'compression': 'DEFLATE'}])
+@pytest.mark.parametrize('window', [None, (0, 0, 64, 48)])
+def test_update_matches_a_full_run(tmp_path, estimator, output_options, window):
+    # a lake grown, one removed and one added, one left as it was
+    dem_path = _write_dem(str(tmp_path / 'dem.tif'))
+    dem = gdal.Open(window_dataset(dem_path, window, str(tmp_path / 'window.vrt')) if window else dem_path)
+    base = dict(base_path=dem_path if window else None, offset=window[:2] if window else (0, 0))
+    previous_output = str(tmp_path / 'previous.tif')
+    previous_lakes = _full_run(dem, _lakes(PREVIOUS_LAKES), previous_output, estimator, **dict(base, **output_options))
+    expected_output = str(tmp_path / 'expected.tif')
+    expected_lakes = _full_run(dem, _lakes(CURRENT_LAKES), expected_output, estimator, **dict(base, **output_options))
+
+    for output_path in (str(tmp_path / 'updated.tif'), previous_output):
+        (records, changed) = reflatten_lakes(dem, _lakes(CURRENT_LAKES), previous_lakes, previous_output, output_path, estimator,
+                                             **dict(base, **output_options))
+        assert changed == 3
+        # the lakes measured again sum their pixels in another order
+        numpy.testing.assert_allclose(_read(output_path), _read(expected_output), rtol=0, atol=TOLERANCE)
+        assert [dict(record, elevation=None) for record in records] == [dict(record, elevation=None) for record in expected_lakes]
+        numpy.testing.assert_allclose([record['elevation'] for record in records], [record['elevation'] for record in expected_lakes],
+                                      rtol=0, atol=TOLERANCE)
+
+
+def test_lakes_outside_the_previous_window_are_refused(tmp_path):
+    dem_path = _write_dem(str(tmp_path / 'dem.tif'))
+    dem = gdal.Open(window_dataset(dem_path, (0, 0, 32, 32), str(tmp_path / 'window.vrt')))
+    previous_output = str(tmp_path / 'previous.tif')
+    lakes = _lakes({'a': (4, 4, 12, 10)})
+    previous_lakes = _full_run(dem, lakes, previous_output, InteriorMean(), base_path=dem_path)
+    with pytest.raises(ValueError):
+        reflatten_lakes(dem, lakes + _lakes({'e': (40, 40, 48, 48)}), previous_lakes, previous_output, str(tmp_path / 'updated.tif'),
+                        InteriorMean(), base_path=dem_path)
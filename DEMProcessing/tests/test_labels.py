@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import numpy
+import pytest
+
+pytest.importorskip('osgeo')
+
+from lakeflattening.labels import RING_BOTH, RING_INNER, RING_OUTER, boundary_ring  # noqa: E402
+
+
+def _reference_ring(labels, width, side):
+    # the definition of the ring, pixel by pixel: distances are counted over
+    # the 8 neighbours (Chebyshev distance) and stop at the edge of the grid
+    (height, grid_width) = labels.shape
+    ring = numpy.zeros_like(labels)
+    for y in range(height):
+        for x in range(grid_width):
+            near = labels[max(0, y - width):y + width + 1, max(0, x - width):x + width + 1]
+            if labels[y, x] > 0:
+                if side != RING_OUTER and (near != labels[y, x]).any():
+                    ring[y, x] = labels[y, x]
+            elif side != RING_INNER:
+                for distance in range(1, width + 1):
+                    reached = labels[max(0, y - distance):y + distance + 1, max(0, x - distance):x + distance + 1]
+                    if reached.any():
+                        ring[y, x] = reached.max()
+                        break
+    return ring
+
+
+def _grids():
+    rng = numpy.random.default_rng(0)
+    yield numpy.zeros((5, 7), dtype=numpy.int32)
+    yield numpy.ones((5, 7), dtype=numpy.int32)
+    square = numpy.zeros((12, 12), dtype=numpy.int32)
+    square[3:9, 2:10] = 1
+    yield square
+    touching = numpy.zeros((10, 14), dtype=numpy.int32)
+    touching[2:8, 1:7] = 1
+    touching[3:9, 7:12] = 2
+    yield touching
+    # blocky lakes that touch each other and the edge of the grid
+    for _ in range(4):
+        blocks = rng.integers(0, 5, (6, 7))
+        blocks[rng.random(blocks.shape) < 0.4] = 0
+        yield numpy.kron(blocks, numpy.ones((3, 3), dtype=numpy.int64)).astype(numpy.int32)[:17, :19]
+
+
+@pytest.mark.parametrize('side', [RING_INNER, RING_OUTER, RING_BOTH])
+@pytest.mark.parametrize('width', [0, 1, 2, 3])
+def test_ring_widths(width, side):
+    for labels in _grids():
+        ring = boundary_ring(labels, width, side)
+        assert ring.dtype == labels.dtype
+        numpy.testing.assert_array_equal(ring, _reference_ring(labels, width, side))
+
+
+def test_ring_of_a_square():
+    labels = numpy.zeros((12, 12), dtype=numpy.int32)
+    labels[3:9, 2:10] = 1
+    # 6 x 8 lake: inner rings of 24 and 40 pixels, outer rings of 32 and 72
+    assert (boundary_ring(labels, 1, RING_INNER) > 0).sum() == 24
+    assert (boundary_ring(labels, 2, RING_INNER) > 0).sum() == 40
+    assert (boundary_ring(labels, 1, RING_OUTER) > 0).sum() == 32
+    assert (boundary_ring(labels, 2, RING_OUTER) > 0).sum() == 72
+    assert (boundary_ring(labels, 1, RING_BOTH) > 0).sum() == 56
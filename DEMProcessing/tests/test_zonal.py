@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+import numpy
+import pytest
+
+from lakeflattening.zonal import ZonalAccumulator, valid_pixels
+
+LAKE_COUNT = 6
+NODATA = -9999.0
+
+
+def _grid(seed=0, shape=(60, 48)):
+    # lakes of very different sizes (lake 6 has no pixel at all), values
+    # with repeated elevations and a few nodata pixels
+    rng = numpy.random.default_rng(seed)
+    labels = rng.choice(numpy.arange(LAKE_COUNT), size=shape, p=[0.3, 0.35, 0.2, 0.1, 0.04, 0.01]).astype(numpy.int32)
+    labels[0, 0] = 5
+    values = numpy.round(rng.normal(100.0, 5.0, shape), 1)
+    values[rng.random(shape) < 0.02] = NODATA
+    return values, labels
+
+
+def _lake_values(values, labels, label):
+    return values[valid_pixels(values, labels, NODATA) & (labels == label)]
+
+
+def _accumulator(values, labels, windows):
+    # every window goes to its own accumulator, merged like the partial
+    # results of the measurement
+    zonal = ZonalAccumulator(LAKE_COUNT, keep_values=True)
+    for rows in windows:
+        partial = ZonalAccumulator(LAKE_COUNT, keep_values=True)
+        partial.add(values[rows], labels[rows], NODATA)
+        zonal.merge(partial)
+    return zonal
+
+
+WINDOWS = {'one window': [slice(0, 60)],
+           'several windows': [slice(0, 7), slice(7, 30), slice(30, 31), slice(31, 60)]}
+
+
+@pytest.fixture(params=sorted(WINDOWS))
+def measured(request):
+    (values, labels) = _grid()
+    return values, labels, _accumulator(values, labels, WINDOWS[request.param])
+
+
+def _expected(values, labels, statistic):
+    expected = numpy.full(LAKE_COUNT + 1, numpy.nan)
+    for label in range(1, LAKE_COUNT + 1):
+        lake_values = _lake_values(values, labels, label)
+        if lake_values.size:
+            expected[label] = statistic(lake_values)
+    return expected
+
+
+def test_medians(measured):
+    (values, labels, zonal) = measured
+    numpy.testing.assert_allclose(zonal.medians(), _expected(values, labels, numpy.median))
+
+
+@pytest.mark.parametrize('percent', [0, 10, 25, 62.5, 90, 100])
+def test_percentiles(measured, percent):
+    (values, labels, zonal) = measured
+    numpy.testing.assert_allclose(zonal.percentiles(percent),
+                                  _expected(values, labels, lambda lake_values: numpy.percentile(lake_values, percent)))
+
+
+@pytest.mark.parametrize('proportion', [0.0, 0.1, 0.25])
+def test_trimmed_means(measured, proportion):
+    (values, labels, zonal) = measured
+
+    def trimmed_mean(lake_values):
+        cut = int(numpy.floor(len(lake_values) * proportion))
+        return numpy.sort(lake_values)[cut:len(lake_values) - cut].mean()
+
+    numpy.testing.assert_allclose(zonal.trimmed_means(proportion), _expected(values, labels, trimmed_mean))
+
+
+@pytest.mark.parametrize('bin_width', [0.5, 2.0])
+def test_modes(measured, bin_width):
+    (values, labels, zonal) = measured
+
+    def mode(lake_values):
+        (bins, counts) = numpy.unique(numpy.floor(lake_values / bin_width), return_counts=True)
+        return (bins[numpy.argmax(counts)] + 0.5) * bin_width
+
+    numpy.testing.assert_allclose(zonal.modes(bin_width), _expected(values, labels, mode))
+
+
+def test_means_and_extremes():
+    (values, labels) = _grid(1)
+    zonal = ZonalAccumulator(LAKE_COUNT, extremes=True)
+    for rows in WINDOWS['several windows']:
+        zonal.add(values[rows], labels[rows], NODATA)
+    numpy.testing.assert_allclose(zonal.means(), _expected(values, labels, numpy.mean))
+    numpy.testing.assert_allclose(zonal.minimums(), _expected(values, labels, numpy.min))
+    numpy.testing.assert_allclose(zonal.maximums(), _expected(values, labels, numpy.max))
+
+
+def test_values_added_after_a_sort():
+    # asking for a statistic sorts the kept values, later windows must be
+    # sorted in again
+    (values, labels) = _grid(2)
+    zonal = ZonalAccumulator(LAKE_COUNT, keep_values=True)
+    zonal.add(values[:30], labels[:30], NODATA)
+    zonal.medians()
+    zonal.add(values[30:], labels[30:], NODATA)
+    numpy.testing.assert_allclose(zonal.medians(), _expected(values, labels, numpy.median))
+
+
+def test_unstack():
+    (values, labels) = _grid(3)
+    (other_values, other_labels) = _grid(4)
+    # the second group of lakes is offset by lake_count + 1, like the epochs
+    # of measure_epochs
+    stacked_labels = numpy.concatenate([labels, numpy.where(other_labels > 0, other_labels + LAKE_COUNT + 1, 0)])
+    zonal = ZonalAccumulator(2 * (LAKE_COUNT + 1) - 1, extremes=True, keep_values=True)
+    zonal.add(numpy.concatenate([values, other_values]), stacked_labels, NODATA)
+    (first, second) = zonal.unstack(2)
+    numpy.testing.assert_allclose(first.medians(), _expected(values, labels, numpy.median))
+    numpy.testing.assert_allclose(second.medians(), _expected(other_values, other_labels, numpy.median))
+    numpy.testing.assert_allclose(second.maximums(), _expected(other_values, other_labels, numpy.max))
+
+
+def test_statistics_need_kept_values():
+    zonal = ZonalAccumulator(LAKE_COUNT)
+    with pytest.raises(ValueError):
+        zonal.medians()